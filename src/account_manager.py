@@ -1,31 +1,39 @@
+import threading
 import time
-from datetime import date, datetime
-from typing import Optional, List, Dict
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, List, Dict, Set, Tuple
 import logging
 import config
 from account_info import AccountInfo
 from tariff import Tariff
 from query_service import QueryService
+from data_store import DataStore, normalise_timestamp
+import metrics
 from queries import (
     get_terms_version_query,
     accept_terms_query,
     account_query,
+    account_and_consumption_query,
     consumption_query,
+    enrolment_query,
     switch_query
 )
 
 logger = logging.getLogger('octobot.account_manager')
 
 class AccountManager:
-    _instance: Optional['AccountManager'] = None
+    # One instance per account number
+    _instances: Dict[str, 'AccountManager'] = {}
+    _instances_lock = threading.Lock()
 
-    def __init__(self, query_service: QueryService, available_tariffs: List[Tariff]):
+    def __init__(self, query_service: QueryService, available_tariffs: List[Tariff], acc_number: str = None):
         """
-        Initializes the AccountManager. This should only be called once via get_instance.
+        Initializes the AccountManager. This should only be called once per account via get_instance.
         Args:
             query_service: The service instance for executing API queries.
             available_tariffs: A list of all Tariff objects that the system knows about,
             used to match against the account's current tariff.
+            acc_number: The Octopus account number, defaults to config.ACC_NUMBER.
         """
         logger.debug(f"Initialising {__class__.__name__}")
         if hasattr(self, '_initialized') and self._initialized:
@@ -34,25 +42,43 @@ class AccountManager:
         self.query_service: QueryService = query_service
         self.config = config
         self.available_tariffs: List[Tariff] = available_tariffs
+        self.acc_number: str = acc_number or config.ACC_NUMBER
 
         self._current_account_info: Optional[AccountInfo] = None
         self.mpan: Optional[str] = None
         self.device_id: Optional[str] = None
         self.region_code: Optional[str] = None
 
+        # Today's telemetry keyed by normalised readAt, so intraday runs only fetch new half-hours
+        self._telemetry_date: Optional[date] = None
+        self._telemetry_series: Dict[str, dict] = {}
+        self.data_store: Optional[DataStore] = DataStore.get_instance()
+
         self._initialized: bool = True
 
     @classmethod
-    def get_instance(cls, query_service: QueryService = None, available_tariffs: List[Tariff] = None) -> 'AccountManager':
+    def get_instance(cls, query_service: QueryService = None, available_tariffs: List[Tariff] = None,
+                     acc_number: str = None) -> 'AccountManager':
         """
-        Gets the singleton instance of AccountManager.
-        The query_service and available_tariffs must be provided on the first call.
+        Gets the AccountManager for an account number (default config.ACC_NUMBER).
+        The query_service and available_tariffs must be provided on the first call for each account.
         """
-        if cls._instance is None:
-            if query_service is None or available_tariffs is None:
-                raise ValueError("QueryService and available_tariffs must be provided for the first instantiation of AccountManager.")
-            cls._instance = cls(query_service, available_tariffs)
-        return cls._instance
+        acc_number = acc_number or config.ACC_NUMBER
+        with cls._instances_lock:
+            if acc_number not in cls._instances:
+                if query_service is None or available_tariffs is None:
+                    raise ValueError("QueryService and available_tariffs must be provided for the first instantiation of AccountManager.")
+                cls._instances[acc_number] = cls(query_service, available_tariffs, acc_number)
+            elif query_service is not None:
+                # Pick up a new QueryService (e.g. a changed API key) for later runs
+                cls._instances[acc_number].query_service = query_service
+            return cls._instances[acc_number]
+
+    @classmethod
+    def get_known_region_codes(cls) -> Set[str]:
+        """Region codes of every account fetched so far."""
+        with cls._instances_lock:
+            return {manager.region_code for manager in cls._instances.values() if manager.region_code}
 
     def _get_agreement_terms_version(self, product_code: str) -> Dict[str, int]:
         """Fetches the major and minor version of terms and conditions for a product."""
@@ -61,15 +87,115 @@ class AccountManager:
         terms_version_str = result.get('termsAndConditionsForProduct', {}).get('version', "1.0").split('.')
         return {'major': int(terms_version_str[0]), 'minor': int(terms_version_str[1])}
 
+    @metrics.span("account_info")
     def fetch_current_account_info(self) -> AccountInfo:
         """
         Fetches comprehensive information about the current electricity account,
         including tariff, consumption, MPAN, and device ID.
         Stores key details like MPAN, device ID, and region code as instance attributes.
+        When the device ID is known from a previous run the account and consumption are fetched
+        in a single batched query, falling back to the two-step flow if that device ID is stale.
         """
-        query = account_query.format(acc_number=self.config.ACC_NUMBER)
-        result = self.query_service.execute_gql_query(query)
+        end_date = f"{date.today()}T23:59:59Z"
+
+        consumption_data = None
+        cached_device_id = self.device_id
+        if cached_device_id:
+            query = account_and_consumption_query.format(
+                acc_number=self.acc_number,
+                device_id=cached_device_id,
+                start_date=self._telemetry_start(),
+                end_date=end_date
+            )
+            try:
+                result = self.query_service.execute_gql_query(query)
+                consumption_data = result.get('smartMeterTelemetry')
+            except Exception as e:
+                logger.info(f"Batched account query failed for cached device ID {cached_device_id}, falling back: {e}")
+                result = self.query_service.execute_gql_query(account_query.format(acc_number=self.acc_number))
+        else:
+            result = self.query_service.execute_gql_query(account_query.format(acc_number=self.acc_number))
+
+        matching_tariff_obj, current_standing_charge = self._parse_account(result)
+
+        if consumption_data is None or self.device_id != cached_device_id:
+            if cached_device_id and self.device_id != cached_device_id:
+                logger.info(f"Cached device ID {cached_device_id} is stale, now {self.device_id}. Refetching consumption.")
+                self._telemetry_date = None
+            # Get consumption for today
+            consumption_gql_query = consumption_query.format(
+                device_id=self.device_id,
+                start_date=self._telemetry_start(),
+                end_date=end_date
+            )
+            consumption_result = self.query_service.execute_gql_query(consumption_gql_query)
+            consumption_data = consumption_result.get('smartMeterTelemetry', [])
+
+        consumption_data = self._merge_telemetry(consumption_data)
+
+        self._current_account_info = AccountInfo(
+            current_tariff=matching_tariff_obj,
+            standing_charge=current_standing_charge,
+            region_code=self.region_code,
+            consumption=consumption_data,
+            mpan=self.mpan
+        )
+        return self._current_account_info
 
+    @metrics.span("telemetry")
+    def fetch_consumption(self, start_date: str, end_date: str) -> List[dict]:
+        """Fetches half-hourly telemetry for an arbitrary period. The account info must have been fetched first."""
+        if not self.device_id:
+            raise Exception("ERROR: Device ID unknown, fetch the account info first")
+        query = consumption_query.format(device_id=self.device_id, start_date=start_date, end_date=end_date)
+        return self.query_service.execute_gql_query(query).get('smartMeterTelemetry') or []
+
+    def _telemetry_start(self) -> str:
+        """
+        Where to start today's telemetry query. After the first fetch of the day this is the
+        high-water mark (the latest readAt seen) minus TELEMETRY_OVERLAP_MINUTES, so only new
+        half-hours plus a few recent ones (which may have been corrected) are downloaded again.
+        """
+        today = date.today()
+        day_start = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
+        if self._telemetry_date != today:
+            self._telemetry_date = today
+            self._telemetry_series = {}
+            if self.data_store and self.mpan:
+                # Pick up where a previous process left off
+                for entry in self.data_store.get_telemetry(self.mpan, f"{today}T00:00:00Z", f"{today}T23:59:59Z"):
+                    self._telemetry_series[entry['readAt']] = entry
+
+        if not self._telemetry_series:
+            return f"{today}T00:00:00Z"
+
+        high_water_mark = datetime.fromisoformat(max(self._telemetry_series).replace('Z', '+00:00'))
+        start = max(day_start, high_water_mark - timedelta(minutes=config.TELEMETRY_OVERLAP_MINUTES))
+        logger.debug(f"Fetching telemetry from {start.isoformat()} (high-water mark {high_water_mark.isoformat()})")
+        return start.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _merge_telemetry(self, new_entries: List[dict]) -> List[dict]:
+        """Merges newly fetched readings into today's series, de-duplicating by readAt, and returns the whole day in order."""
+        corrections = 0
+        for entry in new_entries:
+            read_at = normalise_timestamp(entry['readAt'])
+            existing = self._telemetry_series.get(read_at)
+            if existing and (float(existing['consumptionDelta']) != float(entry['consumptionDelta'])
+                             or float(existing.get('costDeltaWithTax') or 0) != float(entry.get('costDeltaWithTax') or 0)):
+                corrections += 1
+                logger.debug(f"Telemetry corrected at {read_at}: {existing} -> {entry}")
+            self._telemetry_series[read_at] = entry
+
+        if corrections:
+            logger.info(f"Applied {corrections} late telemetry corrections")
+        logger.debug(f"Fetched {len(new_entries)} telemetry readings, {len(self._telemetry_series)} held for today")
+        return [self._telemetry_series[read_at] for read_at in sorted(self._telemetry_series)]
+
+    def _parse_account(self, result: dict) -> Tuple[Tariff, float]:
+        """
+        Reads the IMPORT agreement from an account query result.
+        Stores MPAN, device ID and region code, returning the current tariff and its standing charge.
+        """
         import_agreement = None
         for agreement in result.get("account", {}).get("electricityAgreements", []):
             meter_point_data = agreement.get("meterPoint", {})
@@ -117,23 +243,7 @@ class AccountManager:
         if matching_tariff_obj is None:
             raise Exception(f"ERROR: Found no supported tariff object for '{tariff_code}' among available tariffs.")
 
-        # Get consumption for today
-        consumption_gql_query = consumption_query.format(
-            device_id=self.device_id,
-            start_date=f"{date.today()}T00:00:00Z",
-            end_date=f"{date.today()}T23:59:59Z"
-        )
-        consumption_result = self.query_service.execute_gql_query(consumption_gql_query)
-        consumption_data = consumption_result.get('smartMeterTelemetry', [])
-
-        self._current_account_info = AccountInfo(
-            current_tariff=matching_tariff_obj,
-            standing_charge=current_standing_charge,
-            region_code=self.region_code,
-            consumption=consumption_data,
-            mpan=self.mpan
-        )
-        return self._current_account_info
+        return matching_tariff_obj, current_standing_charge
 
     def initiate_tariff_switch(self, target_product_code: str) -> Optional[str]:
         """Initiates the process of switching to a new electricity tariff."""
@@ -146,7 +256,7 @@ class AccountManager:
 
         change_date = date.today()
         query = switch_query.format(
-            account_number=self.config.ACC_NUMBER,
+            account_number=self.acc_number,
             mpan=self.mpan,
             product_code=target_product_code,
             change_date=change_date.isoformat() # Ensure date is in YYYY-MM-DD format
@@ -154,11 +264,17 @@ class AccountManager:
         result = self.query_service.execute_gql_query(query)
         return result.get("startOnboardingProcess", {}).get("productEnrolment", {}).get("id")
 
+    def fetch_enrolment(self, enrolment_id: str) -> Optional[dict]:
+        """Fetches one of the account's product enrolments, or None if it isn't listed (yet)."""
+        result = self.query_service.execute_gql_query(enrolment_query.format(acc_number=self.acc_number))
+        return next((enrolment for enrolment in result.get("productEnrolments") or []
+                     if enrolment.get("id") == enrolment_id), None)
+
     def accept_new_agreement(self, product_code: str, enrolment_id: str) -> Optional[str]:
         # get terms and conditions version
         version = self._get_agreement_terms_version(product_code)
         # accept terms and conditions
-        query = accept_terms_query.format(account_number=self.config.ACC_NUMBER,
+        query = accept_terms_query.format(account_number=self.acc_number,
                                             enrolment_id=enrolment_id,
                                             version_major=version['major'],
                                             version_minor=version['minor'])
@@ -167,7 +283,7 @@ class AccountManager:
 
     def verify_new_agreement_status(self) -> bool:
         """Verifies if the new tariff agreement is active as of today."""
-        query = account_query.format(acc_number=self.config.ACC_NUMBER)
+        query = account_query.format(acc_number=self.acc_number)
         result = self.query_service.execute_gql_query(query)
 
         today_date = datetime.now().date()
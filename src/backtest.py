@@ -0,0 +1,188 @@
+import argparse
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+
+import config
+from account_info import AccountInfo
+from account_manager import AccountManager
+from comparison_engine import ComparisonEngine
+from data_store import normalise_timestamp
+from query_service import QueryService
+from tariff import Tariff, TARIFFS
+
+logger = logging.getLogger('octobot.backtest')
+
+
+@dataclass
+class BacktestDay:
+    """What MinMax would have done on a single day."""
+    day: date
+    billed_tariff: Tariff  # the tariff the day ends up billed on, after any switch
+    cost: float            # in pence
+    baseline_cost: float   # in pence, had we stayed on the starting tariff
+    switched: bool
+
+
+@dataclass
+class BacktestResult:
+    start: date
+    end: date
+    starting_tariff: Tariff
+    days: List[BacktestDay] = field(default_factory=list)
+    skipped_days: int = 0  # days without telemetry or rates
+
+    @property
+    def realised_cost(self) -> float:
+        return sum(day.cost for day in self.days)
+
+    @property
+    def baseline_cost(self) -> float:
+        return sum(day.baseline_cost for day in self.days)
+
+    @property
+    def savings(self) -> float:
+        return self.baseline_cost - self.realised_cost
+
+    @property
+    def switches(self) -> int:
+        return sum(1 for day in self.days if day.switched)
+
+    def summary(self) -> str:
+        lines = [
+            f"Backtest {self.start} to {self.end}: {len(self.days)} days compared, {self.skipped_days} skipped",
+            # The API only lists the products on sale now, not the versions (and standing charges) of the past
+            "Every day is priced with today's product versions and standing charges, not those on offer at the time",
+            f"Staying on {self.starting_tariff.display_name}: £{self.baseline_cost / 100:.2f}",
+            f"With MinMax (threshold {config.SWITCH_THRESHOLD}p): £{self.realised_cost / 100:.2f} after {self.switches} switches",
+            f"Cumulative savings: £{self.savings / 100:.2f}",
+        ]
+        return "\n".join(lines)
+
+
+class Backtester:
+    """
+    Replays the daily compare/switch decision over a historical date range.
+    Telemetry and unit rates are fetched a chunk of days at a time, so memory stays flat however long
+    the range is, and every day in a chunk is costed from the same prefetched rates.
+    Every day is priced with today's product versions and standing charges, as the catalogue only lists
+    the products on sale now, and the summary says so.
+    """
+
+    def __init__(self, query_service: QueryService, account_manager: AccountManager,
+                 tariffs: List[Tariff], chunk_days: int = 7):
+        logger.debug(f"Initialising {__class__.__name__}")
+        self.account_manager = account_manager
+        self.tariffs = tariffs
+        self.chunk_days = chunk_days
+        self.comparison_engine = ComparisonEngine(query_service)
+
+    def run(self, start: date, end: date, starting_tariff: Optional[Tariff] = None) -> BacktestResult:
+        account_info = self.account_manager.fetch_current_account_info()
+        baseline_tariff = starting_tariff or account_info.current_tariff
+        tariffs = self.tariffs if baseline_tariff in self.tariffs else [baseline_tariff] + self.tariffs
+
+        result = BacktestResult(start=start, end=end, starting_tariff=baseline_tariff)
+        billed_tariff = baseline_tariff
+        for chunk_start, chunk_end in self._chunks(start, end):
+            logger.info(f"Backtesting {chunk_start} to {chunk_end}")
+            self.comparison_engine.prefetch_unit_rates(tariffs, account_info.region_code, chunk_start, chunk_end)
+            consumption_by_day = self._fetch_consumption_by_day(chunk_start, chunk_end)
+
+            day = chunk_start
+            while day <= chunk_end:
+                backtest_day = self._run_day(day, consumption_by_day.get(day), billed_tariff,
+                                             baseline_tariff, tariffs, account_info)
+                if backtest_day is None:
+                    result.skipped_days += 1
+                else:
+                    result.days.append(backtest_day)
+                    billed_tariff = backtest_day.billed_tariff
+                day += timedelta(days=1)
+
+        logger.info(f"Product cache stats - {self.comparison_engine.product_cache.stats}")
+        logger.info(result.summary())
+        return result
+
+    def _run_day(self, day: date, consumption: Optional[List[dict]], on_tariff: Tariff,
+                 baseline_tariff: Tariff, tariffs: List[Tariff], account_info: AccountInfo) -> Optional[BacktestDay]:
+        if not consumption:
+            logger.warning(f"No telemetry for {day}, skipping")
+            return None
+
+        day_info = AccountInfo(
+            current_tariff=on_tariff,
+            standing_charge=0.0,  # unused, the current tariff is costed from its rates
+            region_code=account_info.region_code,
+            consumption=consumption,
+            mpan=account_info.mpan
+        )
+        try:
+            comparison = self.comparison_engine.compare_tariffs(day_info, tariffs, day, cost_current_from_rates=True)
+        except Exception as e:
+            logger.warning(f"Couldn't compare {day}, skipping: {type(e).__name__} - {e}")
+            return None
+
+        baseline = next(c for c in comparison.all_comparisons if c.tariff == baseline_tariff)
+        if not baseline.is_valid:
+            logger.warning(f"Couldn't cost {baseline_tariff.display_name} on {day}, skipping: {baseline.error}")
+            return None
+
+        switched = comparison.cheapest_tariff is not None and comparison.should_switch
+        if switched:
+            # Switching re-bills the whole day on the new tariff
+            billed_tariff = comparison.cheapest_tariff
+            cost = comparison.current_tariff_comparison.total_cost - comparison.potential_savings
+        else:
+            billed_tariff = on_tariff
+            cost = comparison.current_tariff_comparison.total_cost
+
+        return BacktestDay(day=day, billed_tariff=billed_tariff, cost=cost,
+                           baseline_cost=baseline.total_cost, switched=switched)
+
+    def _chunks(self, start: date, end: date) -> Iterator[Tuple[date, date]]:
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(end, chunk_start + timedelta(days=self.chunk_days - 1))
+            yield chunk_start, chunk_end
+            chunk_start = chunk_end + timedelta(days=1)
+
+    def _fetch_consumption_by_day(self, start: date, end: date) -> Dict[date, List[dict]]:
+        consumption = self.account_manager.fetch_consumption(f"{start}T00:00:00Z", f"{end}T23:59:59Z")
+        by_day: Dict[date, List[dict]] = {}
+        for entry in consumption:
+            day = date.fromisoformat(normalise_timestamp(entry['readAt'])[:10])
+            by_day.setdefault(day, []).append(entry)
+        return by_day
+
+
+def main():
+    import logger as logging_setup  # configures the octobot log handlers
+
+    parser = argparse.ArgumentParser(description="Estimate what MinMax would have saved over a past date range.")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First day, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today() - timedelta(days=1),
+                        help="Last day, YYYY-MM-DD. Defaults to yesterday")
+    parser.add_argument("--tariff", help="ID of the tariff to start on. Defaults to your current tariff")
+    parser.add_argument("--chunk-days", type=int, default=config.BACKTEST_CHUNK_DAYS,
+                        help="Days of telemetry and rates fetched per request")
+    args = parser.parse_args()
+
+    requested_ids = set(config.TARIFFS.lower().split(","))
+    tariffs = [tariff for tariff in TARIFFS if tariff.id in requested_ids]
+    starting_tariff = None
+    if args.tariff:
+        starting_tariff = next((tariff for tariff in TARIFFS if tariff.id == args.tariff.lower()), None)
+        if starting_tariff is None:
+            parser.error(f"No tariff found for ID '{args.tariff}'")
+
+    query_service = QueryService(config.API_KEY, config.BASE_URL)
+    account_manager = AccountManager.get_instance(query_service, TARIFFS)
+    backtester = Backtester(query_service, account_manager, tariffs, args.chunk_days)
+    # run() logs the summary, which the logger's console handler shows
+    backtester.run(args.start, args.end, starting_tariff)
+
+
+if __name__ == "__main__":
+    main()
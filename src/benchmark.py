@@ -0,0 +1,348 @@
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+import logging
+
+import config
+from account_manager import AccountManager
+from bot_orchestrator import AccountContext, BotOrchestrator
+from comparison_engine import ComparisonEngine
+from product_cache import ProductCache
+from tariff import Tariff, TARIFFS
+
+logger = logging.getLogger('octobot.benchmark')
+
+REGION_CODES = "ABCDEFGHJKLMNP"
+REGION = "C"
+ACC_NUMBER = "A-BENCH001"
+# Product codes of the real tariffs, the extra benchmark tariffs are numbered after them
+PRODUCT_CODES = {
+    "go": "GO-VAR-22-10-14",
+    "agile": "AGILE-24-10-01",
+    "cosy": "COSY-22-12-08",
+    "flexible": "VAR-22-11-01",
+}
+# Rate shapes: Agile's 48 half-hourly rates a day, or Flexible's single open-ended rate
+RATE_SHAPES = ("agile", "flexible")
+
+
+@dataclass
+class Scenario:
+    days: int
+    tariff_count: int
+    rate_shape: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.days}d/{self.tariff_count} tariffs/{self.rate_shape}"
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    target: str
+    runs: int
+    min_ms: float
+    median_ms: float
+    peak_kib: float
+    requests: int  # per run, as served by the stand-in QueryService
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _agile_publication_end(day: date) -> datetime:
+    """
+    23:00 UK time on day, in UTC, where the Agile rates published the afternoon before end.
+    BST runs from the last Sunday of March to the last Sunday of October.
+    """
+    def last_sunday(month: int) -> date:
+        end_of_month = date(day.year, month, 31)
+        return end_of_month - timedelta(days=(end_of_month.weekday() + 1) % 7)
+
+    utc_offset = timedelta(hours=1) if last_sunday(3) <= day < last_sunday(10) else timedelta(0)
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc) + timedelta(hours=23) - utc_offset
+
+
+def benchmark_tariffs(count: int) -> List[Tariff]:
+    """The four real tariffs, plus numbered copies of them up to count."""
+    tariffs = list(TARIFFS[:count])
+    for number in range(len(tariffs), count):
+        tariffs.append(Tariff(f"bench{number}", f"Bench Tariff {number}", f"Bench Tariff {number}",
+                              rf"-BENCH{number}-", f"bench{number}", True))
+    return tariffs
+
+
+def _product_code(tariff: Tariff) -> str:
+    return PRODUCT_CODES.get(tariff.id, f"{tariff.id.upper()}-25-01-01")
+
+
+class Fixtures:
+    """
+    API responses for a scenario, in the shape the Octopus API returns them: the product catalogue,
+    product details for every region, the unit rates and smartMeterTelemetry for every day of the scenario.
+    They're kept as JSON text so replaying them costs the same parsing as a real response.
+    """
+
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self.tariffs = benchmark_tariffs(scenario.tariff_count)
+        self.current_tariff = next(tariff for tariff in self.tariffs if tariff.id == "agile")
+        self.rest: Dict[str, str] = {}  # URL without its query string: response body
+        today = date.today()
+        self.start = datetime.combine(today - timedelta(days=scenario.days - 1), datetime.min.time(), tzinfo=timezone.utc)
+        self.end = self.start + timedelta(days=scenario.days)
+        # Agile's rates are published in the afternoon up to 23:00 UK time the next day
+        self.rates_end = _agile_publication_end(today + timedelta(days=1))
+
+        catalogue = []
+        # Tariffs share one of a few rate documents so 40 tariffs' worth of a year's Agile rates fits in memory
+        rate_documents = [json.dumps(self._unit_rates(1 + variant * 0.05)) for variant in range(4)]
+        for position, tariff in enumerate(self.tariffs):
+            code = _product_code(tariff)
+            product_url = f"{config.BASE_URL}/products/{code}/"
+            catalogue.append({
+                "code": code,
+                "direction": "IMPORT",
+                "display_name": tariff.api_display_name,
+                "links": [{"href": product_url, "method": "GET", "rel": "self"}],
+            })
+            self.rest[product_url] = json.dumps(self._product(code, tariff))
+            self.rest[self._rates_url(code, REGION)] = rate_documents[position % len(rate_documents)]
+        self.rest[f"{config.BASE_URL}/products/"] = json.dumps({"count": len(catalogue), "next": None, "results": catalogue})
+
+        self.telemetry = json.dumps({"smartMeterTelemetry": self._telemetry()})
+        self.account = json.dumps(self._account())
+
+    @staticmethod
+    def _rates_url(code: str, region: str) -> str:
+        return f"{config.BASE_URL}/products/{code}/electricity-tariffs/E-1R-{code}-{region}/standard-unit-rates/"
+
+    def _product(self, code: str, tariff: Tariff) -> dict:
+        regions = {}
+        for region in REGION_CODES:
+            regions[f"_{region}"] = {"direct_debit_monthly": {
+                "code": f"E-1R-{code}-{region}",
+                "standing_charge_exc_vat": 45.0,
+                "standing_charge_inc_vat": 47.25,
+                "links": [{"href": self._rates_url(code, region), "method": "GET", "rel": "standard_unit_rates"}],
+            }}
+        return {"code": code, "display_name": tariff.api_display_name, "is_variable": True,
+                "single_register_electricity_tariffs": regions}
+
+    def _unit_rates(self, scale: float) -> dict:
+        if self.scenario.rate_shape == "flexible":
+            # Flexible has one open-ended rate, listed for both payment methods
+            results = [
+                {"value_exc_vat": 23.0 * scale, "value_inc_vat": round(24.15 * scale, 4), "valid_from": "2024-10-01T00:00:00Z",
+                 "valid_to": None, "payment_method": payment_method}
+                for payment_method in ("DIRECT_DEBIT", "NON_DIRECT_DEBIT")
+            ]
+        else:
+            results = []
+            slot = self.rates_end
+            while slot > self.start:
+                # Newest first, like the API
+                valid_from = slot - timedelta(minutes=30)
+                value = round((8 + 20 * ((valid_from.hour * 2 + valid_from.minute // 30) % 48) / 47) * scale, 4)
+                results.append({"value_exc_vat": round(value / 1.05, 4), "value_inc_vat": value,
+                                "valid_from": _timestamp(valid_from), "valid_to": _timestamp(slot),
+                                "payment_method": None})
+                slot = valid_from
+        return {"count": len(results), "next": None, "previous": None, "results": results}
+
+    def _telemetry(self) -> List[dict]:
+        readings = []
+        read_at = self.start
+        while read_at < self.end:
+            slot = read_at.hour * 2 + read_at.minute // 30
+            consumption = 150.0 + 300.0 * (slot in range(34, 42)) + (slot * 7) % 40
+            readings.append({
+                "readAt": read_at.isoformat(),
+                "consumptionDelta": f"{consumption:.1f}",
+                "costDeltaWithTax": f"{consumption / 1000 * 24.5:.4f}",
+            })
+            read_at += timedelta(minutes=30)
+        return readings
+
+    def _account(self) -> dict:
+        code = _product_code(self.current_tariff)
+        return {"account": {"electricityAgreements": [{
+            "validFrom": _timestamp(self.start),
+            "validTo": None,
+            "meterPoint": {"meters": [{"smartDevices": [{"deviceId": "00-00-00-00-00-00-00-01"}]}],
+                           "mpan": "1900000000001", "direction": "IMPORT"},
+            "tariff": {"id": "1", "productCode": code, "tariffCode": f"E-1R-{code}-{REGION}",
+                       "standingCharge": 47.25},
+        }]}}
+
+
+class ReplayQueryService:
+    """Stands in for QueryService, answering every request from the fixtures rather than the API."""
+
+    def __init__(self, fixtures: Fixtures):
+        self.fixtures = fixtures
+        self.requests = 0
+
+    def execute_gql_query(self, query: str) -> dict:
+        self.requests += 1
+        result = {}
+        if "account(" in query:
+            result.update(json.loads(self.fixtures.account))
+        if "smartMeterTelemetry(" in query:
+            result.update(json.loads(self.fixtures.telemetry))
+        return result
+
+    def execute_rest_query(self, url: str) -> dict:
+        self.requests += 1
+        try:
+            return json.loads(self.fixtures.rest[url.split("?")[0]])
+        except KeyError:
+            raise Exception(f"No fixture for {url}")
+
+    def execute_conditional_rest_query(self, url: str, etag: str = None, last_modified: str = None):
+        return self.execute_rest_query(url), {"ETag": '"bench"'}
+
+
+class SilentNotifications:
+    def send_notification(self, message: str, title: str = "", is_error: bool = False, batchable: bool = True) -> bool:
+        return True
+
+    def send_batch_notification(self) -> bool:
+        return True
+
+
+def _compare_tariffs(fixtures: Fixtures) -> Callable[[], Tuple[int, float]]:
+    def run() -> Tuple[int, float]:
+        query_service = ReplayQueryService(fixtures)
+        account_info = AccountManager(query_service, fixtures.tariffs, ACC_NUMBER).fetch_current_account_info()
+        engine = ComparisonEngine(query_service)
+        # Only the comparison itself is timed, the account info is already fetched
+        query_service.requests = 0
+        started = time.perf_counter()
+        engine.compare_tariffs(account_info, fixtures.tariffs)
+        return query_service.requests, time.perf_counter() - started
+    return run
+
+
+def _compare_and_switch(fixtures: Fixtures) -> Callable[[], Tuple[int, float]]:
+    def run() -> Tuple[int, float]:
+        query_service = ReplayQueryService(fixtures)
+        orchestrator = BotOrchestrator()
+        orchestrator.tariffs = fixtures.tariffs
+        orchestrator.notification_service = SilentNotifications()
+        context = AccountContext(acc_number=ACC_NUMBER, query_service=query_service,
+                                 account_manager=AccountManager(query_service, fixtures.tariffs, ACC_NUMBER))
+        started = time.perf_counter()
+        orchestrator._compare_and_switch(context, ComparisonEngine(query_service))
+        return query_service.requests, time.perf_counter() - started
+    return run
+
+
+TARGETS: Dict[str, Callable[[Fixtures], Callable[[], Tuple[int, float]]]] = {
+    "compare_tariffs": _compare_tariffs,
+    "compare_and_switch": _compare_and_switch,
+}
+
+
+def run_benchmark(scenario: Scenario, target: str, runs: int) -> BenchmarkResult:
+    """
+    Times target over runs fresh runs, each with an empty product cache, then runs it once more
+    under tracemalloc for the peak memory, which isn't timed as tracing slows everything down.
+    """
+    fixtures = Fixtures(scenario)
+    run = TARGETS[target](fixtures)
+    timings = []
+    requests = 0
+    for _ in range(runs):
+        ProductCache.get_instance().clear()
+        requests, elapsed = run()
+        timings.append(elapsed)
+
+    ProductCache.get_instance().clear()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchmarkResult(scenario=scenario.name, target=target, runs=runs,
+                           min_ms=min(timings) * 1000, median_ms=statistics.median(timings) * 1000,
+                           peak_kib=peak / 1024, requests=requests)
+
+
+def find_regressions(results: List[BenchmarkResult], baseline: List[dict], tolerance: float) -> List[str]:
+    """Describes every result whose median is more than tolerance (a fraction) slower than the baseline's."""
+    previous = {(entry['scenario'], entry['target']): entry for entry in baseline}
+    regressions = []
+    for result in results:
+        entry = previous.get((result.scenario, result.target))
+        if entry and result.median_ms > entry['median_ms'] * (1 + tolerance):
+            regressions.append(f"{result.target} {result.scenario}: {result.median_ms:.1f}ms, "
+                               f"was {entry['median_ms']:.1f}ms")
+    return regressions
+
+
+def format_results(results: List[BenchmarkResult]) -> str:
+    lines = [f"{'target':<20}{'scenario':<32}{'min ms':>10}{'median ms':>11}{'peak KiB':>11}{'requests':>10}"]
+    for result in results:
+        lines.append(f"{result.target:<20}{result.scenario:<32}{result.min_ms:>10.1f}{result.median_ms:>11.1f}"
+                     f"{result.peak_kib:>11.0f}{result.requests:>10}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the comparison against recorded-shape API responses, without touching the API.")
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 365], help="Days of telemetry to compare")
+    parser.add_argument("--tariffs", type=int, nargs="+", default=[4, 40], help="How many tariffs to compare")
+    parser.add_argument("--rates", nargs="+", choices=RATE_SHAPES, default=list(RATE_SHAPES),
+                        help="Agile's half-hourly rates or Flexible's single rate")
+    parser.add_argument("--target", nargs="+", choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs of each scenario")
+    parser.add_argument("--engine", choices=["python", "numpy"], default=config.COSTING_ENGINE,
+                        help="Costing engine, defaults to COSTING_ENGINE")
+    parser.add_argument("--save", help="Write the results as JSON, for use as a later --baseline")
+    parser.add_argument("--baseline", help="Results saved with --save to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower (as a fraction) than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    # Everything is served from memory: no stored telemetry or rates, no notifications and no switching
+    config.DATA_STORE_PATH = ""
+    config.DRY_RUN = True
+    config.COSTING_ENGINE = args.engine
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s - %(name)s - %(message)s")
+
+    results = []
+    for days, tariff_count, rate_shape in itertools.product(args.days, args.tariffs, args.rates):
+        scenario = Scenario(days, tariff_count, rate_shape)
+        for target in args.target:
+            result = run_benchmark(scenario, target, args.runs)
+            print(f"{target} {scenario.name}: median {result.median_ms:.1f}ms", file=sys.stderr)
+            results.append(result)
+    print(format_results(results))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline by more than {args.tolerance:.0%}:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import time
-from datetime import date, datetime
-from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, List, Dict, Optional, Tuple
 import random
 import config
 from account_info import AccountInfo
@@ -10,20 +12,38 @@ from tariff import Tariff, TARIFFS
 from query_service import QueryService
 from comparison_engine import ComparisonEngine, ComparisonResult
 from notification_service import NotificationService
+from data_store import DataStore
+from intraday import IntradayProjector, IntradayProjection
+from switch_tracker import SwitchOutcome, SwitchStage, SwitchTracker
+from scheduler import Scheduler, daily_at, daily_at_times
+from structured_logging import run_context, log_context, in_current_context
+import metrics
+import config_manager
 import logging
 logger = logging.getLogger('octobot.bot_orchestrator')
 
 def get_timestamp():
     return datetime.now().strftime("%d/%m/%Y %H:%M")
 
+@dataclass
+class AccountContext:
+    """Everything needed to compare and switch a single Octopus account."""
+    acc_number: str
+    query_service: QueryService
+    account_manager: AccountManager
+    label: str = ""  # prefixed to notifications when several accounts are managed
+
 class BotOrchestrator:
     def __init__(self):
         logger.debug(f"Initialising {__class__.__name__}")
-        self.query_service = None
-        self.account_manager = None
+        self.accounts: List[Tuple[str, str]] = []  # (account number, API key)
         self.tariffs = []
-        self.last_execution_datetime = None
         self.notification_service = None
+        self.scheduler = None
+        self.data_store = None
+        self.intraday_projector = None
+        # Kept between runs, so what the cache warm-up fetched is still there for the comparison
+        self.comparison_engine: Optional[ComparisonEngine] = None
 
     def start(self) -> None:
         self.notification_service = NotificationService(config.NOTIFICATION_URLS, config.BATCH_NOTIFICATIONS)
@@ -32,34 +52,118 @@ class BotOrchestrator:
         mode_msg = "ONE_OFF mode enabled" if config.ONE_OFF_RUN else f"Scheduled mode, running at {config.EXECUTION_TIME}"
         ns.send_notification(f"[{get_timestamp()}] Octobot {config.BOT_VERSION} - {mode_msg} \n Check port {config.WEB_PORT} for dashboard.")
 
-        while True:
-            if config.ONE_OFF_RUN and not config.ONE_OFF_EXECUTED:
-                ns.send_notification(f"[{get_timestamp()}] Octobot {config.BOT_VERSION} - Running one-off comparison")
-                self._run_tariff_compare()
-                config.ONE_OFF_EXECUTED = True
-            elif not config.ONE_OFF_RUN:
-                now = datetime.now()
-                current_time = now.strftime("%H:%M")
-                current_minute = now.replace(second=0, microsecond=0)  # Datetime object at minute precision
-                if current_time == config.EXECUTION_TIME and self.last_execution_datetime != current_minute:
-                    self.last_execution_datetime = current_minute
-                    delay = random.randint(10, 900)
-                    ns.send_notification(f"[{get_timestamp()}] Octobot {config.BOT_VERSION} - Initiating comparison in {delay/60:.1f} minutes")
-                    time.sleep(delay)
-                    self._run_tariff_compare()
-
-            time.sleep(30)
+        self.scheduler = Scheduler()
+        self.scheduler.add_job("one_off_compare", self._one_off_schedule, self._run_one_off_compare)
+        self.scheduler.add_job("daily_compare", self._daily_schedule(), self._start_daily_compare)
+        self.scheduler.add_job("cache_warm_up", self._daily_schedule(-timedelta(minutes=config.CACHE_WARM_UP_MINUTES)),
+                               self._warm_caches)
+        self.scheduler.add_job("intraday_projection", self._intraday_schedule, self._run_intraday_projection)
+        self.scheduler.add_job("day_ahead_forecast", self._day_ahead_schedule, self._run_day_ahead_forecast)
+        # Wake straight away when the config changes instead of waiting for the next job
+        config_manager.add_change_listener(self.scheduler.reschedule)
+        self.scheduler.run()
+
+    def stop(self, flush_timeout: float) -> None:
+        """Stops scheduling jobs and waits up to flush_timeout seconds for queued notifications to be sent."""
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.notification_service:
+            self.notification_service.close(flush_timeout)
+
+    def _one_off_schedule(self, now: datetime) -> Optional[datetime]:
+        return now if config.ONE_OFF_RUN and not config.ONE_OFF_EXECUTED else None
+
+    def _daily_schedule(self, offset: timedelta = timedelta(0)):
+        """Runs at EXECUTION_TIME (shifted by offset) every day, except in one-off mode."""
+        at_execution_time = daily_at(lambda: config.EXECUTION_TIME, offset)
+        return lambda now: None if config.ONE_OFF_RUN else at_execution_time(now)
+
+    def _intraday_schedule(self, now: datetime) -> Optional[datetime]:
+        if config.ONE_OFF_RUN:
+            return None
+        return daily_at_times(lambda: config.INTRADAY_TIMES.split(","))(now)
+
+    def _day_ahead_schedule(self, now: datetime) -> Optional[datetime]:
+        if config.ONE_OFF_RUN:
+            return None
+        return daily_at_times(lambda: [config.DAY_AHEAD_TIME])(now)
+
+    def _run_one_off_compare(self) -> None:
+        self.notification_service.send_notification(f"[{get_timestamp()}] Octobot {config.BOT_VERSION} - Running one-off comparison")
+        config.ONE_OFF_EXECUTED = True
+        self._run_tariff_compare()
+
+    def _start_daily_compare(self) -> None:
+        # A random delay spreads everyone's bots out rather than hitting the API at the same minute
+        delay = random.randint(10, 900)
+        self.notification_service.send_notification(f"[{get_timestamp()}] Octobot {config.BOT_VERSION} - Initiating comparison in {delay/60:.1f} minutes")
+        self.scheduler.add_one_shot("delayed_compare", delay, self._run_tariff_compare)
+
+    def _warm_caches(self) -> None:
+        """Fetches the product catalogue, product details and today's rates ahead of the daily comparison."""
+        self._load_tariffs_from_ids(config.TARIFFS)
+        comparison_engine = self._get_comparison_engine(QueryService(config.API_KEY, config.BASE_URL))
+        comparison_engine.warm_caches(self.tariffs, AccountManager.get_known_region_codes())
+
+    def _get_comparison_engine(self, query_service: QueryService) -> ComparisonEngine:
+        """The long-lived comparison engine, set up for a run using query_service."""
+        if self.comparison_engine is None:
+            self.comparison_engine = ComparisonEngine(query_service)
+        else:
+            self.comparison_engine.start_run(query_service)
+        return self.comparison_engine
 
     def _initialize(self) -> None:
         logger.debug(f"{__name__}")
         self._load_tariffs_from_ids(config.TARIFFS)
-        self.query_service = QueryService(config.API_KEY, config.BASE_URL)
-        self.account_manager = AccountManager.get_instance(self.query_service, self.tariffs)
+        self.accounts = self._load_accounts(config.ACCOUNTS)
+        self.data_store = DataStore.get_instance()
+        if self.data_store and self.intraday_projector is None:
+            self.intraday_projector = IntradayProjector(self.data_store)
+
+    def _load_accounts(self, accounts: str) -> List[Tuple[str, str]]:
+        """Load (account number, API key) pairs from a comma-separated list of ACC_NUMBER:API_KEY, or the single configured account."""
+        if not accounts.strip():
+            return [(config.ACC_NUMBER, config.API_KEY)]
+
+        loaded = []
+        for entry in accounts.split(","):
+            acc_number, _, api_key = entry.strip().partition(":")
+            if not acc_number or not api_key:
+                self.notification_service.send_notification(f"Warning: Ignoring malformed account entry '{acc_number}', expected ACC_NUMBER:API_KEY")
+                continue
+            loaded.append((acc_number, api_key))
+        return loaded
+
+    def _run_deadline(self) -> float:
+        """
+        When this run has to stop making API requests, as a time.monotonic() value: RUN_TIMEOUT_MINUTES
+        from now, but never past midnight, after which today's comparison no longer means anything.
+        """
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        seconds = min(config.RUN_TIMEOUT_MINUTES * 60, (midnight - now).total_seconds())
+        logger.debug(f"Run deadline in {seconds:.0f}s")
+        return time.monotonic() + seconds
+
+    @staticmethod
+    def _switch_deadline() -> float:
+        return time.monotonic() + config.SWITCH_TIMEOUT_MINUTES * 60
+
+    def _create_account_context(self, acc_number: str, api_key: str, deadline: Optional[float] = None) -> AccountContext:
+        query_service = QueryService(api_key, config.BASE_URL, deadline)
+        return AccountContext(
+            acc_number=acc_number,
+            query_service=query_service,
+            account_manager=AccountManager.get_instance(query_service, self.tariffs, acc_number),
+            label=f"[{acc_number}] " if len(self.accounts) > 1 else ""
+        )
 
 
     def _load_tariffs_from_ids(self, tariff_ids: str) -> None:
         """Load tariffs from comma-separated string of IDs."""
-        requested_ids = set(tariff_ids.lower().split(","))
+        # dict.fromkeys de-duplicates while keeping the configured order, so summaries are deterministic
+        requested_ids = dict.fromkeys(tariff_ids.lower().split(","))
         logger.debug(f" Requested tariff IDs - {requested_ids}")
         matched_tariffs = []
         for tariff_id in requested_ids:
@@ -73,19 +177,61 @@ class BotOrchestrator:
         self.tariffs = matched_tariffs
 
     def _run_tariff_compare(self) -> None:
+        self._run_for_accounts("compare", self._compare_and_switch)
+
+    def _run_intraday_projection(self) -> None:
+        self._run_for_accounts("intraday", self._project_and_switch)
+
+    def _run_day_ahead_forecast(self) -> None:
+        self._run_for_accounts("day_ahead", self._forecast_day_ahead)
+
+    def _run_for_accounts(self, kind: str, action: Callable[[AccountContext, ComparisonEngine], None]) -> None:
+        metrics.runs.inc(kind=kind)
+        with run_context() as run_stats:
+            with metrics.span(f"{kind}_run"):
+                self._run_accounts(action)
+            # The run's own span is the total, the others show where the time went
+            logger.info(f"Run finished after {run_stats.spans[f'{kind}_run'][1]:.1f}s and {run_stats.api_calls} API calls:\n"
+                        f"{metrics.format_span_summary(run_stats.spans)}",
+                        extra={'api_calls': run_stats.api_calls, 'spans': run_stats.spans})
+
+    def _run_accounts(self, action: Callable[[AccountContext, ComparisonEngine], None]) -> None:
         ns = self.notification_service
         try:
             self._initialize()
-            if self.query_service is None:
-                raise Exception("ERROR: QueryService initialization failed")
+            if not self.accounts:
+                raise Exception("ERROR: No accounts configured")
 
-            self._compare_and_switch()
+            deadline = self._run_deadline()
+            # Product and rate data is public, so one engine (and its caches) is shared by every account
+            comparison_engine = self._get_comparison_engine(QueryService(self.accounts[0][1], config.BASE_URL, deadline))
+            workers = min(config.ACCOUNT_WORKERS, len(self.accounts))
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Account") as executor:
+                    list(executor.map(in_current_context(lambda account: self._run_account(account, comparison_engine, action, deadline)),
+                                      self.accounts))
+            else:
+                for account in self.accounts:
+                    self._run_account(account, comparison_engine, action, deadline)
         except Exception as e:
             ns.send_notification(message=str(e), title="Octobot Error", is_error=True)
         finally:
             if config.BATCH_NOTIFICATIONS:
                 ns.send_batch_notification()
 
+    def _run_account(self, account: Tuple[str, str], comparison_engine: ComparisonEngine,
+                     action: Callable[[AccountContext, ComparisonEngine], None], deadline: float) -> None:
+        """Run action for a single account. Failures are reported without affecting the other accounts."""
+        acc_number, api_key = account
+        label = f"[{acc_number}] " if len(self.accounts) > 1 else ""
+        try:
+            with log_context(account=acc_number):
+                context = self._create_account_context(acc_number, api_key, deadline)
+                action(context, comparison_engine)
+        except Exception as e:
+            logger.exception(f"Comparison failed for account {acc_number}")
+            self.notification_service.send_notification(message=f"{label}{e}", title="Octobot Error", is_error=True)
+
     def _format_comparison_summary(self, result: ComparisonResult) -> str:
         lines = []
 
@@ -113,26 +259,83 @@ class BotOrchestrator:
 
         return "\n".join(lines)
 
-    def _compare_and_switch(self) -> None:
-        ns = self.notification_service
+    def _format_projection_summary(self, projection: IntradayProjection) -> str:
+        lines = [f"Projected costs for today, from {projection.slots_metered} metered half-hours and "
+                 f"a forecast from the last {projection.history_days} {projection.day:%A}s:"]
+
+        for label, tariff_projection in [("Current tariff", projection.current)] + \
+                [("Projected cost on", alternative) for alternative in projection.alternatives]:
+            if tariff_projection.is_valid:
+                low, high = tariff_projection.band
+                lines.append(
+                    f"{label} {tariff_projection.tariff.display_name}: "
+                    f"£{tariff_projection.projected_cost / 100:.2f} (£{low / 100:.2f} to £{high / 100:.2f})"
+                )
+            else:
+                lines.append(f"No projection for {tariff_projection.tariff.display_name}")
+
+        if projection.cheapest_tariff and projection.cheapest_tariff != projection.current.tariff:
+            low, high = projection.savings_band
+            lines.append(
+                f"Projected savings on {projection.cheapest_tariff.display_name}: "
+                f"£{projection.projected_savings / 100:.2f} (£{low / 100:.2f} to £{high / 100:.2f})"
+            )
+
+        return "\n".join(lines)
+
+    def _format_day_ahead_summary(self, forecast: IntradayProjection) -> str:
+        lines = [f"Forecast for tomorrow ({forecast.day:%a %d %b}), from your usage on the last "
+                 f"{forecast.history_days} {forecast.day:%A}s:"]
+        if forecast.is_partial_day:
+            covered_until = datetime.combine(forecast.day, datetime.min.time()) + timedelta(minutes=30 * forecast.slots_covered)
+            lines.append(f"Only up to {covered_until:%H:%M} UTC, where the published rates end")
+
+        for label, tariff_projection in [("Current tariff", forecast.current)] + \
+                [("Forecast cost on", alternative) for alternative in forecast.alternatives]:
+            if tariff_projection.is_valid:
+                low, high = tariff_projection.band
+                lines.append(
+                    f"{label} {tariff_projection.tariff.display_name}: "
+                    f"£{tariff_projection.projected_cost / 100:.2f} (£{low / 100:.2f} to £{high / 100:.2f})"
+                )
+            else:
+                lines.append(f"No forecast for {tariff_projection.tariff.display_name}: {tariff_projection.error}")
+
+        if forecast.cheapest_tariff and forecast.cheapest_tariff != forecast.current.tariff:
+            low, high = forecast.savings_band
+            lines.append(
+                f"Tomorrow looks cheapest on {forecast.cheapest_tariff.display_name}, saving "
+                f"£{forecast.projected_savings / 100:.2f} (£{low / 100:.2f} to £{high / 100:.2f})"
+            )
+
+        return "\n".join(lines)
+
+    def _notify(self, context: AccountContext, message: str, **kwargs) -> None:
+        self.notification_service.send_notification(message=f"{context.label}{message}", **kwargs)
+
+    def _compare_and_switch(self, context: AccountContext, comparison_engine: ComparisonEngine) -> None:
         welcome_message = f"{'DRY RUN: ' if config.DRY_RUN else ''}Starting comparison of today's costs..."
-        ns.send_notification(welcome_message)
+        self._notify(context, welcome_message)
 
-        account_info = self.account_manager.fetch_current_account_info()
+        account_info = context.account_manager.fetch_current_account_info()
+        if self.data_store:
+            self.data_store.save_telemetry(account_info.mpan, account_info.consumption)
 
-        comparison_engine = ComparisonEngine(self.query_service)
         results = comparison_engine.compare_tariffs(account_info, self.tariffs)
+        logger.info(f"Product cache stats - {comparison_engine.product_cache.stats}")
+        if self.data_store:
+            self.data_store.save_comparison(results, account_info.mpan)
 
         summary = self._format_comparison_summary(results)
-        ns.send_notification(message=summary)
+        self._notify(context, summary)
 
         if results.should_switch:
             switch_message = f"Initiating Switch to {results.cheapest_tariff.display_name}"
-            ns.send_notification(switch_message)
+            self._notify(context, switch_message)
             if config.DRY_RUN:
-                ns.send_notification("DRY RUN: Not going through with switch today.")
+                self._notify(context, "DRY RUN: Not going through with switch today.")
             else:
-                self._execute_switch(results.cheapest_tariff, account_info)
+                self._execute_switch(context, results.cheapest_tariff, account_info)
         else:
             if results.cheapest_tariff == results.current_tariff_comparison.tariff:
                 message = (f"You are already on the cheapest tariff: "
@@ -142,37 +345,76 @@ class BotOrchestrator:
                 message = (f"Not switching today - savings of (£{results.potential_savings / 100:.2f}) "
                            f"on the cheapest tariff {results.cheapest_tariff.display_name} are below your "
                            f"threshold of £{config.SWITCH_THRESHOLD / 100:.2f}")
-            ns.send_notification(message)
+            self._notify(context, message)
 
-    def _execute_switch(self, target_tariff: Tariff, account_info: AccountInfo) -> None:
-        ns = self.notification_service
+    def _project_and_switch(self, context: AccountContext, comparison_engine: ComparisonEngine) -> None:
+        """
+        Projects today's cost on each tariff from the consumption so far. Only a run at or after
+        INTRADAY_SWITCH_AFTER can switch, and only when the whole savings band clears the threshold.
+        """
+        if self.intraday_projector is None:
+            raise Exception("ERROR: Intraday projections need stored telemetry history, set DATA_STORE_PATH")
+
+        account_info = context.account_manager.fetch_current_account_info()
+        self.data_store.save_telemetry(account_info.mpan, account_info.consumption)
+
+        projection = self.intraday_projector.project(account_info, self.tariffs, comparison_engine)
+        self._notify(context, self._format_projection_summary(projection))
+
+        if projection.should_switch and datetime.now().strftime("%H:%M") >= config.INTRADAY_SWITCH_AFTER:
+            self._notify(context, f"Initiating Switch to {projection.cheapest_tariff.display_name}")
+            if config.DRY_RUN:
+                self._notify(context, "DRY RUN: Not going through with switch today.")
+            else:
+                self._execute_switch(context, projection.cheapest_tariff, account_info)
+
+    def _forecast_day_ahead(self, context: AccountContext, comparison_engine: ComparisonEngine) -> None:
+        """
+        Fetches and stores tomorrow's rates for every tariff, so tomorrow's runs don't have to, and forecasts
+        tomorrow's cost on each from the usual consumption of that weekday.
+        """
+        if self.intraday_projector is None:
+            raise Exception("ERROR: Day-ahead forecasts need stored telemetry history, set DATA_STORE_PATH")
+
+        account_info = context.account_manager.fetch_current_account_info()
+        self.data_store.save_telemetry(account_info.mpan, account_info.consumption)
+
+        tomorrow = date.today() + timedelta(days=1)
+        forecast = self.intraday_projector.forecast_day(account_info, self.tariffs, comparison_engine, tomorrow)
+        self.data_store.save_forecast(account_info.mpan, forecast)
+        self._notify(context, self._format_day_ahead_summary(forecast))
+
+    def _execute_switch(self, context: AccountContext, target_tariff: Tariff, account_info: AccountInfo) -> None:
+        account_manager = context.account_manager
 
         if not target_tariff.product_code:
-            ns.send_notification("ERROR: product_code is missing.")
+            self._notify(context, "ERROR: product_code is missing.")
 
-        enrolment_id = self.account_manager.initiate_tariff_switch(target_tariff.product_code)
+        # Once requested, a switch must be able to finish, so it's bounded by SWITCH_TIMEOUT_MINUTES
+        # rather than by what's left of the run (which would stop at midnight)
+        context.query_service.deadline = self._switch_deadline()
+        enrolment_id = account_manager.initiate_tariff_switch(target_tariff.product_code)
         if not enrolment_id:
-            ns.send_notification("ERROR: Couldn't get enrolment ID")
+            self._notify(context, "ERROR: Couldn't get enrolment ID")
             return
 
-        wait_time = 120
-        ns.send_notification(f"Tariff switch requested successfully. Waiting {wait_time}s before attempting to accept new agreement.")
-
-        # Give octopus some time to generate the agreement
-        time.sleep(wait_time)
-        accepted_version = self.account_manager.accept_new_agreement(target_tariff.product_code, enrolment_id)
-        ns.send_notification(f"Accepted agreement (v.{accepted_version}). Switch successful.")
-
-        verified = self.account_manager.verify_new_agreement_status()
-        if not verified:
-            ns.send_notification("Verification failed, waiting 20 seconds and trying again...")
-            time.sleep(60)
-            verified = self.account_manager.verify_new_agreement_status() # Retry
-            if verified:
-                ns.send_notification("Verified new agreement successfully. Process finished.")
-            else:
-                ns.send_notification(
-                    f"Unable to verify new agreement after retry. "
-                    f"Please check your account and emails.\n"
-                    f"https://octopus.energy/dashboard/new/accounts/{config.ACC_NUMBER}/messages"
-                )
+        self._notify(context, "Tariff switch requested successfully. Waiting for Octopus to generate the new agreement.")
+
+        def on_stage(outcome: SwitchOutcome, seconds: float) -> None:
+            if outcome.stage == SwitchStage.AWAITING_VERIFICATION:
+                self._notify(context, f"Accepted agreement (v.{outcome.accepted_version}) after {seconds:.0f}s. "
+                                      f"Waiting for it to start.")
+
+        # The tracker's own timeout starts now
+        context.query_service.deadline = self._switch_deadline()
+        outcome = SwitchTracker(account_manager, target_tariff.product_code, enrolment_id, on_stage).run()
+        if outcome.verified:
+            self._notify(context, f"Verified new agreement {outcome.total_seconds:.0f}s after requesting the switch. "
+                                  f"Switch successful.")
+        else:
+            self._notify(
+                context,
+                f"Unable to verify new agreement: {outcome.error or 'no agreement starting today'}. "
+                f"Please check your account and emails.\n"
+                f"https://octopus.energy/dashboard/new/accounts/{context.acc_number}/messages"
+            )
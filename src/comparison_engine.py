@@ -1,12 +1,23 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 from tariff import Tariff
 import config
 from datetime import date
 from account_info import AccountInfo
 from query_service import QueryService
+from product_cache import ProductCache
+from data_store import DataStore
+from rate_index import RateIndex, from_epoch, to_epoch
+from vector_costing import VectorCosting
+from structured_logging import log_context, in_current_context
+import metrics
+import vector_costing
 import logging
 logger = logging.getLogger('octobot.comparison_engine')
+# Largest page the Octopus API serves for unit rates
+RATES_PAGE_SIZE = 1500
 @dataclass
 class CostBreakdown:
     """Breakdown of electricity costs."""
@@ -42,6 +53,13 @@ class TariffComparison:
     def total_cost(self) -> Optional[float]:
         return self.cost_breakdown.total_cost if self.cost_breakdown else None
 
+@dataclass
+class TariffRates:
+    """Rates fetched for a tariff, ready to be costed."""
+    tariff: Tariff
+    standing_charge: float
+    rate_index: RateIndex
+
 @dataclass
 class ComparisonResult:
     current_tariff_comparison: TariffComparison
@@ -65,20 +83,59 @@ class ComparisonEngine:
     def __init__(self, query_service: QueryService):
         logger.debug(f"Initialising {__class__.__name__}")
         self.query_service = query_service
-
+        self.product_cache = ProductCache.get_instance()
+        self.data_store = DataStore.get_instance()
+        # Parsed unit rates keyed by their rates URL and day, so each rate list is only indexed once
+        self._rate_indexes: Dict[Tuple[str, date], RateIndex] = {}
+        # One lock per rates URL and day so accounts in the same region sharing this engine fetch each rate list once
+        self._rate_locks: Dict[Tuple[str, date], threading.Lock] = {}
+        self._rate_locks_lock = threading.Lock()
+        # Unit rates fetched for a whole period at once, keyed by (product_code, region_code)
+        self._prefetched_rates: Dict[Tuple[str, str], RateIndex] = {}
+
+    @metrics.span("compare_tariffs")
     def compare_tariffs(self,
                         account_info: AccountInfo,
-                        available_tariffs: List[Tariff]) -> ComparisonResult:
+                        available_tariffs: List[Tariff],
+                        period_date: Optional[date] = None,
+                        cost_current_from_rates: bool = False) -> ComparisonResult:
+        """
+        Compares the consumption of period_date (default today) across tariffs.
+        The current tariff's cost comes from the telemetry's costDeltaWithTax, unless cost_current_from_rates
+        is set (e.g. for a backtest, where the account wasn't really on that tariff) in which case it is
+        costed from its unit rates like the alternatives.
+        """
+        period_date = period_date or date.today()
+
+        vector_costs = self._get_vector_costing(account_info)
+        if not cost_current_from_rates:
+            with metrics.span("costing"):
+                if vector_costs:
+                    curr_costs = self._calculate_current_cost_vectorised(vector_costs, account_info)
+                else:
+                    curr_costs = self._calculate_current_cost(account_info)
+            curr_comparison = TariffComparison(tariff=account_info.current_tariff, cost_breakdown=curr_costs)
 
-        curr_costs = self._calculate_current_cost(account_info)
-        curr_comparison = TariffComparison(tariff=account_info.current_tariff, cost_breakdown=curr_costs)
         #gets a list of tariffs
-        alternative_comparisons = []
-        for tariff in available_tariffs:
-            if tariff == account_info.current_tariff:
-                continue
-            comparison = self._compare_tariff(tariff, account_info)
-            alternative_comparisons.append(comparison)
+        alternative_tariffs = [tariff for tariff in available_tariffs if tariff != account_info.current_tariff]
+        tariffs_to_cost = ([account_info.current_tariff] if cost_current_from_rates else []) + alternative_tariffs
+        if vector_costs:
+            fetched = self.fetch_tariff_rates(account_info, tariffs_to_cost, period_date)
+            with metrics.span("costing"):
+                comparisons = self._cost_tariffs_vectorised(vector_costs, fetched)
+        else:
+            comparisons = self._map_tariffs(
+                lambda tariff, info: self._compare_tariff(tariff, info, period_date),
+                tariffs_to_cost, account_info
+            )
+
+        if cost_current_from_rates:
+            curr_comparison = comparisons[0]
+            alternative_comparisons = comparisons[1:]
+            if not curr_comparison.is_valid:
+                raise ValueError(f"Couldn't cost current tariff {curr_comparison.tariff.display_name}: {curr_comparison.error}")
+        else:
+            alternative_comparisons = comparisons
 
         logger.debug(f"Tariff comparison results - {alternative_comparisons}")
         cheapest_tariff, potential_savings = self._find_best_option(
@@ -93,6 +150,20 @@ class ComparisonEngine:
             potential_savings=potential_savings
         )
 
+    def fetch_tariff_rates(self,
+                           account_info: AccountInfo,
+                           tariffs: List[Tariff],
+                           period_date: date) -> List[Union[TariffComparison, TariffRates]]:
+        """
+        Fetches every tariff's rates for period_date without costing them, for callers that cost
+        consumption themselves. A tariff whose rates couldn't be fetched is returned as a TariffComparison
+        recording the error.
+        """
+        return self._map_tariffs(
+            lambda tariff, info: self._fetch_tariff_rates(tariff, info, period_date),
+            tariffs, account_info
+        )
+
     def _find_best_option(self,
                           current: TariffComparison,
                           alternatives: List[TariffComparison]
@@ -118,23 +189,58 @@ class ComparisonEngine:
 
         return cheapest.tariff, savings
 
-    def _compare_tariff(self, tariff: Tariff, account_info: AccountInfo) -> TariffComparison:
+    def _map_tariffs(self,
+                     func: Callable[[Tariff, AccountInfo], Union[TariffComparison, TariffRates]],
+                     tariffs: List[Tariff],
+                     account_info: AccountInfo) -> List[Union[TariffComparison, TariffRates]]:
         """
-        Compare tariff against today's usage
+        Runs func for every tariff, concurrently when COMPARISON_WORKERS > 1.
+        Results keep the order of tariffs so the summary stays deterministic.
         """
-        standing_charge, unit_rates, product_code = self._get_potential_tariff_rates(
+        workers = min(config.COMPARISON_WORKERS, len(tariffs))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Comparison") as executor:
+                return list(executor.map(in_current_context(lambda tariff: self._safe_call(func, tariff, account_info)), tariffs))
+        return [self._safe_call(func, tariff, account_info) for tariff in tariffs]
+
+    def _safe_call(self,
+                   func: Callable[[Tariff, AccountInfo], Union[TariffComparison, TariffRates]],
+                   tariff: Tariff,
+                   account_info: AccountInfo) -> Union[TariffComparison, TariffRates]:
+        """Call func, recording any failure on the tariff's TariffComparison so one tariff can't sink the others."""
+        try:
+            with log_context(tariff=tariff.id):
+                return func(tariff, account_info)
+        except Exception as e:
+            logger.warning(f"Comparison failed for {tariff.display_name}: {type(e).__name__} - {e}")
+            return TariffComparison(tariff=tariff, cost_breakdown=None, error=str(e))
+
+    @metrics.span("fetch_rates")
+    def _fetch_tariff_rates(self, tariff: Tariff, account_info: AccountInfo, period_date: date) -> TariffRates:
+        standing_charge, rate_index, product_code = self._get_potential_tariff_rates(
             tariff,
-            account_info.region_code
+            account_info.region_code,
+            period_date
         )
 
         # Store product code for potential switching
         tariff.product_code = product_code
 
+        return TariffRates(tariff=tariff, standing_charge=standing_charge, rate_index=rate_index)
+
+    def _compare_tariff(self, tariff: Tariff, account_info: AccountInfo, period_date: date) -> TariffComparison:
+        """
+        Compare tariff against the usage of period_date
+        """
+        tariff_rates = self._fetch_tariff_rates(tariff, account_info, period_date)
+        standing_charge = tariff_rates.standing_charge
+
         # Calculate costs based on consumption
-        period_costs = self._calculate_potential_costs(
-            account_info.consumption,
-            unit_rates
-        )
+        with metrics.span("costing"):
+            period_costs = self._calculate_potential_costs(
+                account_info.consumption,
+                tariff_rates.rate_index
+            )
 
         # Sum up costs
         consumption_cost = sum(period['calculated_cost'] for period in period_costs)
@@ -156,6 +262,60 @@ class ComparisonEngine:
 
         return TariffComparison(tariff=tariff, cost_breakdown=cost_breakdown)
 
+    def _get_vector_costing(self, account_info: AccountInfo) -> Optional[VectorCosting]:
+        if config.COSTING_ENGINE != "numpy":
+            return None
+        if not vector_costing.is_available():
+            logger.warning("COSTING_ENGINE is numpy but numpy isn't installed, falling back to the python engine")
+            return None
+        return VectorCosting(account_info.consumption)
+
+    def _calculate_current_cost_vectorised(self, vector_costs: VectorCosting, account_info: AccountInfo) -> CostBreakdown:
+        total_con_cost = vector_costs.current_consumption_cost()
+
+        if vector_costs.total_kwh == 0:
+            raise ValueError("No consumption data found. Is your home mini okay?")
+
+        return CostBreakdown(
+                consumption_cost=total_con_cost,
+                standing_charge=account_info.standing_charge,
+                total_cost=total_con_cost + account_info.standing_charge,
+                total_kwh=vector_costs.total_kwh
+            )
+
+    def _cost_tariffs_vectorised(self,
+                                 vector_costs: VectorCosting,
+                                 fetched: List[Union[TariffComparison, TariffRates]]) -> List[TariffComparison]:
+        """Cost every tariff whose rates were fetched in one batched operation, keeping failures in place."""
+        comparisons: List[Optional[TariffComparison]] = []
+        costable: List[Tuple[int, TariffRates]] = []
+        aligned_rates = []
+        for position, item in enumerate(fetched):
+            if isinstance(item, TariffComparison):
+                comparisons.append(item)
+                continue
+            try:
+                aligned_rates.append(vector_costs.align_rates(item.rate_index))
+            except ValueError as e:
+                logger.warning(f"Comparison failed for {item.tariff.display_name}: {type(e).__name__} - {e}")
+                comparisons.append(TariffComparison(tariff=item.tariff, cost_breakdown=None, error=str(e)))
+                continue
+            comparisons.append(None)
+            costable.append((position, item))
+
+        _, totals = vector_costs.cost_tariffs(aligned_rates)
+        for (position, item), consumption_cost in zip(costable, totals):
+            comparisons[position] = TariffComparison(
+                tariff=item.tariff,
+                cost_breakdown=CostBreakdown(
+                    consumption_cost=consumption_cost,
+                    standing_charge=item.standing_charge,
+                    total_cost=consumption_cost + item.standing_charge,
+                    total_kwh=vector_costs.total_kwh
+                )
+            )
+
+        return comparisons
 
     def _calculate_current_cost(self, account_info:AccountInfo) -> CostBreakdown:
         total_con_cost = sum(float(entry['costDeltaWithTax'] or 0) for entry in account_info.consumption)
@@ -176,58 +336,58 @@ class ComparisonEngine:
 
     def _calculate_potential_costs(self,
                                    consumption_data: List[dict],
-                                   rate_data: List[dict]) -> List[dict]:
+                                   rate_index: RateIndex) -> List[dict]:
 
         period_costs = []
         for consumption in consumption_data:
             read_time = consumption['readAt'].replace('+00:00', 'Z')
-            matching_rate = next(
-                rate for rate in rate_data
-                # Flexible has no end time, so default to the end of time
-                if rate['valid_from'] <= read_time <= (rate.get('valid_to') or "9999-12-31T23:59:59Z")
-                # DIRECT_DEBIT is for flexible that has different price for direct debit or not
-                and rate['payment_method'] in [None, "DIRECT_DEBIT"]
-            )
+            rate = rate_index.rate_at(to_epoch(read_time))
+            if rate is None:
+                raise ValueError(f"No unit rate found covering {read_time}")
 
             consumption_kwh = float(consumption['consumptionDelta']) / 1000
-            cost = float("{:.4f}".format(consumption_kwh * matching_rate['value_inc_vat']))
+            cost = float("{:.4f}".format(consumption_kwh * rate))
 
             period_costs.append({
                 'period_end': read_time,
                 'consumption_kwh': consumption_kwh,
-                'rate': matching_rate['value_inc_vat'],
+                'rate': rate,
                 'calculated_cost': cost,
             })
 
         return period_costs
 
-    def _get_potential_tariff_rates(self, tariff: Tariff, region_code: str) -> Tuple[float, list[dict], str]:
+    def _get_potential_tariff_rates(self, tariff: Tariff, region_code: str, period_date: date) -> Tuple[float, RateIndex, str]:
         """
-        Get rates for a specific tariff and region
+        Get rates for a specific tariff and region on period_date
         """
-
-        all_products = self.query_service.execute_rest_query(f"{config.BASE_URL}/products/?brand=OCTOPUS_ENERGY&is_business=false")
-        product = next((
-            product for product in all_products['results']
-            if product['display_name'] == tariff.api_display_name
-            and product['direction'] == "IMPORT"
-        ), None)
-
-        if not product:
-            raise ValueError(f"No matching tariff found for {tariff.api_display_name}")
-
-        product_code = product.get('code')
-        if product_code is None:
-            raise ValueError(f"No product code found for {tariff.api_display_name}")
-
-        product_link = next((
-            item.get('href') for item in product.get('links', [])
-            if item.get('rel', '').lower() == 'self'
-        ), None)
-        if not product_link:
-            raise ValueError(f"Self link not found for tariff {product_code}.")
-
-        tariff_details = self.query_service.execute_rest_query(product_link)
+        standing_charge_inc_vat, unit_rates_link, product_code = self._get_tariff_product(tariff, region_code)
+
+        period_from = f"{period_date}T00:00:00Z"
+        period_to = f"{period_date}T23:59:59Z"
+        rates_key = (unit_rates_link, period_date)
+        with self._rate_locks_lock:
+            rate_lock = self._rate_locks.setdefault(rates_key, threading.Lock())
+
+        with rate_lock:
+            source = "memory"
+            rate_index = self._rate_indexes.get(rates_key)
+            if rate_index is None:
+                source = "prefetched"
+                rate_index = self._get_prefetched_rates(product_code, region_code, period_from, period_to)
+            if rate_index is None:
+                rate_index, source = self._load_unit_rates(unit_rates_link, product_code, region_code, period_from, period_to)
+            self._rate_indexes[rates_key] = rate_index
+        metrics.cache_lookups.inc(cache="unit_rates", result=source)
+
+        return standing_charge_inc_vat, rate_index, product_code
+
+    def _get_tariff_product(self, tariff: Tariff, region_code: str) -> Tuple[float, str, str]:
+        """
+        Find a tariff's product, returning its standing charge for the region,
+        its standard unit rates link and its product code
+        """
+        product_code, tariff_details = self._get_product_details(tariff)
 
         # Get the standing charge including VAT
         region_code_key = f'_{region_code}'
@@ -252,9 +412,127 @@ class ComparisonEngine:
         if not unit_rates_link:
             raise ValueError(f"Standard unit rates link not found for region: {region_code_key}")
 
-        # Get today's rates
-        today = date.today()
-        unit_rates_link_with_time = f"{unit_rates_link}?period_from={today}T00:00:00Z&period_to={today}T23:59:59Z"
-        unit_rates = self.query_service.execute_rest_query(unit_rates_link_with_time)
+        return standing_charge_inc_vat, unit_rates_link, product_code
+
+    def _get_product_details(self, tariff: Tariff) -> Tuple[str, dict]:
+        """Find a tariff's product in the catalogue, returning its product code and product details"""
+        all_products = self.product_cache.get_catalogue(self.query_service)
+        product = next((
+            product for product in all_products['results']
+            if product['display_name'] == tariff.api_display_name
+            and product['direction'] == "IMPORT"
+        ), None)
+
+        if not product:
+            raise ValueError(f"No matching tariff found for {tariff.api_display_name}")
+
+        product_code = product.get('code')
+        if product_code is None:
+            raise ValueError(f"No product code found for {tariff.api_display_name}")
+
+        product_link = next((
+            item.get('href') for item in product.get('links', [])
+            if item.get('rel', '').lower() == 'self'
+        ), None)
+        if not product_link:
+            raise ValueError(f"Self link not found for tariff {product_code}.")
+
+        return product_code, self.product_cache.get(self.query_service, product_link)
 
-        return standing_charge_inc_vat, unit_rates.get('results', []), product_code
+    def _load_unit_rates(self, unit_rates_link: str, product_code: str, region_code: str,
+                         period_from: str, period_to: str, page_size: Optional[int] = None) -> Tuple[RateIndex, str]:
+        """
+        Returns the rates for the period and where they came from. Stored rates are used as far as they
+        cover it, and only the rest is fetched from the API (following its pagination) and stored.
+        """
+        stored_rates, covered_until = self._get_stored_rates(product_code, region_code, period_from, period_to)
+        if covered_until >= to_epoch(period_to):
+            logger.debug(f"Using stored unit rates for {product_code} region {region_code}")
+            return RateIndex(stored_rates), "stored"
+
+        fetch_from = from_epoch(covered_until) if stored_rates else period_from
+        url = f"{unit_rates_link}?period_from={fetch_from}&period_to={period_to}"
+        if page_size:
+            url += f"&page_size={page_size}"
+        unit_rates = []
+        while url:
+            page = self.query_service.execute_rest_query(url)
+            unit_rates.extend(page.get('results', []))
+            url = page.get('next')
+        if self.data_store:
+            self.data_store.save_unit_rates(product_code, region_code, unit_rates)
+        if not stored_rates:
+            return RateIndex(unit_rates), "api"
+        logger.debug(f"Using stored unit rates for {product_code} region {region_code} up to {fetch_from}, fetched the rest")
+        return RateIndex(stored_rates + unit_rates), "stored_and_api"
+
+    def _get_stored_rates(self, product_code: str, region_code: str, period_from: str, period_to: str) -> Tuple[List[dict], float]:
+        """
+        Returns the stored rates that cover the period from its start without a gap, and the epoch they run to.
+        Tomorrow's Agile rates are published up to 23:00 UK time, so those stored the day before cover all
+        but the end of the UTC day, and only that needs fetching. An open-ended rate (e.g. Flexible's) only
+        counts if it was fetched during the period, as it may have been superseded since.
+        """
+        if not self.data_store:
+            return [], to_epoch(period_from)
+        unit_rates = self.data_store.get_unit_rates(product_code, region_code, period_from, period_to)
+        fetched_at = self.data_store.unit_rates_fetched_at(product_code, region_code)
+        fetched_during_period = fetched_at is not None and to_epoch(fetched_at) >= to_epoch(period_from)
+        covered_until = RateIndex(unit_rates).covered_until(to_epoch(period_from), allow_open_ended=fetched_during_period)
+        # Anything after a gap is fetched again along with it
+        return [rate for rate in unit_rates if to_epoch(rate['valid_from']) < covered_until], covered_until
+
+    def start_run(self, query_service: QueryService) -> None:
+        """
+        Carries a long-lived engine's caches over into another run, using that run's query service (and
+        so its deadline). The rates of days before today are dropped, as no run asks for them again.
+        """
+        self.query_service = query_service
+        today = date.today()
+        with self._rate_locks_lock:
+            for key in [key for key in self._rate_indexes if key[1] < today]:
+                del self._rate_indexes[key]
+            for key in [key for key in self._rate_locks if key[1] < today]:
+                del self._rate_locks[key]
+
+    def _get_prefetched_rates(self, product_code: str, region_code: str, period_from: str, period_to: str) -> Optional[RateIndex]:
+        rate_index = self._prefetched_rates.get((product_code, region_code))
+        # These were fetched for this period, so an open-ended rate is still current
+        if rate_index is None or not rate_index.covers(to_epoch(period_from), to_epoch(period_to), allow_open_ended=True):
+            return None
+        return rate_index
+
+    def prefetch_unit_rates(self, tariffs: List[Tariff], region_code: str, start: date, end: date) -> None:
+        """
+        Fetches the unit rates of every tariff from the start of start to the end of end, following the
+        API's pagination, so comparisons for any day in between need no further rate requests.
+        Replaces whatever was prefetched before, so only one period is held in memory.
+        """
+        period_from = f"{start}T00:00:00Z"
+        period_to = f"{end}T23:59:59Z"
+        # Cleared in place, as other threads sharing this engine may be using the dicts. The per-URL locks
+        # are kept, so a URL can never end up with two locks and be fetched twice at once.
+        with self._rate_locks_lock:
+            self._prefetched_rates.clear()
+            self._rate_indexes.clear()
+        for tariff in tariffs:
+            _, unit_rates_link, product_code = self._get_tariff_product(tariff, region_code)
+            tariff.product_code = product_code
+
+            rate_index, _ = self._load_unit_rates(unit_rates_link, product_code, region_code,
+                                                  period_from, period_to, page_size=RATES_PAGE_SIZE)
+            self._prefetched_rates[(product_code, region_code)] = rate_index
+
+    def warm_caches(self, tariffs: List[Tariff], region_codes: Set[str]) -> None:
+        """
+        Fetches the product catalogue and every tariff's product details, plus today's unit rates
+        for each known region, so the comparison that follows finds them cached (or stored).
+        """
+        for tariff in tariffs:
+            try:
+                self._get_product_details(tariff)
+                for region_code in region_codes:
+                    self._get_potential_tariff_rates(tariff, region_code, date.today())
+            except Exception as e:
+                logger.warning(f"Couldn't warm caches for {tariff.display_name}: {type(e).__name__} - {e}")
+        logger.info(f"Warmed caches for {len(tariffs)} tariffs, product cache stats - {self.product_cache.stats}")
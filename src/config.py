@@ -7,17 +7,81 @@ BOT_VERSION = "v.local"
 API_KEY = os.getenv("API_KEY", "")
 # Your Octopus Energy account number. Starts with A-
 ACC_NUMBER = os.getenv("ACC_NUMBER", "")
+# Optional comma-separated list of ACC_NUMBER:API_KEY pairs to manage several accounts. Overrides ACC_NUMBER and API_KEY.
+ACCOUNTS = os.getenv("ACCOUNTS", "")
+# How many accounts are compared at the same time when ACCOUNTS lists several
+ACCOUNT_WORKERS = int(os.getenv("ACCOUNT_WORKERS", 4))
 BASE_URL = os.getenv("BASE_URL", "https://api.octopus.energy/v1")
 # Comma-separated list of Apprise notification URLs
 NOTIFICATION_URLS = os.getenv("NOTIFICATION_URLS", "")
 # Whether to send all the notifications as a batch or individually
 BATCH_NOTIFICATIONS = os.getenv("BATCH_NOTIFICATIONS", "false") in ["true", "True", "1"]
+# Notifications are sent in the background: how many can wait per notification URL (the oldest are dropped
+# beyond that) and how many times sending one is tried before giving up
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", 100))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", 5))
 
 EXECUTION_TIME = os.getenv("EXECUTION_TIME", "23:00")
+# How many minutes before EXECUTION_TIME to prefetch product details and today's rates
+CACHE_WARM_UP_MINUTES = int(os.getenv("CACHE_WARM_UP_MINUTES", 30))
+
+# Optional comma-separated HH:MM times to project today's cost from the consumption so far (needs DATA_STORE_PATH)
+INTRADAY_TIMES = os.getenv("INTRADAY_TIMES", "")
+# How many weeks of the same weekday's stored telemetry the forecast of the rest of the day averages
+INTRADAY_HISTORY_WEEKS = int(os.getenv("INTRADAY_HISTORY_WEEKS", 4))
+# Intraday runs at or after this time (HH:MM) can switch tariff, earlier ones only report
+INTRADAY_SWITCH_AFTER = os.getenv("INTRADAY_SWITCH_AFTER", "22:00")
+# Optional HH:MM time to fetch tomorrow's rates (Agile's are published in the afternoon) and forecast tomorrow's cost
+DAY_AHEAD_TIME = os.getenv("DAY_AHEAD_TIME", "")
 
 # A threshold (in pence) over which the difference between the tariffs must be before the switch happens.
 SWITCH_THRESHOLD = int(os.getenv("SWITCH_THRESHOLD", 2))
 
+# Maximum number of keep-alive connections kept open to the Octopus API
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+
+# Retries of failed API requests: exponential backoff with jitter from the base delay, capped at the max delay
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 4))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", 2))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", 60))
+
+# After this many consecutive failures an API endpoint isn't called again for CIRCUIT_RESET_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SECONDS = int(os.getenv("CIRCUIT_RESET_SECONDS", 120))
+
+# How long (in minutes) to keep polling a switch for its new agreement to be accepted and verified
+SWITCH_TIMEOUT_MINUTES = int(os.getenv("SWITCH_TIMEOUT_MINUTES", 15))
+
+# The longest (in minutes) a comparison run may spend on API requests, it also always stops at midnight
+RUN_TIMEOUT_MINUTES = int(os.getenv("RUN_TIMEOUT_MINUTES", 45))
+
+# Renew the Kraken token this many seconds before it expires, rather than waiting for a request to be rejected
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", 300))
+
+# How long (in seconds) the product catalogue and product details are cached before being revalidated
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 86400))
+
+# How many tariffs to fetch rates for at the same time. 1 compares them one after another.
+COMPARISON_WORKERS = int(os.getenv("COMPARISON_WORKERS", 1))
+
+# Which engine calculates the costs: "python", or "numpy" to cost every tariff in one vectorised batch (needs numpy installed)
+COSTING_ENGINE = os.getenv("COSTING_ENGINE", "python").lower()
+
+# SQLite database storing telemetry, unit rates and comparison history. Set it empty to disable storage.
+DATA_STORE_PATH = os.getenv("DATA_STORE_PATH", "logs/octobot.db")
+# The tariff the dashboard's realised savings are measured against, i.e. what you'd have paid without switching
+SAVINGS_BASELINE_TARIFF = os.getenv("SAVINGS_BASELINE_TARIFF", "flexible")
+
+# How far back (in minutes) from the latest reading to re-request telemetry, to pick up late corrections
+TELEMETRY_OVERLAP_MINUTES = int(os.getenv("TELEMETRY_OVERLAP_MINUTES", 60))
+
+# Days of telemetry and unit rates fetched per request when backtesting (see backtest.py)
+BACKTEST_CHUNK_DAYS = int(os.getenv("BACKTEST_CHUNK_DAYS", 7))
+
+# Also write logs as JSON lines (logs/octobot.jsonl) with the run ID, account, tariff and API latency,
+# indexed by time, level and run so the dashboard can fetch a single run's entries
+STRUCTURED_LOGS = os.getenv("STRUCTURED_LOGS", "false") in ["true", "True", "1"]
+
 # List of tariff IDs to compare
 TARIFFS = os.getenv("TARIFFS", "go,agile,flexible")
 
@@ -32,3 +96,8 @@ DRY_RUN = os.getenv("DRY_RUN", "false") in ["true", "True", "1"]
 WEB_USERNAME = os.getenv("WEB_USERNAME", "admin")
 WEB_PASSWORD = os.getenv("WEB_PASSWORD", "admin")
 WEB_PORT = int(os.getenv("WEB_PORT", 5050))
+# Which server runs the dashboard: "waitress", or "flask" for Flask's development server
+WEB_SERVER = os.getenv("WEB_SERVER", "waitress").lower()
+# Requests the dashboard handles at the same time (waitress only), and the most connections it keeps open
+WEB_THREADS = int(os.getenv("WEB_THREADS", 8))
+WEB_CONNECTION_LIMIT = int(os.getenv("WEB_CONNECTION_LIMIT", 100))
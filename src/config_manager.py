@@ -3,6 +3,13 @@ import re
 import config
 
 _config_lock = threading.Lock()
+# Callbacks run after every config update, e.g. so the scheduler can recompute its deadlines
+_change_listeners = []
+
+
+def add_change_listener(callback):
+    """Register a callback to run after the config is updated"""
+    _change_listeners.append(callback)
 
 def get_config():
     """Get current configuration as dictionary (thread-safe)"""
@@ -59,6 +66,8 @@ def update_config(new_values):
         if config.ONE_OFF_RUN and not previous_one_off:
             config.ONE_OFF_EXECUTED = False
 
+    for listener in _change_listeners:
+        listener()
 
 
 def validate_config(config_dict):
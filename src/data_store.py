@@ -0,0 +1,493 @@
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+import logging
+
+import config
+
+logger = logging.getLogger('octobot.data_store')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS telemetry (
+    mpan TEXT NOT NULL,
+    read_at TEXT NOT NULL,
+    consumption_delta REAL NOT NULL,
+    cost_delta_with_tax REAL,
+    PRIMARY KEY (mpan, read_at)
+);
+
+CREATE TABLE IF NOT EXISTS unit_rates (
+    product_code TEXT NOT NULL,
+    region TEXT NOT NULL,
+    valid_from TEXT NOT NULL,
+    valid_to TEXT,
+    value_inc_vat REAL NOT NULL,
+    payment_method TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (product_code, region, valid_from, payment_method)
+);
+
+-- When each product's rates were last fetched, since an open-ended rate is only known to be current as of then
+CREATE TABLE IF NOT EXISTS unit_rate_fetches (
+    product_code TEXT NOT NULL,
+    region TEXT NOT NULL,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (product_code, region)
+);
+
+CREATE TABLE IF NOT EXISTS comparison_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_at TEXT NOT NULL,
+    mpan TEXT,
+    current_tariff TEXT NOT NULL,
+    cheapest_tariff TEXT,
+    potential_savings REAL NOT NULL,
+    should_switch INTEGER NOT NULL,
+    dry_run INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS comparison_results (
+    run_id INTEGER NOT NULL REFERENCES comparison_runs(run_id),
+    tariff_id TEXT NOT NULL,
+    is_current INTEGER NOT NULL,
+    consumption_cost REAL,
+    standing_charge REAL,
+    total_cost REAL,
+    total_kwh REAL,
+    error TEXT,
+    PRIMARY KEY (run_id, tariff_id)
+);
+
+-- Rollups for the savings dashboard, updated at the end of each comparison run rather than
+-- recomputed from comparison_results on every page view. The latest run of a day replaces the earlier ones.
+CREATE TABLE IF NOT EXISTS daily_costs (
+    mpan TEXT NOT NULL,
+    day TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    is_current INTEGER NOT NULL,
+    total_cost REAL NOT NULL,
+    total_kwh REAL NOT NULL,
+    run_id INTEGER NOT NULL,
+    PRIMARY KEY (mpan, day, tariff_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_savings (
+    mpan TEXT NOT NULL,
+    day TEXT NOT NULL,
+    current_tariff TEXT NOT NULL,
+    actual_cost REAL NOT NULL,
+    cheapest_cost REAL NOT NULL,
+    baseline_tariff TEXT,
+    baseline_cost REAL,
+    run_id INTEGER NOT NULL,
+    PRIMARY KEY (mpan, day)
+);
+
+CREATE TABLE IF NOT EXISTS cost_rollups (
+    mpan TEXT NOT NULL,
+    granularity TEXT NOT NULL,
+    period_start TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    total_cost REAL NOT NULL,
+    total_kwh REAL NOT NULL,
+    days INTEGER NOT NULL,
+    PRIMARY KEY (mpan, granularity, period_start, tariff_id)
+);
+
+CREATE TABLE IF NOT EXISTS savings_rollups (
+    mpan TEXT NOT NULL,
+    granularity TEXT NOT NULL,
+    period_start TEXT NOT NULL,
+    days INTEGER NOT NULL,
+    actual_cost REAL NOT NULL,
+    cheapest_cost REAL NOT NULL,
+    baseline_cost REAL,
+    baseline_days INTEGER NOT NULL,
+    realised_savings REAL,
+    missed_savings REAL NOT NULL,
+    PRIMARY KEY (mpan, granularity, period_start)
+);
+
+-- Settings the rollups were built with, e.g. the baseline tariff, so they can be rebuilt when one changes
+CREATE TABLE IF NOT EXISTS rollup_settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS day_ahead_forecasts (
+    mpan TEXT NOT NULL,
+    day TEXT NOT NULL,
+    tariff_id TEXT NOT NULL,
+    is_current INTEGER NOT NULL,
+    is_cheapest INTEGER NOT NULL,
+    projected_cost REAL,
+    low_cost REAL,
+    high_cost REAL,
+    error TEXT,
+    history_days INTEGER NOT NULL,
+    slots_covered INTEGER NOT NULL,
+    forecast_at TEXT NOT NULL,
+    PRIMARY KEY (mpan, day, tariff_id)
+);
+"""
+
+GRANULARITIES = ("day", "week", "month")
+
+
+def normalise_timestamp(timestamp: str) -> str:
+    """Converts an API timestamp to a UTC 'YYYY-MM-DDTHH:MM:SSZ' string, which sorts chronologically as text."""
+    parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def rollup_periods(day: date) -> List[Tuple[str, date, date]]:
+    """The (granularity, start, end) of the day, week (from Monday) and month a day falls in, end exclusive."""
+    week_start = day - timedelta(days=day.weekday())
+    month_start = day.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    return [
+        ("day", day, day + timedelta(days=1)),
+        ("week", week_start, week_start + timedelta(days=7)),
+        ("month", month_start, next_month),
+    ]
+
+
+class DataStore:
+    """
+    Embedded SQLite store (WAL mode, so the dashboard can read while the bot writes) for
+    half-hourly telemetry, unit rates and the result of every comparison run, rolled up by day, week and month.
+    """
+    _instance: Optional['DataStore'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        logger.debug(f"Initialising {__class__.__name__} at {path}")
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+            self._backfill_rollups()
+            # SAVINGS_BASELINE_TARIFF is only read at startup, so this keeps get_savings read-only
+            self._ensure_baseline()
+
+    @classmethod
+    def get_instance(cls) -> Optional['DataStore']:
+        """Gets the shared DataStore, or None if DATA_STORE_PATH is empty (storage disabled)."""
+        if not config.DATA_STORE_PATH:
+            return None
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(config.DATA_STORE_PATH)
+            return cls._instance
+
+    def save_telemetry(self, mpan: str, consumption_data: List[dict]) -> None:
+        """Upserts smartMeterTelemetry readings, so a corrected reading replaces the stored one."""
+        rows = [
+            (mpan, normalise_timestamp(entry['readAt']), float(entry['consumptionDelta']),
+             float(entry['costDeltaWithTax']) if entry.get('costDeltaWithTax') is not None else None)
+            for entry in consumption_data
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO telemetry (mpan, read_at, consumption_delta, cost_delta_with_tax) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+        logger.debug(f"Stored {len(rows)} telemetry readings for {mpan}")
+
+    def get_telemetry(self, mpan: str, start: str, end: str) -> List[dict]:
+        """Returns stored readings between start and end (inclusive) in the smartMeterTelemetry shape."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT read_at, consumption_delta, cost_delta_with_tax FROM telemetry "
+                "WHERE mpan = ? AND read_at >= ? AND read_at <= ? ORDER BY read_at",
+                (mpan, normalise_timestamp(start), normalise_timestamp(end))
+            ).fetchall()
+        return [
+            {'readAt': row['read_at'], 'consumptionDelta': row['consumption_delta'], 'costDeltaWithTax': row['cost_delta_with_tax']}
+            for row in rows
+        ]
+
+    def latest_read_at(self, mpan: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(read_at) AS latest FROM telemetry WHERE mpan = ?", (mpan,)
+            ).fetchone()
+        return row['latest'] if row else None
+
+    def save_unit_rates(self, product_code: str, region: str, rates: List[dict]) -> None:
+        rows = [
+            (product_code, region, normalise_timestamp(rate['valid_from']),
+             normalise_timestamp(rate['valid_to']) if rate.get('valid_to') else None,
+             rate['value_inc_vat'], rate.get('payment_method') or '')
+            for rate in rates
+        ]
+        fetched_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO unit_rates (product_code, region, valid_from, valid_to, value_inc_vat, payment_method) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO unit_rate_fetches (product_code, region, fetched_at) VALUES (?, ?, ?)",
+                (product_code, region, fetched_at)
+            )
+        logger.debug(f"Stored {len(rows)} unit rates for {product_code} region {region}")
+
+    def unit_rates_fetched_at(self, product_code: str, region: str) -> Optional[str]:
+        """When the product's rates for the region were last fetched, or None if they never have been."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT fetched_at FROM unit_rate_fetches WHERE product_code = ? AND region = ?", (product_code, region)
+            ).fetchone()
+        return row['fetched_at'] if row else None
+
+    def get_unit_rates(self, product_code: str, region: str, period_from: str, period_to: str) -> List[dict]:
+        """Returns stored rates overlapping the period, in the API's unit rate shape (newest first)."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT valid_from, valid_to, value_inc_vat, payment_method FROM unit_rates "
+                "WHERE product_code = ? AND region = ? AND valid_from <= ? AND (valid_to IS NULL OR valid_to >= ?) "
+                "ORDER BY valid_from DESC",
+                (product_code, region, normalise_timestamp(period_to), normalise_timestamp(period_from))
+            ).fetchall()
+        return [
+            {'valid_from': row['valid_from'], 'valid_to': row['valid_to'],
+             'value_inc_vat': row['value_inc_vat'], 'payment_method': row['payment_method'] or None}
+            for row in rows
+        ]
+
+    def save_comparison(self, result, mpan: Optional[str], day: Optional[date] = None) -> int:
+        """
+        Stores a ComparisonResult and the cost of every tariff in it, and updates the rollups of the day
+        (default today) it compared. Returns the run ID.
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO comparison_runs (run_at, mpan, current_tariff, cheapest_tariff, potential_savings, should_switch, dry_run) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), mpan,
+                 result.current_tariff_comparison.tariff.id,
+                 result.cheapest_tariff.id if result.cheapest_tariff else None,
+                 result.potential_savings, int(result.should_switch), int(config.DRY_RUN))
+            )
+            run_id = cursor.lastrowid
+            self._connection.executemany(
+                "INSERT INTO comparison_results (run_id, tariff_id, is_current, consumption_cost, standing_charge, total_cost, total_kwh, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id, comparison.tariff.id, int(comparison is result.current_tariff_comparison),
+                     comparison.cost_breakdown.consumption_cost if comparison.cost_breakdown else None,
+                     comparison.cost_breakdown.standing_charge if comparison.cost_breakdown else None,
+                     comparison.cost_breakdown.total_cost if comparison.cost_breakdown else None,
+                     comparison.cost_breakdown.total_kwh if comparison.cost_breakdown else None,
+                     comparison.error)
+                    for comparison in result.all_comparisons
+                ]
+            )
+            self._roll_up_run(run_id, mpan, day or date.today())
+        logger.debug(f"Stored comparison run {run_id}")
+        return run_id
+
+    def _roll_up_run(self, run_id: int, mpan: Optional[str], day: date) -> None:
+        """
+        Makes a run the day's figures and re-aggregates only the day, week and month it falls in.
+        Must be called holding self._lock, inside a transaction.
+        """
+        self._ensure_baseline()
+        mpan = mpan or ''
+        results = self._connection.execute(
+            "SELECT tariff_id, is_current, total_cost, total_kwh FROM comparison_results "
+            "WHERE run_id = ? AND total_cost IS NOT NULL", (run_id,)
+        ).fetchall()
+        current = next((row for row in results if row['is_current']), None)
+        if current is None:
+            logger.debug(f"Comparison run {run_id} has no cost for the current tariff, not rolled up")
+            return
+
+        day_key = day.isoformat()
+        baseline = next((row for row in results if row['tariff_id'] == config.SAVINGS_BASELINE_TARIFF), None)
+        self._connection.execute("DELETE FROM daily_costs WHERE mpan = ? AND day = ?", (mpan, day_key))
+        self._connection.executemany(
+            "INSERT INTO daily_costs (mpan, day, tariff_id, is_current, total_cost, total_kwh, run_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(mpan, day_key, row['tariff_id'], row['is_current'], row['total_cost'], row['total_kwh'], run_id) for row in results]
+        )
+        self._connection.execute(
+            "INSERT OR REPLACE INTO daily_savings (mpan, day, current_tariff, actual_cost, cheapest_cost, baseline_tariff, baseline_cost, run_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (mpan, day_key, current['tariff_id'], current['total_cost'], min(row['total_cost'] for row in results),
+             baseline['tariff_id'] if baseline else None, baseline['total_cost'] if baseline else None, run_id)
+        )
+
+        for granularity, start, end in rollup_periods(day):
+            self._aggregate_period(mpan, granularity, start, end)
+
+    def _aggregate_period(self, mpan: str, granularity: str, start: date, end: date, costs: bool = True) -> None:
+        """Rebuilds one period's rollups from the daily figures. Must be called holding self._lock, inside a transaction."""
+        period = (mpan, granularity, start.isoformat())
+        days = (mpan, start.isoformat(), end.isoformat())
+        if costs:
+            self._connection.execute(
+                "DELETE FROM cost_rollups WHERE mpan = ? AND granularity = ? AND period_start = ?", period
+            )
+            self._connection.execute(
+                "INSERT INTO cost_rollups (mpan, granularity, period_start, tariff_id, total_cost, total_kwh, days) "
+                "SELECT ?, ?, ?, tariff_id, SUM(total_cost), SUM(total_kwh), COUNT(*) FROM daily_costs "
+                "WHERE mpan = ? AND day >= ? AND day < ? GROUP BY tariff_id",
+                period + days
+            )
+        # Realised savings only count the days the baseline tariff was compared
+        self._connection.execute(
+            "INSERT OR REPLACE INTO savings_rollups (mpan, granularity, period_start, days, actual_cost, cheapest_cost, "
+            "baseline_cost, baseline_days, realised_savings, missed_savings) "
+            "SELECT ?, ?, ?, COUNT(*), SUM(actual_cost), SUM(cheapest_cost), SUM(baseline_cost), COUNT(baseline_cost), "
+            "SUM(baseline_cost - actual_cost), SUM(actual_cost - cheapest_cost) FROM daily_savings "
+            "WHERE mpan = ? AND day >= ? AND day < ?",
+            period + days
+        )
+
+    def _ensure_baseline(self) -> None:
+        """
+        Re-rolls every day's baseline cost, and the savings rollups, if SAVINGS_BASELINE_TARIFF has changed since
+        they were built, so no period mixes two baselines. Must be called holding self._lock, inside a transaction.
+        """
+        baseline_tariff = config.SAVINGS_BASELINE_TARIFF
+        row = self._connection.execute("SELECT value FROM rollup_settings WHERE name = 'baseline_tariff'").fetchone()
+        if row is not None and row['value'] == baseline_tariff:
+            return
+
+        self._connection.execute(
+            "UPDATE daily_savings SET baseline_tariff = ?, baseline_cost = (SELECT total_cost FROM daily_costs "
+            "WHERE daily_costs.mpan = daily_savings.mpan AND daily_costs.day = daily_savings.day AND daily_costs.tariff_id = ?)",
+            (baseline_tariff, baseline_tariff)
+        )
+        self._connection.execute("UPDATE daily_savings SET baseline_tariff = NULL WHERE baseline_cost IS NULL")
+        periods = set()
+        for daily in self._connection.execute("SELECT mpan, day FROM daily_savings").fetchall():
+            for granularity, start, end in rollup_periods(date.fromisoformat(daily['day'])):
+                periods.add((daily['mpan'], granularity, start, end))
+        for mpan, granularity, start, end in periods:
+            self._aggregate_period(mpan, granularity, start, end, costs=False)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO rollup_settings (name, value) VALUES ('baseline_tariff', ?)", (baseline_tariff,)
+        )
+        if periods:
+            logger.info(f"Re-rolled {len(periods)} savings periods against baseline tariff {baseline_tariff}")
+
+    def _backfill_rollups(self) -> None:
+        """Rolls up comparison runs stored before the rollups existed. Must be called holding self._lock, inside a transaction."""
+        if self._connection.execute("SELECT 1 FROM daily_savings LIMIT 1").fetchone():
+            return
+        runs = self._connection.execute("SELECT run_id, run_at, mpan FROM comparison_runs ORDER BY run_id").fetchall()
+        for table in ("daily_costs", "cost_rollups", "savings_rollups"):
+            self._connection.execute(f"DELETE FROM {table}")
+        for run in runs:
+            run_day = datetime.fromisoformat(run['run_at'].replace('Z', '+00:00')).astimezone().date()
+            self._roll_up_run(run['run_id'], run['mpan'], run_day)
+        if runs:
+            logger.info(f"Rolled up {len(runs)} stored comparison runs for the savings dashboard")
+
+    def rollup_version(self) -> int:
+        """Changes whenever the rollups do, so it can tag cached dashboard responses."""
+        with self._lock:
+            row = self._connection.execute("SELECT MAX(run_id) AS version FROM daily_savings").fetchone()
+        return row['version'] or 0
+
+    def get_savings(self, granularity: str, limit: int = 30, mpan: Optional[str] = None) -> List[dict]:
+        """
+        The latest `limit` days, weeks or months of rollups, oldest first: actual, cheapest and baseline costs,
+        realised and missed savings, and the cost on each tariff compared. Costs are in pence.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity}, expected one of {', '.join(GRANULARITIES)}")
+        mpan_filter = " AND mpan = ?" if mpan is not None else ""
+        mpan_args = (mpan,) if mpan is not None else ()
+        with self._lock:
+            periods = [dict(row) for row in self._connection.execute(
+                "SELECT * FROM savings_rollups WHERE granularity = ?" + mpan_filter + " ORDER BY period_start DESC LIMIT ?",
+                (granularity,) + mpan_args + (limit,)
+            ).fetchall()]
+            if not periods:
+                return []
+            costs = self._connection.execute(
+                "SELECT mpan, period_start, tariff_id, total_cost, total_kwh, days FROM cost_rollups "
+                "WHERE granularity = ? AND period_start >= ?" + mpan_filter,
+                (granularity, periods[-1]['period_start']) + mpan_args
+            ).fetchall()
+
+        tariffs = {}
+        for row in costs:
+            tariffs.setdefault((row['mpan'], row['period_start']), {})[row['tariff_id']] = {
+                'total_cost': row['total_cost'], 'total_kwh': row['total_kwh'], 'days': row['days']
+            }
+        for period in periods:
+            del period['granularity']
+            period['tariffs'] = tariffs.get((period['mpan'], period['period_start']), {})
+        periods.reverse()
+        return periods
+
+    def save_forecast(self, mpan: str, projection) -> None:
+        """Stores a day-ahead IntradayProjection for the dashboard, replacing any earlier forecast of that day."""
+        day = projection.day.isoformat()
+        forecast_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        rows = []
+        for tariff_projection in [projection.current] + projection.alternatives:
+            low, high = tariff_projection.band if tariff_projection.is_valid else (None, None)
+            rows.append((
+                mpan, day, tariff_projection.tariff.id, int(tariff_projection is projection.current),
+                int(tariff_projection.tariff == projection.cheapest_tariff),
+                tariff_projection.projected_cost if tariff_projection.is_valid else None, low, high,
+                tariff_projection.error, projection.history_days, projection.slots_covered, forecast_at
+            ))
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM day_ahead_forecasts WHERE mpan = ? AND day = ?", (mpan, day))
+            self._connection.executemany(
+                "INSERT INTO day_ahead_forecasts (mpan, day, tariff_id, is_current, is_cheapest, projected_cost, "
+                "low_cost, high_cost, error, history_days, slots_covered, forecast_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        logger.debug(f"Stored forecast of {day} for {mpan}")
+
+    def get_forecasts(self, from_day: date) -> List[dict]:
+        """The stored day-ahead forecasts of from_day onwards, one per MPAN and day, each with its tariffs' costs."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM day_ahead_forecasts WHERE day >= ? ORDER BY day, mpan, is_current DESC, projected_cost",
+                (from_day.isoformat(),)
+            ).fetchall()
+
+        forecasts = {}
+        for row in rows:
+            forecast = forecasts.setdefault((row['mpan'], row['day']), {
+                'mpan': row['mpan'], 'day': row['day'], 'history_days': row['history_days'],
+                'slots_covered': row['slots_covered'], 'forecast_at': row['forecast_at'], 'tariffs': []
+            })
+            forecast['tariffs'].append({
+                'tariff_id': row['tariff_id'], 'is_current': bool(row['is_current']), 'is_cheapest': bool(row['is_cheapest']),
+                'projected_cost': row['projected_cost'], 'low_cost': row['low_cost'], 'high_cost': row['high_cost'],
+                'error': row['error']
+            })
+        return list(forecasts.values())
+
+    def get_comparison_history(self, limit: int = 30) -> List[dict]:
+        """Returns the most recent comparison runs, newest first, each with its per-tariff results."""
+        with self._lock:
+            runs = [dict(row) for row in self._connection.execute(
+                "SELECT * FROM comparison_runs ORDER BY run_id DESC LIMIT ?", (limit,)
+            ).fetchall()]
+            for run in runs:
+                run['results'] = [dict(row) for row in self._connection.execute(
+                    "SELECT tariff_id, is_current, consumption_cost, standing_charge, total_cost, total_kwh, error "
+                    "FROM comparison_results WHERE run_id = ?", (run['run_id'],)
+                ).fetchall()]
+        return runs
@@ -0,0 +1,324 @@
+import math
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import logging
+
+import config
+from account_info import AccountInfo
+from comparison_engine import ComparisonEngine, TariffRates
+from data_store import DataStore, normalise_timestamp
+from tariff import Tariff
+
+logger = logging.getLogger('octobot.intraday')
+
+SLOT_SECONDS = 1800
+SLOTS_PER_DAY = 48
+# Standard normal quantile for a two-sided 90% confidence band
+BAND_Z = 1.645
+
+
+def slot_of(read_at: str) -> int:
+    """The half-hour slot (0 to 47) of the UTC day a reading falls in."""
+    normalised = normalise_timestamp(read_at)
+    return int(normalised[11:13]) * 2 + int(normalised[14:16]) // 30
+
+
+@dataclass
+class LoadForecast:
+    """Expected consumption (kWh) of each half-hour slot of a day, and its variance."""
+    day: date
+    mean_kwh: List[float]
+    variance_kwh: List[float]
+    history_days: int  # how many past days the forecast was averaged from
+
+    @classmethod
+    def from_history(cls, data_store: DataStore, mpan: str, day: date, weeks: int) -> 'LoadForecast':
+        """Averages each slot over the same weekday of the last `weeks` weeks of stored telemetry."""
+        samples: List[List[float]] = [[] for _ in range(SLOTS_PER_DAY)]
+        history_days = 0
+        for week in range(1, weeks + 1):
+            past_day = day - timedelta(weeks=week)
+            readings = data_store.get_telemetry(mpan, f"{past_day}T00:00:00Z", f"{past_day}T23:59:59Z")
+            if readings:
+                history_days += 1
+            for reading in readings:
+                samples[slot_of(reading['readAt'])].append(float(reading['consumptionDelta']) / 1000)
+
+        all_samples = [sample for slot_samples in samples for sample in slot_samples]
+        if not all_samples:
+            raise ValueError(f"No stored telemetry from the last {weeks} {day:%A}s to forecast {day} from")
+
+        # Slots with too little history fall back to the whole day's figures
+        day_mean = statistics.fmean(all_samples)
+        day_variance = statistics.pvariance(all_samples)
+        mean_kwh = [statistics.fmean(slot_samples) if slot_samples else day_mean for slot_samples in samples]
+        variance_kwh = [statistics.pvariance(slot_samples) if len(slot_samples) > 1 else day_variance
+                        for slot_samples in samples]
+        return cls(day=day, mean_kwh=mean_kwh, variance_kwh=variance_kwh, history_days=history_days)
+
+
+@dataclass
+class TariffProjection:
+    """A tariff's projected cost for the whole of today."""
+    tariff: Tariff
+    actual_cost: float = 0.0      # in pence, for the consumption so far
+    forecast_cost: float = 0.0    # in pence, for the forecast consumption over the rest of the day
+    standing_charge: float = 0.0  # in pence
+    uncertainty: float = 0.0      # in pence, the standard deviation of forecast_cost
+    error: Optional[str] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.error is None
+
+    @property
+    def projected_cost(self) -> float:
+        return self.actual_cost + self.forecast_cost + self.standing_charge
+
+    @property
+    def band(self) -> Tuple[float, float]:
+        """The confidence band around projected_cost. It can't fall below what's already been spent."""
+        spread = BAND_Z * self.uncertainty
+        floor = self.actual_cost + self.standing_charge
+        return max(floor, self.projected_cost - spread), self.projected_cost + spread
+
+
+@dataclass
+class IntradayProjection:
+    day: date
+    slots_metered: int
+    slots_covered: int  # the half-hours from the start of the day the projection runs to
+    history_days: int
+    current: TariffProjection
+    alternatives: List[TariffProjection]
+    cheapest_tariff: Optional[Tariff]
+    projected_savings: float  # in pence
+    savings_band: Tuple[float, float]  # in pence
+
+    @property
+    def is_partial_day(self) -> bool:
+        """Whether the rates stop short of the end of the day, so the projection does too."""
+        return self.slots_covered < SLOTS_PER_DAY
+
+    @property
+    def should_switch(self) -> bool:
+        """Only when even the low end of the savings band clears the threshold."""
+        return (self.cheapest_tariff is not None and
+                self.cheapest_tariff != self.current.tariff and
+                self.savings_band[0] > config.SWITCH_THRESHOLD)
+
+
+@dataclass
+class _TariffState:
+    """Everything needed to project a tariff that stays the same all day, built on the first run."""
+    projection: TariffProjection
+    slot_rates: List[Optional[float]] = field(default_factory=list)
+    slots_covered: int = SLOTS_PER_DAY  # the slots from the start of the day that have a rate
+    # forecast_suffix[slot] is the forecast cost of every slot from slot to the end of the day
+    forecast_suffix: List[float] = field(default_factory=list)
+    variance_suffix: List[float] = field(default_factory=list)
+
+
+@dataclass
+class _DayState:
+    day: date
+    current_tariff: Tariff
+    forecast: LoadForecast
+    # Whether rates may stop short of the end of the day, as tomorrow's Agile rates do until the afternoon
+    partial: bool = False
+    tariffs: Dict[str, _TariffState] = field(default_factory=dict)
+    # The readings already costed, keyed by normalised readAt, so a corrected reading can be re-costed
+    readings: Dict[str, dict] = field(default_factory=dict)
+
+
+class IntradayProjector:
+    """
+    Projects every tariff's end-of-day cost from today's consumption so far plus a forecast of the
+    half-hours still to come. Rates, the forecast and the forecast cost of the rest of the day are
+    worked out on the first run of the day, and each reading is only costed when it's new or corrected,
+    so later runs only do work for the half-hours metered since the last one.
+    """
+
+    def __init__(self, data_store: DataStore):
+        logger.debug(f"Initialising {__class__.__name__}")
+        self.data_store = data_store
+        self._states: Dict[str, _DayState] = {}  # keyed by MPAN
+        # One lock per MPAN, as building a state fetches rates, so accounts don't wait on each other
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def project(self,
+                account_info: AccountInfo,
+                tariffs: List[Tariff],
+                comparison_engine: ComparisonEngine,
+                day: Optional[date] = None) -> IntradayProjection:
+        day = day or date.today()
+        started = time.perf_counter()
+        with self._locks_lock:
+            lock = self._locks.setdefault(account_info.mpan, threading.Lock())
+        with lock:
+            state = self._states.get(account_info.mpan)
+            if state is None or state.day != day or state.current_tariff != account_info.current_tariff:
+                # A new day, or we've switched since the last run
+                state = _DayState(
+                    day=day,
+                    current_tariff=account_info.current_tariff,
+                    forecast=LoadForecast.from_history(self.data_store, account_info.mpan, day,
+                                                       config.INTRADAY_HISTORY_WEEKS)
+                )
+                self._states[account_info.mpan] = state
+
+            all_tariffs = [account_info.current_tariff] + [t for t in tariffs if t != account_info.current_tariff]
+            # New tariffs (e.g. after a config change) and ones whose rates failed last time
+            missing = [t for t in all_tariffs if t.id not in state.tariffs or not state.tariffs[t.id].projection.is_valid]
+            self._add_tariffs(state, missing, account_info, comparison_engine)
+            self._cost_new_readings(state, account_info.consumption)
+            projection = self._build_projection(state, all_tariffs)
+
+        logger.debug(f"Projected {len(all_tariffs)} tariffs in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return projection
+
+    def forecast_day(self,
+                     account_info: AccountInfo,
+                     tariffs: List[Tariff],
+                     comparison_engine: ComparisonEngine,
+                     day: date) -> IntradayProjection:
+        """
+        Projects a day that hasn't started yet, e.g. tomorrow once its Agile rates are published, from the
+        forecast consumption alone. Agile's published rates run to 23:00 UK time, so the projection stops
+        where the first tariff's rates do (see is_partial_day). Doesn't touch the state kept for today's intraday runs.
+        """
+        all_tariffs = [account_info.current_tariff] + [t for t in tariffs if t != account_info.current_tariff]
+        # Fetched (and stored) first, so the day's own comparison finds the rates even without history to forecast from
+        comparison_engine.fetch_tariff_rates(account_info, all_tariffs, day)
+        state = _DayState(
+            day=day,
+            current_tariff=account_info.current_tariff,
+            forecast=LoadForecast.from_history(self.data_store, account_info.mpan, day, config.INTRADAY_HISTORY_WEEKS),
+            partial=True
+        )
+        self._add_tariffs(state, all_tariffs, account_info, comparison_engine)
+        return self._build_projection(state, all_tariffs)
+
+    def _add_tariffs(self, state: _DayState, tariffs: List[Tariff],
+                     account_info: AccountInfo, comparison_engine: ComparisonEngine) -> None:
+        if not tariffs:
+            return
+
+        day_start = datetime(state.day.year, state.day.month, state.day.day, tzinfo=timezone.utc).timestamp()
+        for fetched in comparison_engine.fetch_tariff_rates(account_info, tariffs, state.day):
+            if not isinstance(fetched, TariffRates):
+                state.tariffs[fetched.tariff.id] = _TariffState(TariffProjection(fetched.tariff, error=fetched.error))
+                continue
+
+            is_current = fetched.tariff == state.current_tariff
+            tariff_state = _TariffState(TariffProjection(
+                fetched.tariff,
+                # The current tariff's standing charge comes from the account, like in compare_tariffs
+                standing_charge=account_info.standing_charge if is_current else fetched.standing_charge
+            ))
+            # Looked up mid-slot, as a rate also covers the instant it ends at
+            slot_rates = [fetched.rate_index.rate_at(day_start + (slot + 0.5) * SLOT_SECONDS) for slot in range(SLOTS_PER_DAY)]
+            covered = slot_rates.index(None) if None in slot_rates else SLOTS_PER_DAY
+            # Only a missing tail is allowed, and only when the state allows it
+            if covered == 0 or (covered < SLOTS_PER_DAY and not state.partial) or \
+                    any(rate is not None for rate in slot_rates[covered:]):
+                tariff_state.projection.error = f"No unit rate found for half-hour {covered} of {state.day}"
+                state.tariffs[fetched.tariff.id] = tariff_state
+                continue
+
+            tariff_state.slot_rates = slot_rates
+            tariff_state.slots_covered = covered
+            tariff_state.forecast_suffix = [0.0] * (SLOTS_PER_DAY + 1)
+            tariff_state.variance_suffix = [0.0] * (SLOTS_PER_DAY + 1)
+            for slot in reversed(range(covered)):
+                rate = slot_rates[slot]
+                tariff_state.forecast_suffix[slot] = tariff_state.forecast_suffix[slot + 1] + rate * state.forecast.mean_kwh[slot]
+                tariff_state.variance_suffix[slot] = (tariff_state.variance_suffix[slot + 1]
+                                                      + rate * rate * state.forecast.variance_kwh[slot])
+
+            # Catch up with the readings already costed for the other tariffs
+            for reading in state.readings.values():
+                tariff_state.projection.actual_cost += self._reading_cost(state, tariff_state, reading)
+            state.tariffs[fetched.tariff.id] = tariff_state
+
+    def _cost_new_readings(self, state: _DayState, consumption: List[dict]) -> None:
+        for entry in consumption:
+            read_at = normalise_timestamp(entry['readAt'])
+            if not read_at.startswith(str(state.day)):
+                continue
+            reading = {
+                'slot': slot_of(read_at),
+                'kwh': float(entry['consumptionDelta']) / 1000,
+                'cost_with_tax': float(entry['costDeltaWithTax'] or 0),
+            }
+            previous = state.readings.get(read_at)
+            if previous == reading:
+                continue
+
+            for tariff_state in state.tariffs.values():
+                if tariff_state.projection.is_valid:
+                    if previous:
+                        tariff_state.projection.actual_cost -= self._reading_cost(state, tariff_state, previous)
+                    tariff_state.projection.actual_cost += self._reading_cost(state, tariff_state, reading)
+            state.readings[read_at] = reading
+
+    def _reading_cost(self, state: _DayState, tariff_state: _TariffState, reading: dict) -> float:
+        if tariff_state.projection.tariff == state.current_tariff:
+            return reading['cost_with_tax']
+        return float("{:.4f}".format(reading['kwh'] * tariff_state.slot_rates[reading['slot']]))
+
+    def _build_projection(self, state: _DayState, tariffs: List[Tariff]) -> IntradayProjection:
+        next_slot = max((reading['slot'] for reading in state.readings.values()), default=-1) + 1
+        # Every tariff is projected over the same half-hours, so stop where the first one's rates do
+        end_slot = min((state.tariffs[tariff.id].slots_covered for tariff in tariffs
+                        if state.tariffs[tariff.id].projection.is_valid), default=SLOTS_PER_DAY)
+
+        projections = []
+        for tariff in tariffs:
+            tariff_state = state.tariffs[tariff.id]
+            projection = tariff_state.projection
+            if projection.is_valid:
+                projection.forecast_cost = tariff_state.forecast_suffix[next_slot] - tariff_state.forecast_suffix[end_slot]
+                projection.uncertainty = math.sqrt(max(0.0, tariff_state.variance_suffix[next_slot]
+                                                       - tariff_state.variance_suffix[end_slot]))
+            # Copied so a caller holding an earlier projection doesn't see it change
+            projections.append(TariffProjection(**vars(projection)))
+
+        current = projections[0]
+        if not current.is_valid:
+            raise ValueError(f"Couldn't project current tariff {current.tariff.display_name}: {current.error}")
+
+        switchable = [p for p in projections if p.is_valid and p.tariff.switchable]
+        if not switchable:
+            cheapest_tariff, savings, savings_band = None, 0.0, (0.0, 0.0)
+        else:
+            cheapest = min(switchable, key=lambda p: p.projected_cost)
+            cheapest_tariff = cheapest.tariff
+            savings = current.projected_cost - cheapest.projected_cost
+            # Both tariffs share the same forecast consumption, so the uncertainty of the saving
+            # comes from the difference between their rates over the remaining slots
+            current_rates = state.tariffs[current.tariff.id].slot_rates
+            cheapest_rates = state.tariffs[cheapest.tariff.id].slot_rates
+            variance = sum(
+                (current_rates[slot] - cheapest_rates[slot]) ** 2 * state.forecast.variance_kwh[slot]
+                for slot in range(next_slot, end_slot)
+            )
+            spread = BAND_Z * math.sqrt(variance)
+            savings_band = (savings - spread, savings + spread)
+
+        return IntradayProjection(
+            day=state.day,
+            slots_metered=next_slot,
+            slots_covered=end_slot,
+            history_days=state.forecast.history_days,
+            current=current,
+            alternatives=projections[1:],
+            cheapest_tariff=cheapest_tariff,
+            projected_savings=savings,
+            savings_band=savings_band
+        )
@@ -0,0 +1,279 @@
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger('octobot.log_reader')
+
+LOG_PATH = os.path.join('logs', 'octobot.log')
+# Matches RotatingFileHandler's backupCount in logger.py
+LOG_BACKUP_COUNT = 5
+BLOCK_SIZE = 64 * 1024
+
+# Every entry starts with a timestamp, lines without one continue the previous entry (e.g. tracebacks)
+TIMESTAMP_PATTERN = re.compile(rb'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+# The detailed format from logger.py: asctime - name - levelname - module.funcName - message
+ENTRY_PATTERN = re.compile(r'^(\S+ \S+) - (\S+) - ([A-Z]+) - ([^.\s]+)\.(\S+) - ')
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+
+@dataclass
+class LogEntry:
+    text: str
+    file_id: int  # inode of the file the entry is in, which stays the same when the file is rotated
+    start: int    # byte offset of the entry in its file
+    end: int      # byte offset just past the entry
+    timestamp: Optional[str] = None
+    name: Optional[str] = None
+    level: Optional[str] = None
+    module: Optional[str] = None
+
+    @classmethod
+    def parse(cls, lines: List[bytes], file_id: int, start: int, end: int) -> 'LogEntry':
+        text = b"\n".join(lines).decode('utf-8', errors='replace')
+        entry = cls(text=text, file_id=file_id, start=start, end=end)
+        match = ENTRY_PATTERN.match(text)
+        if match:
+            entry.timestamp, entry.name, entry.level, entry.module = match.group(1, 2, 3, 4)
+        return entry
+
+    @property
+    def cursor(self) -> str:
+        """Identifies the entry's start, for paging back to older entries."""
+        return f"{self.file_id}-{self.start}"
+
+    @property
+    def resume_cursor(self) -> str:
+        """Identifies the entry's end, for streaming the entries after it."""
+        return f"{self.file_id}-{self.end}"
+
+    def to_dict(self) -> dict:
+        return {
+            'cursor': self.cursor,
+            'resume_cursor': self.resume_cursor,
+            'timestamp': self.timestamp,
+            'name': self.name,
+            'level': self.level,
+            'module': self.module,
+            'text': self.text,
+        }
+
+
+@dataclass
+class LogFilter:
+    min_level: Optional[str] = None
+    modules: List[str] = field(default_factory=list)  # module or logger names, e.g. comparison_engine
+
+    def matches(self, entry: LogEntry) -> bool:
+        if self.min_level and (entry.level not in LEVELS or LEVELS.index(entry.level) < LEVELS.index(self.min_level)):
+            return False
+        if self.modules and entry.module not in self.modules and \
+                not any(entry.name and entry.name.endswith(module) for module in self.modules):
+            return False
+        return True
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    if not cursor:
+        return None
+    try:
+        file_id, offset = cursor.split("-")
+        return int(file_id), int(offset)
+    except ValueError:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def _lines_backwards(handle, end: int) -> Iterator[Tuple[int, bytes]]:
+    """Yields (offset, line) from the line ending at end back to the start of the file, a block at a time."""
+    position = end
+    remainder = b""
+    skip_trailing_newline = True
+    while position > 0:
+        size = min(BLOCK_SIZE, position)
+        position -= size
+        handle.seek(position)
+        block = handle.read(size) + remainder
+        lines = block.split(b"\n")
+        remainder = lines[0]  # may carry on in the previous block
+        cursor = position + len(block)
+        for line in reversed(lines[1:]):
+            cursor -= len(line)
+            if line or not skip_trailing_newline:
+                yield cursor, line
+            skip_trailing_newline = False
+            cursor -= 1  # the newline before it
+    if remainder:
+        yield 0, remainder
+
+
+def _entries_backwards(handle, file_id: int, end: int) -> Iterator[LogEntry]:
+    """Yields the entries ending at or before end, newest first."""
+    pending: List[bytes] = []
+    group_end = end
+    for offset, line in _lines_backwards(handle, end):
+        if not pending:
+            group_end = min(end, offset + len(line) + 1)
+        pending.append(line)
+        if TIMESTAMP_PATTERN.match(line):
+            yield LogEntry.parse(pending[::-1], file_id, offset, group_end)
+            pending = []
+    if pending:
+        # Continuation lines at the very start of the file, whose first line was rotated away
+        yield LogEntry.parse(pending[::-1], file_id, 0, group_end)
+
+
+class LogReader:
+    """
+    Reads the rotated log files newest entry first, seeking backwards from the end a block at a time,
+    so memory stays the same however big the logs get. Cursors are an entry's file inode and byte
+    offset, so they stay valid when the files are rotated (octobot.log becomes octobot.log.1 and so on).
+    """
+
+    def __init__(self, path: str = LOG_PATH, backup_count: int = LOG_BACKUP_COUNT):
+        self.path = path
+        self.backup_count = backup_count
+
+    def files(self) -> List[Tuple[str, int]]:
+        """The existing log files and their inodes, newest first."""
+        files = []
+        for path in [self.path] + [f"{self.path}.{number}" for number in range(1, self.backup_count + 1)]:
+            try:
+                files.append((path, os.stat(path).st_ino))
+            except FileNotFoundError:
+                continue
+        return files
+
+    def page(self, limit: int, before: Optional[str] = None,
+             log_filter: Optional[LogFilter] = None) -> Tuple[List[LogEntry], Optional[str]]:
+        """
+        Returns up to limit entries matching log_filter that come before the before cursor (or the
+        newest ones), oldest first, plus the cursor for the page before them, or None if there isn't one.
+        """
+        log_filter = log_filter or LogFilter()
+        files = self.files()
+        start_index, start_offset = 0, None
+        parsed = parse_cursor(before)
+        if parsed:
+            file_id, start_offset = parsed
+            start_index = next((index for index, (_, inode) in enumerate(files) if inode == file_id), None)
+            if start_index is None:
+                # Rotated out of existence
+                return [], None
+
+        entries: List[LogEntry] = []
+        for index in range(start_index, len(files)):
+            path, file_id = files[index]
+            with open(path, 'rb') as handle:
+                end = start_offset if index == start_index and start_offset is not None else os.fstat(handle.fileno()).st_size
+                for entry in _entries_backwards(handle, file_id, end):
+                    if not log_filter.matches(entry):
+                        continue
+                    if len(entries) == limit:
+                        entries.reverse()
+                        return entries, entries[0].cursor
+                    entries.append(entry)
+
+        entries.reverse()
+        return entries, None
+
+    def follow(self, after: Optional[str] = None, log_filter: Optional[LogFilter] = None,
+               poll_seconds: float = 1.0) -> Iterator[Optional[LogEntry]]:
+        """
+        Yields entries as they're written, starting after the after cursor (or from the end of the log),
+        following the log across rotations. Yields None after every idle poll so the caller can send a
+        keep-alive or notice the client has gone.
+        """
+        log_filter = log_filter or LogFilter()
+        files = self.files()
+        parsed = parse_cursor(after)
+        queue: List[Tuple[str, int]] = []  # (path, offset) of the files still to read, oldest first
+        if parsed:
+            file_id, offset = parsed
+            index = next((index for index, (_, inode) in enumerate(files) if inode == file_id), None)
+            if index is not None:
+                queue = [(files[index][0], offset)] + [(path, 0) for path, _ in reversed(files[:index])]
+
+        handle = None
+        try:
+            if queue:
+                # Catch up on the rotated files first. Each is opened before moving on, so a rotation
+                # in the meantime doesn't matter.
+                for path, offset in queue[:-1]:
+                    with open(path, 'rb') as rotated:
+                        yield from self._read_new_entries(rotated, offset, log_filter)
+                handle = open(queue[-1][0], 'rb')
+                handle.seek(queue[-1][1])
+            else:
+                while handle is None:
+                    try:
+                        handle = open(self.path, 'rb')
+                        handle.seek(0, os.SEEK_END)
+                    except FileNotFoundError:
+                        yield None
+                        time.sleep(poll_seconds)
+
+            while True:
+                yield from self._read_new_entries(handle, handle.tell(), log_filter)
+                if self._rotated(handle):
+                    handle.close()
+                    handle = open(self.path, 'rb')
+                    continue
+                yield None
+                time.sleep(poll_seconds)
+        finally:
+            if handle:
+                handle.close()
+
+    def since(self, after: Optional[str], limit: int,
+              log_filter: Optional[LogFilter] = None) -> List[LogEntry]:
+        """Returns up to limit of the entries written after the after cursor, without waiting for more."""
+        entries: List[LogEntry] = []
+        follower = self.follow(after, log_filter)
+        try:
+            for entry in follower:
+                if entry is None:
+                    break
+                entries.append(entry)
+                if len(entries) == limit:
+                    break
+        finally:
+            follower.close()
+        return entries
+
+    def _rotated(self, handle) -> bool:
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return current.st_ino != os.fstat(handle.fileno()).st_ino or current.st_size < handle.tell()
+
+    @staticmethod
+    def _read_new_entries(handle, offset: int, log_filter: LogFilter) -> Iterator[LogEntry]:
+        """Yields the complete entries from offset to the end of the file, leaving handle after the last one."""
+        file_id = os.fstat(handle.fileno()).st_ino
+        handle.seek(offset)
+        pending: List[bytes] = []
+        pending_start = offset
+        position = offset
+        for line in iter(handle.readline, b""):
+            if not line.endswith(b"\n"):
+                # Still being written, come back for it
+                break
+            if TIMESTAMP_PATTERN.match(line) and pending:
+                entry = LogEntry.parse(pending, file_id, pending_start, position)
+                if log_filter.matches(entry):
+                    yield entry
+                pending = []
+            if not pending:
+                pending_start = position
+            pending.append(line.rstrip(b"\n"))
+            position += len(line)
+
+        # Entries are written in a single write, so whatever's complete now is the whole entry
+        if pending:
+            entry = LogEntry.parse(pending, file_id, pending_start, position)
+            if log_filter.matches(entry):
+                yield entry
+        handle.seek(position)
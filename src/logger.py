@@ -1,6 +1,11 @@
 import logging
 import os
 from logging.handlers import RotatingFileHandler
+import config
+from structured_logging import JsonLinesHandler, LogIndex
+
+# Set when STRUCTURED_LOGS is on, for the web server to query
+structured_log_handler = None
 
 def setup_logging():
     """Configure logging for the application."""
@@ -42,6 +47,17 @@ def setup_logging():
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
+    if config.STRUCTURED_LOGS:
+        global structured_log_handler
+        structured_log_handler = JsonLinesHandler(
+            filename=os.path.join(log_dir, 'octobot.jsonl'),
+            index=LogIndex(os.path.join(log_dir, 'octobot-log-index.db')),
+            max_bytes=10*1024*1024,  # 10MB
+            backup_count=5
+        )
+        structured_log_handler.setLevel(logging.DEBUG)
+        logger.addHandler(structured_log_handler)
+
     return logger
 
 logger = setup_logging()
\ No newline at end of file
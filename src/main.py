@@ -1,11 +1,28 @@
 from bot_orchestrator import BotOrchestrator
 import logger
+import signal
+import sys
 import threading
 import web_server
 
+# Docker waits 10 seconds after SIGTERM before killing the container, leave time to exit within it
+SHUTDOWN_FLUSH_SECONDS = 8
+
 orchestrator = BotOrchestrator()
-bot_thread = threading.Thread(target=orchestrator.start, daemon=False, name="BotThread")
-web_thread = threading.Thread(target=web_server.run_server, daemon=False, name="WebThread")
+# Daemon threads, so the process can exit once the signal handler has flushed what matters
+bot_thread = threading.Thread(target=orchestrator.start, daemon=True, name="BotThread")
+web_thread = threading.Thread(target=web_server.run_server, daemon=True, name="WebThread")
+
+
+def shutdown(signum, frame):
+    print(f"Received {signal.Signals(signum).name}, shutting down...")
+    orchestrator.stop(SHUTDOWN_FLUSH_SECONDS)
+    sys.exit(0)
+
+
+# Handlers run on the main thread, which waits in join() below
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGINT, shutdown)
 
 # Start both threads
 print("Starting bot thread...")
@@ -14,4 +31,4 @@ bot_thread.start()
 print("Starting web server thread...")
 web_thread.start()
 bot_thread.join()
-web_thread.join()
\ No newline at end of file
+web_thread.join()
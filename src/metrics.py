@@ -0,0 +1,153 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+import logging
+
+from structured_logging import current_run_stats
+
+logger = logging.getLogger('octobot.metrics')
+
+# In seconds, from a cached lookup up to the waits in the switch flow
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets) + (math.inf,)
+        # Per label set: a count for each bucket (not cumulative), the sum and the count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            bucket_counts, totals = self._values.setdefault(key, ([0] * len(self.buckets), [0.0, 0]))
+            bucket_counts[bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, (total, count)) in sorted(self._values.items()):
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(upper_bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {_format_value(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Every metric the bot records, rendered in the Prometheus text exposition format for /metrics."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, help_text, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_seconds = registry.histogram(
+    "octobot_http_request_duration_seconds", "Time taken by each request to the Octopus API.",
+    ("method", "endpoint", "status"))
+http_response_bytes = registry.counter(
+    "octobot_http_response_bytes_total", "Bytes downloaded from the Octopus API.", ("endpoint",))
+http_retries = registry.counter(
+    "octobot_http_retries_total", "Requests to the Octopus API that were retried.", ("endpoint",))
+circuit_opened = registry.counter(
+    "octobot_circuit_opened_total", "Times an Octopus API endpoint's circuit breaker opened.", ("endpoint",))
+cache_lookups = registry.counter(
+    "octobot_cache_lookups_total", "Product and unit rate lookups by cache and where the answer came from.",
+    ("cache", "result"))
+span_seconds = registry.histogram(
+    "octobot_span_duration_seconds", "Time spent in each stage of a run.", ("span",))
+runs = registry.counter(
+    "octobot_runs_total", "Comparison runs by kind.", ("kind",))
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Times a stage, recording it in the span histogram and in the current run's summary."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def record_span(name: str, seconds: float) -> None:
+    """Records a stage timed some other way than with span, e.g. one that ends inside a loop."""
+    span_seconds.observe(seconds, span=name)
+    run_stats = current_run_stats()
+    if run_stats:
+        run_stats.record_span(name, seconds)
+
+
+def format_span_summary(spans: Dict[str, Tuple[int, float]]) -> str:
+    """One line per span, slowest first, e.g. 'gql_query: 3 calls, 1.20s'."""
+    ordered = sorted(spans.items(), key=lambda item: item[1][1], reverse=True)
+    return "\n".join(f"{name}: {count} calls, {total:.2f}s" for name, (count, total) in ordered)
@@ -0,0 +1,334 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, asdict, fields
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional
+import logging
+
+from flask import Flask, Response, jsonify, request
+
+import config
+from benchmark import ACC_NUMBER, Fixtures, Scenario, RATE_SHAPES
+from rate_index import to_epoch
+
+logger = logging.getLogger('octobot.mock_api')
+
+# The Octopus API serves 100 rates a page unless asked for more, and no more than 1500
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1500
+TERMS_VERSION = "1.2"
+
+
+@dataclass
+class Faults:
+    """What the mock does to requests. Every rate is a probability from 0 to 1, checked per request."""
+    latency_ms: float = 0.0     # added to every request
+    jitter_ms: float = 0.0      # plus a random extra of up to this
+    error_rate: float = 0.0     # answered with a 500, 502 or 503
+    rate_limit_rate: float = 0.0  # answered with a 429 and a Retry-After header
+    retry_after_seconds: int = 1
+    unauthorized_rate: float = 0.0  # GraphQL requests with a valid token answered with a 401
+    token_lifetime_seconds: int = 3600
+    agreement_delay_seconds: int = 5  # how long after a switch starts the new agreement's terms can be accepted
+
+    def update(self, values: dict) -> None:
+        for field in fields(self):
+            if field.name in values:
+                setattr(self, field.name, type(field.default)(values[field.name]))
+
+
+def _encode(part: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+
+
+def _gql_error(message: str, error_code: str) -> Response:
+    # Kraken reports errors in the body of a 200 response
+    return jsonify({"data": None, "errors": [{"message": message, "extensions": {"errorCode": error_code}}]})
+
+
+@dataclass
+class Enrolment:
+    id: str
+    product_code: str
+    started_at: float
+    accepted: bool = False
+
+
+class MockOctopusApi:
+    """
+    A stand-in for the Octopus API, serving the benchmark's fixtures at BASE_URL's paths: the product
+    catalogue, product details and paginated unit rates over REST, plus the GraphQL operations in queries.py.
+    Tokens expire like Kraken's, a switch changes the account's agreement once its terms are accepted,
+    and latency, errors, 429s and 401s can be injected, changed at runtime through /_mock/faults.
+    """
+
+    def __init__(self, fixtures: Fixtures, faults: Faults, api_key: Optional[str] = None):
+        self.fixtures = fixtures
+        self.faults = faults
+        self.api_key = api_key
+        self.catalogue = json.loads(fixtures.rest[f"{config.BASE_URL}/products/"])
+        self.products = {product["code"]: json.loads(fixtures.rest[f"{config.BASE_URL}/products/{product['code']}/"])
+                         for product in self.catalogue["results"]}
+        # Tariffs share rate documents, so parse each one once
+        parsed: Dict[int, List[dict]] = {}
+        self.rates: Dict[str, List[dict]] = {}
+        for url, body in fixtures.rest.items():
+            if url.endswith("/standard-unit-rates/"):
+                tariff_code = url.split("/")[-3]
+                self.rates[tariff_code] = parsed.setdefault(id(body), json.loads(body)["results"])
+        self.telemetry: List[dict] = json.loads(fixtures.telemetry)["smartMeterTelemetry"]
+        self.account: dict = json.loads(fixtures.account)
+
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, float] = {}  # token: expiry (epoch seconds)
+        self._refresh_tokens: Dict[str, float] = {}
+        self._enrolments: List[Enrolment] = []
+        self.stats: Dict[str, int] = {}
+
+    def create_app(self) -> Flask:
+        app = Flask(__name__)
+        app.before_request(self._inject_faults)
+        app.after_request(self._count)
+        app.add_url_rule('/v1/graphql/', view_func=self.graphql, methods=['POST'])
+        app.add_url_rule('/v1/products/', view_func=self.product_catalogue)
+        app.add_url_rule('/v1/products/<code>/', view_func=self.product)
+        app.add_url_rule('/v1/products/<code>/electricity-tariffs/<tariff_code>/standard-unit-rates/',
+                         view_func=self.unit_rates)
+        app.add_url_rule('/_mock/faults', view_func=self.faults_endpoint, methods=['GET', 'POST'])
+        app.add_url_rule('/_mock/stats', view_func=lambda: jsonify(self.stats))
+        return app
+
+    def _inject_faults(self) -> Optional[Response]:
+        if request.path.startswith('/_mock/'):
+            return None
+        faults = self.faults
+        delay = faults.latency_ms + random.uniform(0, faults.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if random.random() < faults.rate_limit_rate:
+            return Response("Too many requests", 429, {'Retry-After': str(faults.retry_after_seconds)})
+        if random.random() < faults.error_rate:
+            return Response("Injected server error", random.choice([500, 502, 503]))
+        return None
+
+    def _count(self, response: Response) -> Response:
+        if request.path.startswith('/_mock/'):
+            return response
+        if request.path.endswith("/graphql/"):
+            endpoint = "graphql"
+        elif request.path.endswith("/standard-unit-rates/"):
+            endpoint = "unit_rates"
+        else:
+            endpoint = "products"
+        key = f"{request.method} {endpoint} {response.status_code}"
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+        return response
+
+    def faults_endpoint(self):
+        if request.method == 'POST':
+            try:
+                self.faults.update(request.get_json(force=True))
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': str(e)}), 400
+            logger.info(f"Faults changed to {self.faults}")
+        return jsonify(asdict(self.faults))
+
+    # REST
+
+    def product_catalogue(self):
+        return self._cacheable(self.catalogue)
+
+    def product(self, code: str):
+        if code not in self.products:
+            return jsonify({"detail": "Not found."}), 404
+        return self._cacheable(self.products[code])
+
+    @staticmethod
+    def _cacheable(body: dict) -> Response:
+        etag = f'"{hash(json.dumps(body, sort_keys=True)) & 0xffffffff:08x}"'
+        if request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers={'ETag': etag})
+        response = jsonify(body)
+        response.headers['ETag'] = etag
+        return response
+
+    def unit_rates(self, code: str, tariff_code: str):
+        rates = self.rates.get(tariff_code)
+        if rates is None:
+            return jsonify({"detail": "Not found."}), 404
+        period_from = request.args.get('period_from')
+        period_to = request.args.get('period_to')
+        start = to_epoch(period_from) if period_from else float('-inf')
+        end = to_epoch(period_to) if period_to else float('inf')
+        matching = [rate for rate in rates
+                    if to_epoch(rate['valid_from']) < end and (rate['valid_to'] is None or to_epoch(rate['valid_to']) > start)]
+
+        page_size = min(request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+        page = request.args.get('page', 1, type=int)
+        results = matching[(page - 1) * page_size:page * page_size]
+        next_url = None
+        if page * page_size < len(matching):
+            query = request.args.to_dict()
+            query['page'] = page + 1
+            next_url = f"{request.base_url}?" + "&".join(f"{key}={value}" for key, value in query.items())
+        return jsonify({"count": len(matching), "next": next_url, "previous": None, "results": results})
+
+    # GraphQL
+
+    def graphql(self):
+        query = (request.get_json(force=True, silent=True) or {}).get("query", "")
+        if "obtainKrakenToken" in query:
+            return self._obtain_token(query)
+
+        token = request.headers.get('Authorization', '')
+        with self._lock:
+            expires_at = self._tokens.get(token)
+        if expires_at is None:
+            return Response("Unknown token", 401)
+        if time.time() >= expires_at:
+            return _gql_error("Signature of the JWT has expired.", "KT-CT-1124")
+        if random.random() < self.faults.unauthorized_rate:
+            return Response("Injected authentication failure", 401)
+
+        if "startOnboardingProcess" in query:
+            return self._start_onboarding(query)
+        if "acceptTermsAndConditions" in query:
+            return self._accept_terms(query)
+        if "termsAndConditionsForProduct" in query:
+            return jsonify({"data": {"termsAndConditionsForProduct": {"name": "Mock terms", "version": TERMS_VERSION}}})
+        if "productEnrolments" in query:
+            return jsonify({"data": {"productEnrolments": self._enrolment_data()}})
+
+        data = {}
+        if "account(" in query:
+            data.update(self.account)
+        if "smartMeterTelemetry(" in query:
+            data["smartMeterTelemetry"] = self._telemetry(query)
+        if not data:
+            return _gql_error("Operation not supported by the mock", "MOCK-1")
+        return jsonify({"data": data})
+
+    def _obtain_token(self, query: str):
+        refresh_token = self._argument(query, "refreshToken")
+        with self._lock:
+            if refresh_token is not None:
+                if self._refresh_tokens.get(refresh_token, 0) <= time.time():
+                    return _gql_error("Invalid refresh token.", "KT-CT-1135")
+            elif self.api_key and self._argument(query, "APIKey") != self.api_key:
+                return _gql_error("Invalid API key.", "KT-CT-1139")
+
+            now = time.time()
+            expires_at = now + self.faults.token_lifetime_seconds
+            token = f"{_encode({'alg': 'none', 'typ': 'JWT'})}.{_encode({'exp': int(expires_at), 'iat': int(now)})}.mock"
+            new_refresh_token = uuid.uuid4().hex
+            refresh_expires_at = now + 7 * 24 * 3600
+            self._tokens[token] = expires_at
+            self._refresh_tokens[new_refresh_token] = refresh_expires_at
+        return jsonify({"data": {"obtainKrakenToken": {
+            "token": token, "refreshToken": new_refresh_token, "refreshExpiresIn": int(refresh_expires_at)}}})
+
+    def _telemetry(self, query: str) -> List[dict]:
+        start = to_epoch(self._argument(query, "start") or "1970-01-01T00:00:00Z")
+        end = to_epoch(self._argument(query, "end") or "2100-01-01T00:00:00Z")
+        return [reading for reading in self.telemetry if start <= to_epoch(reading['readAt']) <= end]
+
+    def _start_onboarding(self, query: str):
+        product_code = self._argument(query, "productCode")
+        if product_code not in self.products:
+            return _gql_error(f"Unknown product {product_code}.", "KT-CT-4501")
+        enrolment = Enrolment(id=f"ENR-{uuid.uuid4().hex[:8]}", product_code=product_code, started_at=time.time())
+        with self._lock:
+            self._enrolments.append(enrolment)
+        return jsonify({"data": {"startOnboardingProcess": {
+            "onboardingProcess": {"id": f"OP-{enrolment.id}"}, "productEnrolment": {"id": enrolment.id}}}})
+
+    def _accept_terms(self, query: str):
+        enrolment_id = self._argument(query, "enrolmentId")
+        with self._lock:
+            enrolment = next((enrolment for enrolment in self._enrolments if enrolment.id == enrolment_id), None)
+            if enrolment is None:
+                return _gql_error(f"Unknown enrolment {enrolment_id}.", "KT-CT-4502")
+            if time.time() - enrolment.started_at < self.faults.agreement_delay_seconds:
+                # What Octopus does while the new agreement is still being generated
+                return _gql_error("The agreement isn't ready to be accepted yet.", "KT-CT-4503")
+            enrolment.accepted = True
+            self._switch_agreement(enrolment.product_code)
+        return jsonify({"data": {"acceptTermsAndConditions": {"acceptedVersion": TERMS_VERSION}}})
+
+    def _switch_agreement(self, product_code: str) -> None:
+        """Ends the current agreement today and starts one on the new product, listed first like the API does."""
+        agreements = self.account["account"]["electricityAgreements"]
+        current = agreements[0]
+        today = f"{date.today()}T00:00:00+00:00"
+        current["validTo"] = today
+        region = current["tariff"]["tariffCode"][-1]
+        agreements.insert(0, {
+            "validFrom": today,
+            "validTo": None,
+            "meterPoint": current["meterPoint"],
+            "tariff": {"id": str(len(agreements) + 1), "productCode": product_code,
+                       "tariffCode": f"E-1R-{product_code}-{region}",
+                       "standingCharge": current["tariff"]["standingCharge"]},
+        })
+
+    def _enrolment_data(self) -> List[dict]:
+        with self._lock:
+            enrolments = list(self._enrolments)
+        data = []
+        for enrolment in enrolments:
+            status = "COMPLETED" if enrolment.accepted else "IN_PROGRESS"
+            # The terms stage only starts once the new agreement has been generated
+            terms_status = status
+            if not enrolment.accepted and time.time() - enrolment.started_at < self.faults.agreement_delay_seconds:
+                terms_status = "NOT_STARTED"
+            display_name = next((product["display_name"] for product in self.catalogue["results"]
+                                 if product["code"] == enrolment.product_code), enrolment.product_code)
+            data.append({
+                "id": enrolment.id,
+                "status": status,
+                "product": {"code": enrolment.product_code, "displayName": display_name},
+                "stages": [{"name": "TERMS_AND_CONDITIONS", "status": terms_status, "steps": [{
+                    "displayName": "Accept terms", "status": terms_status,
+                    "updatedAt": datetime.fromtimestamp(enrolment.started_at, timezone.utc).isoformat()}]}],
+            })
+        return data
+
+    @staticmethod
+    def _argument(query: str, name: str) -> Optional[str]:
+        """Reads a quoted argument out of a query built from queries.py, e.g. deviceId: "..."."""
+        match = re.search(rf'\b{name}:\s*"([^"]*)"', query)
+        return match.group(1) if match else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a stand-in Octopus API for testing the bot offline. Point BASE_URL at http://<host>:<port>/v1")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--days", type=int, default=30, help="Days of telemetry to serve, up to today, with rates up to 23:00 UK time tomorrow as published")
+    parser.add_argument("--tariffs", type=int, default=4, help="How many products to list")
+    parser.add_argument("--rates", choices=RATE_SHAPES, default="agile",
+                        help="Agile's half-hourly rates or Flexible's single rate")
+    parser.add_argument("--api-key", help="Only accept this API key. Any key is accepted if not given")
+    for field in fields(Faults):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    config.BASE_URL = f"http://{args.host}:{args.port}/v1"
+    faults = Faults(**{field.name: getattr(args, field.name) for field in fields(Faults)})
+    mock = MockOctopusApi(Fixtures(Scenario(args.days, args.tariffs, args.rates)), faults, args.api_key)
+    logger.info(f"Mock Octopus API on {config.BASE_URL}, account {ACC_NUMBER} on {mock.fixtures.current_tariff.display_name} "
+                f"with {len(mock.telemetry)} readings, faults {faults}")
+    mock.create_app().run(host=args.host, port=args.port, debug=False, use_reloader=False, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
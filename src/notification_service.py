@@ -1,94 +1,327 @@
+import atexit
+import random
+import threading
+import time
 from apprise import Apprise
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from functools import lru_cache
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
 import logging
 
 import config
 
 logger = logging.getLogger('octobot.notification_service')
-DISCORD_CHAR_LIMIT = 1900 # Technically it's 2000 but the "title" and backticks are part of it so this is safer in case the formatting changes
+# Room left under each service's body limit in case Apprise's own formatting adds to the message
+BODY_LIMIT_MARGIN = 100
+# Limit for services Apprise doesn't know one for (Discord's 2000 less the margin, which used to be the only limit)
+DEFAULT_BODY_LIMIT = 1900
+CODE_BLOCK_START = "```py\n"
+CODE_BLOCK_END = "\n```"
+
+# Retries of a failed send to one target: exponential backoff with jitter from the base delay, capped at the max
+SEND_BASE_DELAY_SECONDS = 2.0
+SEND_MAX_DELAY_SECONDS = 120.0
+
+
+@dataclass(frozen=True)
+class Message:
+    text: str
+    is_error: bool = False  # a stack trace, sent as a code block
+
+
+@dataclass
+class Notification:
+    body: str
+    title: str = ""
+    attempts: int = 0  # failed sends so far
+
+
+_apprise_cache: Dict[str, Apprise] = {}
+_apprise_cache_lock = threading.Lock()
+
+
+def get_apprise(url: str) -> Apprise:
+    """The Apprise instance for a notification URL, built once and kept across config reloads."""
+    with _apprise_cache_lock:
+        apprise = _apprise_cache.get(url)
+        if apprise is None:
+            apprise = Apprise()
+            if not apprise.add(url):
+                logger.warning(f"Apprise doesn't recognise the notification URL {url.split('://')[0]}://...")
+            _apprise_cache[url] = apprise
+        return apprise
+
+
+def chunk_text(text: str, limit: int) -> List[str]:
+    """
+    Splits text into chunks of at most limit characters, in order and along line boundaries.
+    Only a line that is longer than the limit by itself is split mid-line.
+    """
+    chunks = []
+    lines: List[str] = []
+    length = 0
+    for line in text.split("\n"):
+        if lines and length + 1 + len(line) > limit:
+            chunks.append("\n".join(lines))
+            lines, length = [], 0
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        length += len(line) + (1 if lines else 0)
+        lines.append(line)
+    if lines:
+        chunks.append("\n".join(lines))
+    return chunks
+
+
+@lru_cache(maxsize=256)
+def format_message(text: str, is_error: bool, limit: int) -> Tuple[str, ...]:
+    """A message as the bodies to send to a service with the given limit, stack traces wrapped as code blocks."""
+    if not is_error:
+        return tuple(chunk_text(text, limit))
+    code_limit = max(1, limit - len(CODE_BLOCK_START) - len(CODE_BLOCK_END))
+    return tuple(f"{CODE_BLOCK_START}{chunk}{CODE_BLOCK_END}" for chunk in chunk_text(text, code_limit))
+
+
+def pack_messages(messages: Iterable[Message], limit: int) -> List[str]:
+    """
+    Packs messages, in order, into the fewest bodies of at most limit characters, one message per line.
+    Messages too long for one body are chunked first.
+    """
+    bodies = []
+    current: List[str] = []
+    length = 0
+    for message in messages:
+        for piece in format_message(message.text, message.is_error, limit):
+            if current and length + 1 + len(piece) > limit:
+                bodies.append("\n".join(current))
+                current, length = [], 0
+            length += len(piece) + (1 if current else 0)
+            current.append(piece)
+    if current:
+        bodies.append("\n".join(current))
+    return bodies
+
+
+class NotificationTarget:
+    """
+    One notification URL, the messages waiting to go to it and the worker thread sending them,
+    so a slow or failing service doesn't hold up the others.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.apprise = get_apprise(url)
+        self.pending: Deque[Notification] = deque()
+        self.next_attempt_at = 0.0  # time.monotonic() before which nothing is sent, while backing off
+        self.sending = False  # whether the first pending message is being sent right now
+        self.closed = False
+        self.worker: Optional[threading.Thread] = None
+
+    @property
+    def idle(self) -> bool:
+        return not self.pending and not self.sending
+
+    def body_limit(self, title: str = "") -> int:
+        """The longest body this target's service takes with the given title, less BODY_LIMIT_MARGIN."""
+        limits = []
+        for plugin in self.apprise:
+            limit = plugin.body_maxlen - BODY_LIMIT_MARGIN
+            if title and not plugin.title_maxlen:
+                # Services without titles get the title as the first line of the body
+                limit -= len(title) + 2
+            limits.append(limit)
+        return max(1, min(limits)) if limits else DEFAULT_BODY_LIMIT
+
+    def add(self, notification: Notification) -> None:
+        """Queues a message, coalescing it with the last one if that hasn't been sent yet. Must hold the service's lock."""
+        last = self.pending[-1] if self.pending else None
+        in_flight = self.sending and len(self.pending) == 1
+        if last is not None and not in_flight and last.attempts == 0 and last.title == notification.title and \
+                len(last.body) + len(notification.body) + 1 <= self.body_limit(notification.title):
+            last.body = f"{last.body}\n{notification.body}"
+            return
+
+        self.pending.append(notification)
+        if len(self.pending) > config.NOTIFICATION_QUEUE_SIZE:
+            # Drop the oldest message, unless it's the one being sent
+            dropped = self.pending[1] if self.sending else self.pending[0]
+            self.pending.remove(dropped)
+            logger.warning(f"Notification queue for {self} is full, dropped: {dropped.body[:100]}")
+
+    def __str__(self):
+        # Notification URLs contain tokens, so only the scheme is logged
+        return f"{self.url.split('://')[0]}://..."
+
 
 class NotificationService:
+    """
+    Sends notifications in the background, so the bot thread never waits on a slow notification service.
+    Each target (notification URL) has its own queue and worker thread, coalesces messages with the same
+    title that are still waiting, retries failures with backoff and holds at most NOTIFICATION_QUEUE_SIZE
+    messages, dropping the oldest. Messages are chunked to each target's own limit, and batches packed into
+    as few messages as that limit allows. Whatever is still queued is flushed when the process exits.
+    """
 
     def __init__(self, notification_urls: str, batch_enabled: bool):
         self.notification_urls = notification_urls
-        self.batch_notifications: List[str] = []
+        self.batch_notifications: List[Message] = []
         self.batch_enabled = batch_enabled
-        self._apprise: Optional[Apprise] = None
+        self._targets: Optional[List[NotificationTarget]] = None
+        self._condition = threading.Condition()
+        self._exit_flush_registered = False
 
     def _refresh_from_config(self) -> None:
-        if self.notification_urls != config.NOTIFICATION_URLS:
-            self.notification_urls = config.NOTIFICATION_URLS
-            self._apprise = None
+        with self._condition:
+            if self.notification_urls != config.NOTIFICATION_URLS:
+                self.notification_urls = config.NOTIFICATION_URLS
+                self._update_targets()
         if self.batch_enabled != config.BATCH_NOTIFICATIONS:
             self.batch_enabled = config.BATCH_NOTIFICATIONS
 
+    def _get_targets(self) -> List[NotificationTarget]:
+        """The configured targets. Must be called holding self._condition."""
+        if self._targets is None:
+            self._targets = [NotificationTarget(url) for url in self._configured_urls()]
+        return self._targets
+
+    def _configured_urls(self) -> List[str]:
+        return list(dict.fromkeys(url.strip() for url in self.notification_urls.split(',') if url.strip()))
 
-    def _get_apprise(self) -> Optional[Apprise]:
-        if self._apprise is None:
-            self._apprise = Apprise()
-            for url in self.notification_urls.split(','):
-                self._apprise.add(url.strip())
+    def _update_targets(self) -> None:
+        """
+        Follows a change of notification URLs, keeping the targets (and their queues) of URLs that are
+        still configured and stopping the rest. Must be called holding self._condition.
+        """
+        if self._targets is None:
+            return
+        existing = {target.url: target for target in self._targets}
+        self._targets = [existing.pop(url, None) or NotificationTarget(url) for url in self._configured_urls()]
+        for target in existing.values():
+            target.closed = True
+        self._condition.notify_all()
 
-        return self._apprise
+    def _close_targets(self) -> None:
+        """Stops the targets' workers once they've sent what they're sending. Must be called holding self._condition."""
+        for target in self._targets or []:
+            target.closed = True
+        self._targets = None
+        self._condition.notify_all()
 
     def send_notification(self, message:str, title: str = "", is_error: bool = False, batchable: bool = True) -> bool:
-        """Sends a notification using Apprise.
+        """Queues a notification to be sent in the background.
 
         Args:
             message (str): The message to send.
             title (str, optional): The title of the notification.
             is_error (bool, optional): Whether the message is a stack trace. Defaults to False.
             batchable (bool, optional): Whether the message can be batched.
+
+        Returns:
+            bool: Whether it was queued (or batched), False if no notification services are configured.
         """
         self._refresh_from_config()
-        apprise = self._get_apprise()
-
-        if is_error:
-            # Apprise fails if we try to send a discord message over 2k chars (long stacktraces) so chunk it and send it recursively.
-            # I don't like this approach very much but it's the best I could come up with.
-            if len(message) > DISCORD_CHAR_LIMIT:
-                self.send_notification(message[:-DISCORD_CHAR_LIMIT], "", is_error, batchable)
-                message = message[-DISCORD_CHAR_LIMIT:]
-
-            message = f"```py\n{message}\n```"
 
         if self.batch_enabled and batchable:
-            self.batch_notifications.append(message)
+            self.batch_notifications.append(Message(message, is_error))
             logger.debug(f"Added message to batch. Current batch size: {len(self.batch_notifications)}")
             return True
-        else:
-            if not apprise:
-                logger.warning("No notification services configured. Check config.NOTIFICATION_URLS.")
-                logger.info(message)
-                return False
-            success = apprise.notify(body=message, title=title)
-            logger.info(f"Successfuly sent notification: {message}")
-            if not success:
-                logger.error(f"Failed to send notification: {title}")
-            return success
+
+        return self._enqueue([Message(message, is_error)], title)
 
     def send_batch_notification(self) -> bool:
+        """Queues everything batched so far, packed into as few notifications as each target allows."""
         self._refresh_from_config()
         if not self.batch_notifications:
             logger.debug("No notifications in batch to send")
             return True
 
-        apprise = self._get_apprise()
-
         now = datetime.now()
         title = now.strftime(f"Octopus MinMax Results - %a %d %b {config.EXECUTION_TIME if not config.ONE_OFF_RUN else now.strftime('%H:%M:%S')}")
-        body = "\n".join(self.batch_notifications)
+        messages = self.batch_notifications
+        self.batch_notifications = []
+        queued = self._enqueue(messages, title)
+        if queued:
+            logger.info(f"Queued batch notification with {len(messages)} messages")
+        return queued
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """Waits up to timeout seconds for every queued message to be sent (or given up on). Returns whether they were."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not all(target.idle for target in self._targets or []):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Gave up waiting for queued notifications to be sent")
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Flushes the queues and stops the workers."""
+        self.flush(timeout)
+        with self._condition:
+            self._close_targets()
+
+    def _enqueue(self, messages: List[Message], title: str) -> bool:
+        with self._condition:
+            targets = self._get_targets()
+            if not targets:
+                logger.warning("No notification services configured. Check config.NOTIFICATION_URLS.")
+                logger.info("\n".join(message.text for message in messages))
+                return False
 
-        if not apprise:
-            logger.warning("Cannot send batch - no notification services configured. Check config.NOTIFICATION_URLS.")
-            logger.info(body)
-            return False
-        success = apprise.notify(body=body, title=title)
+            for target in targets:
+                for body in pack_messages(messages, target.body_limit(title)):
+                    target.add(Notification(body=body, title=title))
+                if target.worker is None:
+                    target.worker = threading.Thread(target=self._work, args=(target,), daemon=True, name="Notifications")
+                    target.worker.start()
+            if not self._exit_flush_registered:
+                atexit.register(self.close)
+                self._exit_flush_registered = True
+            self._condition.notify_all()
+        return True
+
+    def _work(self, target: NotificationTarget) -> None:
+        while True:
+            with self._condition:
+                while not target.pending or time.monotonic() < target.next_attempt_at:
+                    if target.closed and not target.pending:
+                        return
+                    wait = target.next_attempt_at - time.monotonic() if target.pending else None
+                    self._condition.wait(wait)
+                notification = target.pending[0]
+                target.sending = True
+
+            try:
+                success = target.apprise.notify(body=notification.body, title=notification.title)
+            except Exception as e:
+                logger.error(f"Notification to {target} raised {type(e).__name__} - {e}")
+                success = False
+
+            with self._condition:
+                target.sending = False
+                self._finish_send(target, notification, success)
+                self._condition.notify_all()
+
+    @staticmethod
+    def _finish_send(target: NotificationTarget, notification: Notification, success: bool) -> None:
         if success:
-            logger.info(f"Sent batch notification with {len(self.batch_notifications)} messages")
-            self.batch_notifications.clear()
-        else:
-            logger.error("Failed to send batch notification")
+            logger.info(f"Successfuly sent notification to {target}: {notification.body}")
+            target.pending.popleft()
+            target.next_attempt_at = 0.0
+            return
+
+        notification.attempts += 1
+        if notification.attempts >= config.NOTIFICATION_MAX_ATTEMPTS or target.closed:
+            logger.error(f"Failed to send notification to {target} after {notification.attempts} attempts: {notification.title}")
+            target.pending.popleft()
+            target.next_attempt_at = 0.0
+            return
 
-        return success
+        delay = random.uniform(0, min(SEND_MAX_DELAY_SECONDS, SEND_BASE_DELAY_SECONDS * 2 ** notification.attempts))
+        target.next_attempt_at = time.monotonic() + delay
+        logger.warning(f"Failed to send notification to {target} (attempt {notification.attempts}), retrying in {delay:.1f}s")
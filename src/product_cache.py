@@ -0,0 +1,101 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+import logging
+
+import config
+from query_service import QueryService
+import metrics
+
+logger = logging.getLogger('octobot.product_cache')
+
+
+@dataclass
+class CacheEntry:
+    """A cached REST document and the validators needed to revalidate it."""
+    body: dict
+    fetched_at: float  # time.monotonic() of the last download or revalidation
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidations: int = 0  # 304 Not Modified responses
+
+    def __str__(self):
+        return f"hits={self.hits}, misses={self.misses}, revalidated={self.revalidations}"
+
+
+class ProductCache:
+    """
+    Caches the public product catalogue and product detail documents so every comparison
+    (and every run, for a long running bot) shares a single download of each.
+    Expired entries are revalidated with ETag/Last-Modified rather than downloaded again.
+    """
+    _instance: Optional['ProductCache'] = None
+
+    def __init__(self, ttl_seconds: int):
+        logger.debug(f"Initialising {__class__.__name__}")
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._entries: Dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+        # One lock per URL so concurrent callers wait for a single download instead of repeating it
+        self._url_locks: Dict[str, threading.Lock] = {}
+
+    @classmethod
+    def get_instance(cls) -> 'ProductCache':
+        """Gets the ProductCache shared by all comparisons."""
+        if cls._instance is None:
+            cls._instance = cls(config.PRODUCT_CACHE_TTL)
+        return cls._instance
+
+    @metrics.span("product_catalogue")
+    def get_catalogue(self, query_service: QueryService) -> dict:
+        return self.get(query_service, f"{config.BASE_URL}/products/?brand=OCTOPUS_ENERGY&is_business=false")
+
+    def get(self, query_service: QueryService, url: str) -> dict:
+        """Returns the document at url, downloading or revalidating it only when the cached copy has expired."""
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+
+        with url_lock:
+            entry = self._entries.get(url)
+            if entry and time.monotonic() - entry.fetched_at < self.ttl_seconds:
+                self._count('hits')
+                logger.debug(f"Product cache hit: {url}")
+                return entry.body
+
+            if entry:
+                body, headers = query_service.execute_conditional_rest_query(url, entry.etag, entry.last_modified)
+            else:
+                body, headers = query_service.execute_conditional_rest_query(url)
+
+            if body is None:
+                # 304 Not Modified - keep the cached body and restart its TTL
+                self._count('revalidations')
+                logger.debug(f"Product cache revalidated: {url}")
+                entry.fetched_at = time.monotonic()
+                return entry.body
+
+            self._count('misses')
+            self._entries[url] = CacheEntry(
+                body=body,
+                fetched_at=time.monotonic(),
+                etag=headers.get('ETag'),
+                last_modified=headers.get('Last-Modified')
+            )
+            return body
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            setattr(self.stats, stat, getattr(self.stats, stat) + 1)
+        metrics.cache_lookups.inc(cache="product", result=stat)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
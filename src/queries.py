@@ -1,6 +1,16 @@
 token_query = """mutation {{
 	obtainKrakenToken(input: {{ APIKey: "{api_key}" }}) {{
 	    token
+	    refreshToken
+	    refreshExpiresIn
+	}}
+}}"""
+
+refresh_token_query = """mutation {{
+	obtainKrakenToken(input: {{ refreshToken: "{refresh_token}" }}) {{
+	    token
+	    refreshToken
+	    refreshExpiresIn
 	}}
 }}"""
 
@@ -25,8 +35,8 @@ get_terms_version_query = """query {{
     }}
 }}"""
 
-consumption_query = """query {{
-    smartMeterTelemetry(
+# The selections shared by the queries below, so fetching both in one round trip can't drift from either
+_telemetry_selection = """    smartMeterTelemetry(
         deviceId: "{device_id}"
         grouping: HALF_HOURLY
         start: "{start_date}"
@@ -36,10 +46,9 @@ consumption_query = """query {{
     consumptionDelta
     costDeltaWithTax
   }}
-}}"""
+"""
 
-account_query = """query{{
-    account(
+_account_selection = """    account(
         accountNumber: "{acc_number}"
     ) {{
     electricityAgreements(active: true) {{
@@ -65,7 +74,14 @@ account_query = """query{{
             }}
         }}
     }}
-}}"""
+"""
+
+consumption_query = "query {{\n" + _telemetry_selection + "}}"
+
+account_query = "query{{\n" + _account_selection + "}}"
+# account_query and consumption_query in a single round trip, for when the device ID is already known
+account_and_consumption_query = "query{{\n" + _account_selection + _telemetry_selection + "}}"
+
 enrolment_query = """query {{
     productEnrolments(accountNumber: "{acc_number}") {{
         id
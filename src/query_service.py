@@ -1,18 +1,53 @@
+import threading
+import weakref
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from queries import *
 import time
 import logging
+from typing import Optional
+import config
+from token_manager import TokenManager
+from structured_logging import current_run_stats
+import metrics
+from resilience import (
+    CircuitBreaker,
+    DeadlineExceeded,
+    AmbiguousRequestError,
+    endpoint_key,
+    RetryableError,
+    RetryPolicy,
+    RETRYABLE_STATUSES,
+    parse_retry_after
+)
 
 logger = logging.getLogger('octobot.query_service')
-MAX_RETRIES = 5
-BASE_WAIT_BEFORE_RETRY_SECONDS = 30
+REQUEST_TIMEOUT_SECONDS = 60
+# Kraken error codes worth retrying: "Too many requests". Any other GraphQL error (validation, or a
+# mutation being refused) will only be refused again, so it fails straight away.
+TRANSIENT_GQL_ERROR_CODES = {"KT-CT-1199"}
+# Too Many Requests and Too Early: the server refused the request without acting on it
+REFUSED_STATUSES = {429, 425}
 
 class QueryService:
-    _shared_token = None
-    def __init__(self, api_key: str, base_url: str):
+    # One pooled keep-alive session shared by every instance so connections survive between runs
+    _shared_session: requests.Session = None
+    _session_lock = threading.Lock()
+    # Sockets that have carried a request already, to tell a reused connection from a new one
+    _used_sockets = weakref.WeakSet()
+    _used_sockets_lock = threading.Lock()
+
+    def __init__(self, api_key: str, base_url: str, deadline: Optional[float] = None):
+        """
+        deadline is a time.monotonic() value after which no request is started or retried,
+        so one run can't overrun however flaky the API is.
+        """
         logger.debug(f"Initialising {__class__.__name__}")
         self.base_url = base_url
         self.api_key = api_key
+        self.deadline = deadline
+        self.retry_policy = RetryPolicy.from_config()
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/605.1.15 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/605.1.15',
             'Accept': 'application/json, text/plain, */*',
@@ -20,120 +55,230 @@ class QueryService:
             'Content-Type': 'application/json'
         }
         self.graphql_endpoint = f"{self.base_url}/graphql/"
+        self.session = self._get_session()
+        # Shared by every instance using this API key. Public REST queries never need a token.
+        self.token_manager = TokenManager.for_api_key(api_key)
+
+    @classmethod
+    def _get_session(cls) -> requests.Session:
+        with cls._session_lock:
+            if cls._shared_session is None:
+                logger.debug(f"Creating HTTP session with a pool size of {config.HTTP_POOL_SIZE}")
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=config.HTTP_POOL_SIZE, pool_maxsize=config.HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Accept-Encoding': 'gzip, deflate',
+                    'Connection': 'keep-alive'
+                })
+                cls._shared_session = session
+            return cls._shared_session
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request over the pooled session, logging how long the headers and the whole response took
+        and whether a new connection (TCP + TLS handshake) had to be opened for it.
+        """
+        connection = "connection closed by the server"
+
+        def note_connection(response: requests.Response, **_) -> None:
+            # Runs before the body is read, while the response still holds its own connection
+            nonlocal connection
+            sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+            if sock is not None:
+                connection = self._note_socket(sock)
 
-        if QueryService._shared_token is None:
-            QueryService._shared_token = self._get_token()
+        run_stats = current_run_stats()
+        if run_stats:
+            run_stats.record_api_call()
+        start = time.perf_counter()
+        response = self.session.request(method, url, hooks={'response': note_connection}, **kwargs)
+        # Accessing content makes sure the body has been downloaded before stopping the clock
+        size = len(response.content)
+        total = time.perf_counter() - start
+        endpoint = endpoint_key(url)
+        metrics.http_request_seconds.observe(total, method=method, endpoint=endpoint, status=response.status_code)
+        metrics.http_response_bytes.inc(size, endpoint=endpoint)
+        logger.debug(f"{method} {url} took {total * 1000:.0f}ms "
+                     f"(headers after {response.elapsed.total_seconds() * 1000:.0f}ms, {size} bytes, {connection})",
+                     extra={'http_method': method, 'url': url, 'status': response.status_code,
+                            'latency_ms': round(total * 1000), 'bytes': size, 'connection': connection})
+        return response
 
+    @classmethod
+    def _note_socket(cls, sock) -> str:
+        with cls._used_sockets_lock:
+            if sock in cls._used_sockets:
+                return "reused connection"
+            cls._used_sockets.add(sock)
+            return "new connection"
 
-    def _get_token(self):
-        logger.debug("Getting token")
-        formatted_token_query = token_query.format(api_key=self.api_key)
+    @metrics.span("token_fetch")
+    def _obtain_token(self, refresh_token: Optional[str] = None) -> dict:
+        """Sends the obtainKrakenToken mutation, with the refresh token if given or else the API key."""
+        logger.debug("Refreshing token" if refresh_token else "Getting token")
+        if refresh_token:
+            formatted_token_query = refresh_token_query.format(refresh_token=refresh_token)
+        else:
+            formatted_token_query = token_query.format(api_key=self.api_key)
         headers = self.headers.copy()
         payload = {"query": formatted_token_query, "variables": {}}
 
         try:
-            response = requests.post(
-                self.graphql_endpoint,
-                headers=headers,
-                json=payload,
-                timeout=60
-            )
-
-            response.raise_for_status()
+            response = self._send('POST', self.graphql_endpoint, headers=headers, json=payload)
+
+            self._raise_for_response(response)
             result = response.json()
-            logger.debug(f"GQL query response: status={response.status_code} | body={result}")
+            logger.debug(f"GQL token response: status={response.status_code}")
 
             if "errors" in result:
                 raise Exception(f"GQL errors: {result['errors']}")
 
-            token = result.get("data", {}).get("obtainKrakenToken", {}).get("token")
-
-            if not token:
-                raise Exception("GQL token missing from response")
-
-            logger.info(f"Acquired token: {token[:20]}...")
-            return token
+            return (result.get("data") or {}).get("obtainKrakenToken") or {}
+        except RetryableError as e:
+            # Left for the retry policy of the query that needed the token
+            logger.warning(f"Failed to get token: {e}")
+            raise
         except Exception as e:
             logger.error(f"Failed to get token: {type(e).__name__} - {e}")
             raise Exception("Failed to get token")
 
+    @metrics.span("gql_query")
     def execute_gql_query(self, query: str):
         logger.debug(f"Executing GQL query: '{query}'")
-        retry = 0
         token_refreshed = False
-        while retry < MAX_RETRIES:
-            headers = self.headers.copy()
+        # A mutation that may have reached the server mustn't be sent again
+        is_mutation = query.lstrip().startswith("mutation")
 
-            if self._shared_token:
-                headers["Authorization"] = self._shared_token
+        def attempt():
+            nonlocal token_refreshed
+            headers = self.headers.copy()
+            token = self.token_manager.get_token(self._obtain_token)
+            headers["Authorization"] = token
 
             payload = {
                 "query": query,
                 "variables": {}
             }
-            try:
-                response = requests.post(
-                    self.graphql_endpoint,
-                    headers=headers,
-                    json=payload,
-                    timeout=60
-                )
-
-                logger.debug(f"GQL query response: status={response.status_code} | body={response.json()}")
-                if response.ok:
-                    result = response.json()
-                    if "errors" in result:
-                        error_codes = [e.get("extensions", {}).get("errorCode") for e in result.get("errors", [])]
-                        if "KT-CT-1124" in error_codes and not token_refreshed:
-                            logger.debug("JWT expired, refreshing token...")
-                            try:
-                                QueryService._shared_token = self._get_token()
-                                token_refreshed = True
-                                continue  # Retry with new token
-                            except Exception as e:
-                                logger.warning(f"Failed to refresh token: {e}")
-                        raise Exception(f"GQL errors: {result['errors']}")
-
-                    data = result.get("data")
-                    if data and isinstance(data, dict) and len(data) > 0:
-                        return data
-                    else:
-                        raise Exception("No 'data' returned from GraphQL query")
-
-                if response.status_code in [401, 403] and not token_refreshed:
-                    logger.debug("Authentication failed, refreshing token...")
-                    try:
-                        QueryService._shared_token = self._get_token()
-                        token_refreshed = True
-                        continue
+            response = self._send('POST', self.graphql_endpoint, headers=headers, json=payload,
+                                  idempotent=not is_mutation)
 
-                    except Exception as e:
-                        logger.warning(f"Failed to refresh token: {e}")
+            logger.debug(f"GQL query response: status={response.status_code} | body={response.text}")
+            if response.ok:
+                result = response.json()
+                if "errors" in result:
+                    error_codes = [e.get("extensions", {}).get("errorCode") for e in result.get("errors", [])]
+                    if "KT-CT-1124" in error_codes and not token_refreshed:
+                        # Only if the token was revoked or the clocks disagree, expiry is normally handled ahead of time
+                        logger.debug("JWT expired, refreshing token...")
+                        self.token_manager.invalidate(token)
+                        token_refreshed = True
+                        raise RetryableError("JWT expired", retry_after=0, server_fault=False)
+                    if any(code in TRANSIENT_GQL_ERROR_CODES for code in error_codes):
+                        raise RetryableError(f"GQL errors: {result['errors']}", server_fault=False)
+                    raise Exception(f"GQL errors: {result['errors']}")
 
-            except Exception as e:
-                logger.warning(f"Request exception on attempt {retry + 1}/{MAX_RETRIES}: {type(e).__name__} - {e}")
-                if retry == MAX_RETRIES - 1:
-                    raise Exception(f"GQL query failed after {MAX_RETRIES} attempts: {e}")
+                data = result.get("data")
+                if data and isinstance(data, dict) and len(data) > 0:
+                    return data
+                raise RetryableError("No 'data' returned from GraphQL query", server_fault=False)
 
-            if retry == MAX_RETRIES - 1:
-                logger.warning(f"GQL query failed after {MAX_RETRIES} attempts: {response.status_code}: {response.text}")
-                raise Exception(f"GQL query failed after {MAX_RETRIES} attempts: {response.status_code}: {response.text}")
+            if response.status_code in [401, 403] and not token_refreshed:
+                logger.debug("Authentication failed, refreshing token...")
+                self.token_manager.invalidate(token)
+                token_refreshed = True
+                raise RetryableError(f"{response.status_code}: authentication failed", retry_after=0, server_fault=False)
 
+            self._raise_for_response(response, idempotent=not is_mutation)
 
-            # Calculate wait time with exponential backoff
-            wait_time = BASE_WAIT_BEFORE_RETRY_SECONDS * (2 ** retry)
-            logger.debug(f"Request failed with status {response.status_code}. Retrying in {wait_time} seconds... (attempt {retry + 1}/{MAX_RETRIES})")
-            retry += 1
-            time.sleep(wait_time)
+        return self.retry_policy.call(attempt, CircuitBreaker.for_endpoint(self.graphql_endpoint),
+                                      self.deadline, "GQL query")
 
+    @metrics.span("rest_query")
     def execute_rest_query(self, url: str):
         logger.info(f"Executing REST query: {url}")
-        try:
-            response = requests.get(url, timeout=60)
+
+        def attempt():
+            response = self._send('GET', url)
             logger.debug(f"REST query response: status={response.status_code} | body={response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text[:200]}")
-            response.raise_for_status()
+            self._raise_for_response(response)
             return response.json()
+
+        try:
+            return self.retry_policy.call(attempt, CircuitBreaker.for_endpoint(url), self.deadline, "REST query")
         except Exception as e:
             logger.exception(f"Request failed for {url}: {type(e).__name__} - {e}")
             raise Exception(f"ERROR: Request failed for {url}: {type(e).__name__} - {e}")
 
+    @metrics.span("rest_query")
+    def execute_conditional_rest_query(self, url: str, etag: str = None, last_modified: str = None):
+        """
+        Executes a REST query, revalidating a previously fetched copy when validators are given.
+        Returns (body, headers) where body is None if the server replied 304 Not Modified.
+        """
+        logger.info(f"Executing conditional REST query: {url}")
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        def attempt():
+            response = self._send('GET', url, headers=headers)
+            logger.debug(f"REST query response: status={response.status_code} | etag={response.headers.get('ETag')} | last_modified={response.headers.get('Last-Modified')}")
+            if response.status_code == 304:
+                return None, response.headers
+            self._raise_for_response(response)
+            return response.json(), response.headers
+
+        try:
+            return self.retry_policy.call(attempt, CircuitBreaker.for_endpoint(url), self.deadline, "REST query")
+        except Exception as e:
+            logger.exception(f"Request failed for {url}: {type(e).__name__} - {e}")
+            raise Exception(f"ERROR: Request failed for {url}: {type(e).__name__} - {e}")
+
+    def _send(self, method: str, url: str, idempotent: bool = True, **kwargs) -> requests.Response:
+        """
+        One attempt at a request, turning network failures into retryable errors. A request that isn't
+        idempotent is only retried if it can't have been sent, i.e. the connection was never made.
+        """
+        try:
+            return self._request(method, url, timeout=self._timeout(), **kwargs)
+        except requests.ConnectTimeout as e:
+            raise RetryableError(f"{type(e).__name__} - {e}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # e.g. a reset or a read timeout after the request went out
+            if not idempotent and not self._never_connected(e):
+                raise AmbiguousRequestError(f"{type(e).__name__} - {e} (not retried, the request may have gone through)")
+            raise RetryableError(f"{type(e).__name__} - {e}")
+
+    @staticmethod
+    def _never_connected(error: requests.RequestException) -> bool:
+        """Whether the connection couldn't be opened at all (refused, or the host not found)."""
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def _timeout(self) -> float:
+        """The per-request timeout, cut short so a request can't outlive the run deadline."""
+        if self.deadline is None:
+            return REQUEST_TIMEOUT_SECONDS
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("The run deadline has passed")
+        return min(REQUEST_TIMEOUT_SECONDS, remaining)
+
+    @staticmethod
+    def _raise_for_response(response: requests.Response, idempotent: bool = True) -> None:
+        """
+        Raises for an error status, retryably if it's worth retrying. A request that isn't idempotent got as
+        far as the server (or a gateway in front of it), so it's only retried if it was refused as too many or too early.
+        """
+        if response.ok:
+            return
+        message = f"{response.status_code}: {response.text[:200]}"
+        if response.status_code in RETRYABLE_STATUSES and (idempotent or response.status_code in REFUSED_STATUSES):
+            raise RetryableError(message, retry_after=parse_retry_after(response.headers.get('Retry-After')))
+        if response.status_code in RETRYABLE_STATUSES:
+            raise AmbiguousRequestError(f"{message} (not retried, the request may have gone through)")
+        raise Exception(message)
@@ -0,0 +1,66 @@
+from bisect import bisect_right
+from datetime import datetime, timezone
+from typing import List, Optional
+import math
+
+
+def to_epoch(timestamp: str) -> float:
+    """Converts an API ISO 8601 timestamp (with a 'Z' or numeric offset) to epoch seconds."""
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+def from_epoch(epoch: float) -> str:
+    """Converts epoch seconds to the API's UTC timestamp format."""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class RateIndex:
+    """
+    Unit rates parsed once into parallel arrays sorted by valid_from, so the rate covering
+    a reading can be found with a binary search instead of scanning every rate.
+    """
+
+    def __init__(self, rate_data: List[dict]):
+        rates = sorted(
+            # DIRECT_DEBIT is for flexible that has different price for direct debit or not
+            (rate for rate in rate_data if rate.get('payment_method') in [None, "DIRECT_DEBIT"]),
+            key=lambda rate: to_epoch(rate['valid_from'])
+        )
+        self.starts: List[float] = [to_epoch(rate['valid_from']) for rate in rates]
+        # Flexible has no end time, so default to the end of time
+        self.ends: List[float] = [to_epoch(rate['valid_to']) if rate.get('valid_to') else math.inf for rate in rates]
+        self.values: List[float] = [rate['value_inc_vat'] for rate in rates]
+
+    def __len__(self):
+        return len(self.values)
+
+    def find_position(self, epoch: float) -> Optional[int]:
+        """
+        Returns the position of the rate covering epoch, or None if there isn't one.
+        On a boundary between two rates the later one wins, matching the API's newest-first ordering.
+        """
+        position = bisect_right(self.starts, epoch) - 1
+        if position < 0 or epoch > self.ends[position]:
+            return None
+        return position
+
+    def rate_at(self, epoch: float) -> Optional[float]:
+        position = self.find_position(epoch)
+        return self.values[position] if position is not None else None
+
+    def covers(self, start: float, end: float, allow_open_ended: bool = False) -> bool:
+        """
+        Whether the rates cover every moment from start to end without a gap.
+        Open-ended rates only count if allow_open_ended, as for stored rates a newer
+        rate may since have been published to replace them.
+        """
+        return self.covered_until(start, allow_open_ended) >= end
+
+    def covered_until(self, start: float, allow_open_ended: bool = False) -> float:
+        """How far from start the rates run without a gap, start itself if no rate covers it."""
+        cursor = start
+        for rate_start, rate_end in zip(self.starts, self.ends):
+            if rate_start > cursor or (rate_end == math.inf and not allow_open_ended):
+                break
+            cursor = max(cursor, rate_end)
+        return cursor
@@ -0,0 +1,183 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, TypeVar
+from urllib.parse import urlsplit
+import logging
+
+import config
+import metrics
+
+logger = logging.getLogger('octobot.resilience')
+
+T = TypeVar('T')
+
+# Statuses worth retrying, everything else in the 4xx range won't get better by asking again
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """A failed attempt that might succeed if tried again."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, server_fault: bool = True):
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds the server asked us to wait, if it said
+        # False when the API answered fine but the attempt needs repeating (e.g. after refreshing the token),
+        # so it doesn't count towards tripping the circuit breaker
+        self.server_fault = server_fault
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AmbiguousRequestError(Exception):
+    """A request that isn't idempotent failed after it may have reached the server, so it wasn't retried."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, given either as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def endpoint_key(url: str) -> str:
+    """Groups URLs into endpoints for circuit breaking, e.g. api.octopus.energy/v1/products."""
+    parts = urlsplit(url)
+    segments = [segment for segment in parts.path.split("/") if segment][:2]
+    return f"{parts.netloc}/{'/'.join(segments)}"
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after failure_threshold consecutive failures, so a run fails fast
+    instead of waiting out every retry. After reset_seconds one trial call is let through (half-open):
+    success closes the circuit again, failure keeps it open for another reset_seconds.
+    """
+    _breakers: Dict[str, 'CircuitBreaker'] = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_endpoint(cls, url: str) -> 'CircuitBreaker':
+        """Gets the breaker shared by every request to the URL's endpoint."""
+        key = endpoint_key(url)
+        with cls._breakers_lock:
+            if key not in cls._breakers:
+                cls._breakers[key] = cls(key, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_SECONDS)
+            return cls._breakers[key]
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_seconds or self._trial_in_progress:
+                raise CircuitOpenError(f"Circuit open for {self.name} after {self._failures} failures, "
+                                       f"retrying in {max(0.0, self.reset_seconds - waited):.0f}s")
+            logger.info(f"Circuit half-open for {self.name}, trying one request")
+            self._trial_in_progress = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit closed for {self.name}")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or (self._opened_at is None and self._failures >= self.failure_threshold):
+                logger.warning(f"Circuit opened for {self.name} after {self._failures} consecutive failures")
+                metrics.circuit_opened.inc(endpoint=self.name)
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring the server's Retry-After."""
+    max_attempts: int
+    base_delay: float  # in seconds
+    max_delay: float   # in seconds
+
+    @classmethod
+    def from_config(cls) -> 'RetryPolicy':
+        return cls(config.RETRY_MAX_ATTEMPTS, config.RETRY_BASE_DELAY_SECONDS, config.RETRY_MAX_DELAY_SECONDS)
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """How long to wait after the given failed attempt (1-based)."""
+        if retry_after is not None:
+            return retry_after
+        # Full jitter spreads retries out so bots that failed together don't retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def call(self,
+             func: Callable[[], T],
+             breaker: CircuitBreaker,
+             deadline: Optional[float] = None,
+             description: str = "Request") -> T:
+        """
+        Calls func until it succeeds, raises something other than RetryableError, runs out of attempts
+        or would overrun deadline (a time.monotonic() value). Fails straight away while breaker is open.
+        """
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = func()
+            except RetryableError as e:
+                if e.server_fault:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                attempt += 1
+                if breaker.is_open:
+                    raise CircuitOpenError(f"{description} failed and the circuit for {breaker.name} is now open: {e}")
+                if attempt >= self.max_attempts:
+                    raise Exception(f"{description} failed after {attempt} attempts: {e}")
+
+                wait_time = self.delay(attempt, e.retry_after)
+                if deadline is not None and time.monotonic() + wait_time > deadline:
+                    raise DeadlineExceeded(f"{description} failed and the run deadline leaves no time to retry: {e}")
+                logger.warning(f"{description} failed on attempt {attempt}/{self.max_attempts}: {e}. "
+                               f"Retrying in {wait_time:.1f}s")
+                metrics.http_retries.inc(endpoint=breaker.name)
+                time.sleep(wait_time)
+                continue
+            except Exception:
+                # The endpoint answered, the request itself was at fault
+                breaker.record_success()
+                raise
+
+            breaker.record_success()
+            return result
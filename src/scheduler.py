@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+import logging
+
+logger = logging.getLogger('octobot.scheduler')
+
+# Given the current wall-clock time, returns when a job should next run, or None if it shouldn't run
+Schedule = Callable[[datetime], Optional[datetime]]
+
+
+def daily_at(time_getter: Callable[[], str], offset: timedelta = timedelta(0)) -> Schedule:
+    """
+    Runs every day at the HH:MM returned by time_getter (read on every reschedule, so config
+    changes apply straight away), shifted by offset.
+    """
+    def schedule(now: datetime) -> Optional[datetime]:
+        hour, minute = map(int, time_getter().split(":"))
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + offset
+        while next_run <= now:
+            next_run += timedelta(days=1)
+        return next_run
+    return schedule
+
+
+def daily_at_times(times_getter: Callable[[], List[str]]) -> Schedule:
+    """Runs every day at each of the HH:MM times returned by times_getter."""
+    def schedule(now: datetime) -> Optional[datetime]:
+        runs = [daily_at(lambda t=t: t)(now) for t in times_getter() if t]
+        return min(runs) if runs else None
+    return schedule
+
+
+def seconds_until(wall_time: datetime) -> float:
+    """
+    Seconds from now until a naive local wall-clock time. Worked out from the UTC instants, so a clock
+    change (e.g. to or from summer time) in between is counted, which subtracting naive times misses.
+    """
+    return wall_time.timestamp() - time.time()
+
+
+@dataclass(order=True)
+class ScheduledJob:
+    deadline: float  # time.monotonic() at which the job is due
+    sequence: int    # breaks deadline ties in the order jobs were scheduled
+    name: str = field(compare=False)
+    func: Callable[[], None] = field(compare=False)
+    schedule: Optional[Schedule] = field(compare=False)  # None for one-shot jobs
+    wall_time: datetime = field(compare=False)  # the wall-clock time the deadline was computed for
+    cancelled: bool = field(default=False, compare=False)
+
+
+class Scheduler:
+    """
+    Runs jobs from a heap ordered by monotonic deadline. The run loop sleeps exactly until the next
+    job is due and can be woken early, e.g. when the config changes, to recompute every deadline.
+    Wall-clock times are converted to monotonic deadlines, and checked again on waking: a job only
+    runs once its wall-clock time has come, so a clock change in between can't fire it early.
+    """
+
+    def __init__(self):
+        logger.debug(f"Initialising {__class__.__name__}")
+        self._heap: List[ScheduledJob] = []
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def add_job(self, name: str, schedule: Schedule, func: Callable[[], None]) -> None:
+        """Adds a recurring job, replacing any job with the same name."""
+        with self._condition:
+            self._schedule(name, func, schedule, datetime.now())
+            self._condition.notify()
+
+    def add_one_shot(self, name: str, delay_seconds: float, func: Callable[[], None]) -> None:
+        """Runs func once, delay_seconds from now."""
+        with self._condition:
+            self._cancel(name)
+            self._push(ScheduledJob(
+                deadline=time.monotonic() + delay_seconds,
+                sequence=next(self._sequence),
+                name=name,
+                func=func,
+                schedule=None,
+                wall_time=datetime.now() + timedelta(seconds=delay_seconds)
+            ))
+            self._condition.notify()
+
+    def reschedule(self) -> None:
+        """Recomputes the deadline of every recurring job (call after the config changes) and wakes the run loop."""
+        with self._condition:
+            now = datetime.now()
+            for job in list(self._jobs.values()):
+                if job.schedule is not None:
+                    self._schedule(job.name, job.func, job.schedule, now)
+            self._condition.notify()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self) -> None:
+        """Runs due jobs until stop() is called. Jobs run one at a time on the calling thread."""
+        while True:
+            with self._condition:
+                job = self._wait_for_next_job()
+                if job is None:
+                    return
+
+            logger.debug(f"Running scheduled job '{job.name}'")
+            try:
+                job.func()
+            except Exception:
+                logger.exception(f"Scheduled job '{job.name}' failed")
+
+            if job.schedule is not None:
+                with self._condition:
+                    # Only reschedule if the job wasn't replaced while it was running
+                    if self._jobs.get(job.name) is job:
+                        # From its own time at the earliest, so a job that ran quickly isn't booked for the same time again
+                        self._schedule(job.name, job.func, job.schedule, max(datetime.now(), job.wall_time))
+
+    def next_runs(self) -> Dict[str, datetime]:
+        """When each pending job is next due, for logging and the dashboard."""
+        with self._condition:
+            return {job.name: job.wall_time for job in self._jobs.values() if not job.cancelled}
+
+    def _wait_for_next_job(self) -> Optional[ScheduledJob]:
+        while not self._stopped:
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                self._condition.wait()
+                continue
+
+            job = self._heap[0]
+            remaining = job.deadline - time.monotonic()
+            if remaining > 0:
+                self._condition.wait(timeout=remaining)
+                continue
+
+            # The wall clock may have been set back since the deadline was computed
+            early_by = seconds_until(job.wall_time)
+            if early_by > 0:
+                logger.debug(f"Wall clock is behind for job '{job.name}', waiting another {early_by:.1f}s")
+                job.deadline = time.monotonic() + early_by
+                heapq.heapify(self._heap)
+                continue
+
+            heapq.heappop(self._heap)
+            self._jobs.pop(job.name, None)
+            if job.schedule is not None:
+                # Keep recurring jobs registered while they run so reschedule() still knows about them
+                self._jobs[job.name] = job
+            return job
+        return None
+
+    def _schedule(self, name: str, func: Callable[[], None], schedule: Schedule, now: datetime) -> None:
+        self._cancel(name)
+        next_run = schedule(now)
+        if next_run is None:
+            # Inactive for now, keep it registered so a reschedule can activate it
+            self._jobs[name] = ScheduledJob(float('inf'), next(self._sequence), name, func, schedule, now, cancelled=True)
+            return
+
+        logger.debug(f"Scheduled job '{name}' for {next_run}")
+        self._push(ScheduledJob(
+            deadline=time.monotonic() + max(0.0, seconds_until(next_run)),
+            sequence=next(self._sequence),
+            name=name,
+            func=func,
+            schedule=schedule,
+            wall_time=next_run
+        ))
+
+    def _push(self, job: ScheduledJob) -> None:
+        self._jobs[job.name] = job
+        heapq.heappush(self._heap, job)
+
+    def _cancel(self, name: str) -> None:
+        job = self._jobs.pop(name, None)
+        if job:
+            job.cancelled = True
@@ -0,0 +1,260 @@
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+import logging
+
+T = TypeVar('T')
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+# Attributes every LogRecord has, anything else on a record was passed with extra=
+_STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+@dataclass
+class RunStats:
+    """Counted while a run is in progress and logged with its final entry."""
+    api_calls: int = 0
+    spans: Dict[str, Tuple[int, float]] = field(default_factory=dict)  # name: (count, total seconds)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_api_call(self) -> None:
+        with self._lock:
+            self.api_calls += 1
+
+    def record_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            count, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (count + 1, total + seconds)
+
+
+# Fields added to every structured entry logged in the current context, e.g. run_id, account and tariff
+_log_context: contextvars.ContextVar[Dict[str, object]] = contextvars.ContextVar('log_context', default={})
+_run_stats: contextvars.ContextVar[Optional[RunStats]] = contextvars.ContextVar('run_stats', default=None)
+
+
+def new_run_id() -> str:
+    return f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[None]:
+    """Adds fields to every structured entry logged inside the block, on this thread or ones started with in_current_context."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+@contextmanager
+def run_context(run_id: Optional[str] = None) -> Iterator[RunStats]:
+    """Starts counting a run's API calls and tags every entry logged inside the block with its run_id."""
+    stats = RunStats()
+    token = _run_stats.set(stats)
+    try:
+        with log_context(run_id=run_id or new_run_id()):
+            yield stats
+    finally:
+        _run_stats.reset(token)
+
+
+def current_run_stats() -> Optional[RunStats]:
+    return _run_stats.get()
+
+
+def in_current_context(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    Wraps func to run in a copy of the caller's context, for handing to a thread pool.
+    Pool threads don't inherit the submitting thread's context, so entries logged in them would lose the run_id.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line with the record, the context fields and anything passed with extra=."""
+
+    @staticmethod
+    def timestamp(record: logging.LogRecord) -> str:
+        return datetime.fromtimestamp(record.created, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.timestamp(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'func': record.funcName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(_log_context.get())
+        entry.update({key: value for key, value in record.__dict__.items() if key not in _STANDARD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogIndex:
+    """
+    SQLite index of where each structured entry is in the JSON lines files, by time, level and run,
+    so one run's entries or the errors can be read straight from their offsets instead of scanning every file.
+    Entries are located by file inode, which doesn't change when the files are rotated.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        file_id INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        ts TEXT NOT NULL,
+        level INTEGER NOT NULL,
+        run_id TEXT,
+        PRIMARY KEY (file_id, offset)
+    );
+    CREATE INDEX IF NOT EXISTS entries_ts ON entries (ts);
+    CREATE INDEX IF NOT EXISTS entries_run ON entries (run_id, ts);
+    CREATE INDEX IF NOT EXISTS entries_level ON entries (level, ts);
+    """
+    # Index rows are written in batches, a query writes any pending ones first
+    BATCH_SIZE = 50
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(self.SCHEMA)
+
+    def add(self, file_id: int, offset: int, length: int, ts: str, level: str, run_id: Optional[str]) -> None:
+        with self._lock:
+            self._pending.append((file_id, offset, length, ts, LEVELS.index(level) if level in LEVELS else 0, run_id))
+            if len(self._pending) >= self.BATCH_SIZE:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def forget_files(self, live_file_ids: List[int]) -> None:
+        """Drops the rows for files that have been rotated away."""
+        with self._lock:
+            self._flush()
+            placeholders = ",".join("?" * len(live_file_ids)) or "NULL"
+            with self._connection:
+                self._connection.execute(f"DELETE FROM entries WHERE file_id NOT IN ({placeholders})", live_file_ids)
+
+    def query(self, run_id: Optional[str] = None, min_level: Optional[str] = None,
+              since: Optional[str] = None, until: Optional[str] = None, limit: int = 500) -> List[sqlite3.Row]:
+        """The newest matching entries' locations, oldest first."""
+        conditions, parameters = [], []
+        if run_id:
+            conditions.append("run_id = ?")
+            parameters.append(run_id)
+        if min_level in LEVELS:
+            conditions.append("level >= ?")
+            parameters.append(LEVELS.index(min_level))
+        if since:
+            conditions.append("ts >= ?")
+            parameters.append(since)
+        if until:
+            conditions.append("ts <= ?")
+            parameters.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            self._flush()
+            rows = self._connection.execute(
+                f"SELECT file_id, offset, length FROM entries {where} ORDER BY ts DESC, offset DESC LIMIT ?",
+                parameters + [limit]
+            ).fetchall()
+        return rows[::-1]
+
+    def runs(self, limit: int = 30) -> List[dict]:
+        """The most recent runs, newest first, with how many entries and errors each logged."""
+        with self._lock:
+            self._flush()
+            rows = self._connection.execute(
+                "SELECT run_id, MIN(ts) AS started, MAX(ts) AS finished, COUNT(*) AS entries, "
+                "SUM(level >= ?) AS errors FROM entries WHERE run_id IS NOT NULL "
+                "GROUP BY run_id ORDER BY started DESC LIMIT ?",
+                (LEVELS.index('ERROR'), limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO entries (file_id, offset, length, ts, level, run_id) VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending
+            )
+        self._pending = []
+
+
+class JsonLinesHandler(RotatingFileHandler):
+    """Writes structured entries as JSON lines, recording each one's position in a LogIndex."""
+
+    def __init__(self, filename: str, index: LogIndex, max_bytes: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.index = index
+        self.setFormatter(JsonLineFormatter())
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+                self.index.forget_files([file_id for _, file_id in self.files()])
+            if self.stream is None:
+                self.stream = self._open()
+
+            line = self.format(record)
+            self.stream.flush()
+            offset = self.stream.buffer.tell() if hasattr(self.stream, 'buffer') else self.stream.tell()
+            self.stream.write(line + self.terminator)
+            self.stream.flush()
+            self.index.add(os.fstat(self.stream.fileno()).st_ino, offset, len(line.encode('utf-8')) + 1,
+                           JsonLineFormatter.timestamp(record), record.levelname, _log_context.get().get('run_id'))
+        except Exception:
+            self.handleError(record)
+
+    def files(self) -> List[tuple]:
+        """The existing JSON lines files and their inodes, newest first."""
+        files = []
+        for path in [self.baseFilename] + [f"{self.baseFilename}.{number}" for number in range(1, self.backupCount + 1)]:
+            try:
+                files.append((path, os.stat(path).st_ino))
+            except FileNotFoundError:
+                continue
+        return files
+
+    def read_entries(self, locations: List[sqlite3.Row]) -> List[dict]:
+        """Reads the entries at the locations returned by LogIndex.query."""
+        paths = {file_id: path for path, file_id in self.files()}
+        entries = []
+        handles = {}
+        try:
+            for location in locations:
+                path = paths.get(location['file_id'])
+                if path is None:
+                    continue
+                if path not in handles:
+                    handles[path] = open(path, 'rb')
+                handle = handles[path]
+                handle.seek(location['offset'])
+                entries.append(json.loads(handle.read(location['length'])))
+        finally:
+            for handle in handles.values():
+                handle.close()
+        return entries
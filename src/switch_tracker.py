@@ -0,0 +1,201 @@
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Dict, List, Optional
+import logging
+
+import config
+from account_manager import AccountManager
+from resilience import AmbiguousRequestError
+import metrics
+
+logger = logging.getLogger('octobot.switch_tracker')
+
+# Polling starts quickly, as the agreement is often ready within seconds, then backs off
+FIRST_POLL_SECONDS = 2.0
+POLL_BACKOFF = 1.5
+MAX_POLL_SECONDS = 20.0
+
+# If the enrolment doesn't show the agreement as ready within this long (it may not be listed, or use status
+# names we don't know) the terms are accepted anyway, as the bot did after a fixed wait before polling
+ACCEPT_FALLBACK_SECONDS = 120
+
+# Enrolment and stage statuses meaning the switch won't go through
+FAILED_STATUSES = {"FAILED", "CANCELLED", "WITHDRAWN", "REJECTED"}
+# Enrolment statuses meaning it has finished, so there are no terms left to accept
+COMPLETED_STATUSES = {"COMPLETED", "COMPLETE", "SUCCEEDED", "ACCEPTED"}
+# Stage statuses meaning the stage hasn't been reached yet
+NOT_STARTED_STATUSES = {"NOT_STARTED", "PENDING", "WAITING", "SCHEDULED"}
+
+
+class SwitchStage(Enum):
+    AWAITING_AGREEMENT = "awaiting_agreement"        # waiting for Octopus to generate the new agreement
+    AWAITING_VERIFICATION = "awaiting_verification"  # terms accepted, waiting for the agreement to start
+    VERIFIED = "verified"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+
+
+@dataclass
+class SwitchOutcome:
+    stage: SwitchStage
+    accepted_version: Optional[str] = None
+    error: Optional[str] = None
+    # An accept failed without knowing whether it went through, so it's checked for rather than sent again
+    accept_unconfirmed: bool = False
+    stage_seconds: Dict[str, float] = field(default_factory=dict)  # seconds spent in each stage
+
+    @property
+    def verified(self) -> bool:
+        return self.stage == SwitchStage.VERIFIED
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.stage_seconds.values())
+
+
+def _terms_statuses(enrolment: dict) -> List[str]:
+    """The upper-cased statuses of the enrolment's terms stages and steps."""
+    statuses = []
+    for stage in enrolment.get("stages") or []:
+        if "TERMS" in (stage.get("name") or "").upper():
+            statuses.append((stage.get("status") or "").upper())
+        for step in stage.get("steps") or []:
+            if "TERMS" in (step.get("displayName") or "").upper():
+                statuses.append((step.get("status") or "").upper())
+    return statuses
+
+
+def terms_ready(enrolment: dict) -> bool:
+    """
+    Whether the enrolment has got as far as its terms being accepted, i.e. the new agreement exists.
+    Enrolments without a terms stage count as ready as soon as they're listed.
+    """
+    terms_statuses = _terms_statuses(enrolment)
+    if not terms_statuses:
+        return True
+    return any(status not in NOT_STARTED_STATUSES for status in terms_statuses)
+
+
+def terms_accepted(enrolment: dict) -> bool:
+    """Whether the enrolment shows its terms as accepted."""
+    return any(status in COMPLETED_STATUSES for status in _terms_statuses(enrolment))
+
+
+def enrolment_failure(enrolment: dict) -> Optional[str]:
+    """Describes why the enrolment failed, or None if it hasn't."""
+    if (enrolment.get("status") or "").upper() in FAILED_STATUSES:
+        return f"Enrolment {enrolment.get('id')} is {enrolment['status']}"
+    for stage in enrolment.get("stages") or []:
+        if (stage.get("status") or "").upper() in FAILED_STATUSES:
+            return f"Enrolment stage {stage.get('name')} is {stage['status']}"
+    return None
+
+
+class SwitchTracker:
+    """
+    Follows a switch from startOnboardingProcess to a verified agreement by polling rather than waiting a
+    fixed time: the enrolment is watched with productEnrolments and its terms accepted as soon as the new
+    agreement exists (or regardless, from ACCEPT_FALLBACK_SECONDS on), then the account is polled until the
+    agreement starting today appears. A failed or completed enrolment ends the wait for the agreement.
+    An accept that may have gone through despite failing is never sent again: later polls look for it instead.
+    Polls back off from FIRST_POLL_SECONDS to MAX_POLL_SECONDS, restarting with each stage, and the whole
+    switch gives up after SWITCH_TIMEOUT_MINUTES. Each stage is timed as a span.
+    """
+
+    def __init__(self, account_manager: AccountManager, product_code: str, enrolment_id: str,
+                 on_stage: Optional[Callable[[SwitchOutcome, float], None]] = None):
+        self.account_manager = account_manager
+        self.product_code = product_code
+        self.enrolment_id = enrolment_id
+        self.on_stage = on_stage  # called on each change of stage with the outcome so far and the seconds the last stage took
+
+    def run(self) -> SwitchOutcome:
+        outcome = SwitchOutcome(stage=SwitchStage.AWAITING_AGREEMENT)
+        deadline = time.monotonic() + config.SWITCH_TIMEOUT_MINUTES * 60
+        stage_started = time.monotonic()
+        poll_seconds = FIRST_POLL_SECONDS
+
+        while outcome.stage in (SwitchStage.AWAITING_AGREEMENT, SwitchStage.AWAITING_VERIFICATION):
+            stage = outcome.stage
+            try:
+                if stage == SwitchStage.AWAITING_AGREEMENT:
+                    self._poll_enrolment(outcome, time.monotonic() - stage_started)
+                else:
+                    self._poll_agreement(outcome)
+            except Exception as e:
+                # The API being briefly unavailable shouldn't abandon a switch that's under way
+                logger.warning(f"Polling switch to {self.product_code} failed while {stage.value}: {e}")
+
+            now = time.monotonic()
+            if outcome.stage != stage:
+                self._finish_stage(outcome, stage, now - stage_started)
+                stage_started = now
+                poll_seconds = FIRST_POLL_SECONDS
+                continue
+            if now + poll_seconds > deadline:
+                outcome.error = f"Gave up {stage.value.replace('_', ' ')} after {config.SWITCH_TIMEOUT_MINUTES} minutes"
+                if outcome.accept_unconfirmed:
+                    outcome.error += ", the terms may have been accepted"
+                outcome.stage = SwitchStage.TIMED_OUT
+                self._finish_stage(outcome, stage, now - stage_started)
+                break
+            time.sleep(poll_seconds)
+            poll_seconds = min(MAX_POLL_SECONDS, poll_seconds * POLL_BACKOFF)
+
+        return outcome
+
+    def _poll_enrolment(self, outcome: SwitchOutcome, waited: float) -> None:
+        try:
+            enrolment = self.account_manager.fetch_enrolment(self.enrolment_id)
+        except Exception as e:
+            # Not knowing the enrolment's state mustn't stop the fallback below
+            logger.warning(f"Couldn't fetch enrolment {self.enrolment_id}: {e}")
+            enrolment = None
+
+        if enrolment is not None:
+            failure = enrolment_failure(enrolment)
+            if failure:
+                outcome.error = failure
+                outcome.stage = SwitchStage.FAILED
+                return
+            if (enrolment.get("status") or "").upper() in COMPLETED_STATUSES:
+                logger.info(f"Enrolment {self.enrolment_id} is {enrolment['status']}, nothing left to accept")
+                outcome.stage = SwitchStage.AWAITING_VERIFICATION
+                return
+
+        if enrolment is None or not terms_ready(enrolment):
+            if waited < ACCEPT_FALLBACK_SECONDS:
+                status = enrolment.get('status') if enrolment else "not listed yet"
+                logger.debug(f"Enrolment {self.enrolment_id} is {status}, agreement not ready yet")
+                return
+            logger.info(f"No sign of the agreement for enrolment {self.enrolment_id} after {waited:.0f}s, "
+                        f"trying to accept the terms anyway")
+
+        if outcome.accept_unconfirmed:
+            # Sending it again could accept twice, so look for signs that the last one went through
+            if (enrolment is not None and terms_accepted(enrolment)) or self.account_manager.verify_new_agreement_status():
+                logger.info(f"The earlier accept of enrolment {self.enrolment_id}'s terms went through")
+                outcome.stage = SwitchStage.AWAITING_VERIFICATION
+            else:
+                logger.debug(f"No sign yet that the earlier accept of enrolment {self.enrolment_id}'s terms went through")
+            return
+
+        try:
+            outcome.accepted_version = self.account_manager.accept_new_agreement(self.product_code, self.enrolment_id)
+        except AmbiguousRequestError:
+            outcome.accept_unconfirmed = True
+            raise
+        outcome.stage = SwitchStage.AWAITING_VERIFICATION
+
+    def _poll_agreement(self, outcome: SwitchOutcome) -> None:
+        if self.account_manager.verify_new_agreement_status():
+            outcome.stage = SwitchStage.VERIFIED
+
+    def _finish_stage(self, outcome: SwitchOutcome, stage: SwitchStage, seconds: float) -> None:
+        outcome.stage_seconds[stage.value] = seconds
+        metrics.record_span(f"switch_{stage.value}", seconds)
+        logger.info(f"Switch to {self.product_code} spent {seconds:.1f}s {stage.value.replace('_', ' ')}, "
+                    f"now {outcome.stage.value}", extra={'switch_stage': outcome.stage.value, 'stage_seconds': seconds})
+        if self.on_stage:
+            self.on_stage(outcome, seconds)
@@ -0,0 +1,121 @@
+import base64
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+import logging
+
+import config
+
+logger = logging.getLogger('octobot.token_manager')
+
+# Kraken tokens last an hour. Used when the expiry can't be read from the token itself.
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+
+
+def decode_jwt_expiry(token: str) -> Optional[float]:
+    """Reads the exp claim (epoch seconds) from a JWT without verifying it. Returns None if it can't be read."""
+    try:
+        payload = token.split(".")[1]
+        # JWTs drop the base64 padding
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+@dataclass
+class KrakenToken:
+    token: str
+    expires_at: float  # epoch seconds
+    refresh_token: Optional[str] = None
+    refresh_expires_at: Optional[float] = None  # epoch seconds
+
+    @classmethod
+    def from_response(cls, response: dict) -> 'KrakenToken':
+        """Builds a token from an obtainKrakenToken response."""
+        token = response.get("token")
+        if not token:
+            raise Exception("GQL token missing from response")
+
+        expires_at = decode_jwt_expiry(token)
+        if expires_at is None:
+            logger.debug(f"Couldn't read the token's expiry, assuming {DEFAULT_TOKEN_LIFETIME_SECONDS}s")
+            expires_at = time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+
+        refresh_expires_at = response.get("refreshExpiresIn")
+        if refresh_expires_at is not None:
+            refresh_expires_at = float(refresh_expires_at)
+            # Kraken gives an epoch timestamp despite the name, but allow for a duration too
+            if refresh_expires_at < 10 ** 9:
+                refresh_expires_at += time.time()
+
+        return cls(token=token, expires_at=expires_at,
+                   refresh_token=response.get("refreshToken"), refresh_expires_at=refresh_expires_at)
+
+    def expires_within(self, seconds: float) -> bool:
+        return time.time() + seconds >= self.expires_at
+
+    def can_refresh_within(self, seconds: float) -> bool:
+        """Whether the refresh token will still be valid in the given number of seconds."""
+        return bool(self.refresh_token) and (self.refresh_expires_at is None
+                                             or time.time() + seconds < self.refresh_expires_at)
+
+
+class TokenManager:
+    """
+    Keeps the Kraken token for one API key. The token's expiry is read from the JWT and it's renewed
+    TOKEN_REFRESH_MARGIN_SECONDS before then, with the refresh token when there's a valid one, so requests
+    don't fail on an expired token first. Renewal happens under the manager's lock, so however many threads
+    need a token at once only one obtainKrakenToken mutation is sent.
+    """
+    _managers: Dict[str, 'TokenManager'] = {}
+    _managers_lock = threading.Lock()
+
+    def __init__(self):
+        self._token: Optional[KrakenToken] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_api_key(cls, api_key: str) -> 'TokenManager':
+        """Gets the manager shared by everything using api_key."""
+        with cls._managers_lock:
+            if api_key not in cls._managers:
+                cls._managers[api_key] = cls()
+            return cls._managers[api_key]
+
+    def get_token(self, obtain: Callable[[Optional[str]], dict]) -> str:
+        """
+        Returns a token valid for at least TOKEN_REFRESH_MARGIN_SECONDS, renewing it first if needed.
+        obtain sends the obtainKrakenToken mutation, with the refresh token if given or the API key if None,
+        and returns its response.
+        """
+        with self._lock:
+            margin = config.TOKEN_REFRESH_MARGIN_SECONDS
+            if self._token is None or self._token.expires_within(margin):
+                self._renew(obtain, margin)
+            return self._token.token
+
+    def invalidate(self, token: str) -> None:
+        """
+        Marks a token the API rejected as expired. Only the first caller holding it does anything,
+        so threads that were all rejected at once lead to a single renewal.
+        """
+        with self._lock:
+            if self._token is not None and self._token.token == token:
+                logger.debug("Token rejected by the API, it will be renewed")
+                self._token.expires_at = 0
+
+    def _renew(self, obtain: Callable[[Optional[str]], dict], margin: float) -> None:
+        if self._token is not None and self._token.can_refresh_within(margin):
+            try:
+                self._token = KrakenToken.from_response(obtain(self._token.refresh_token))
+                logger.info(f"Refreshed token: {self._token.token[:20]}..., "
+                            f"valid for {self._token.expires_at - time.time():.0f}s")
+                return
+            except Exception as e:
+                logger.warning(f"Couldn't refresh token, obtaining a new one with the API key: {e}")
+
+        self._token = KrakenToken.from_response(obtain(None))
+        logger.info(f"Acquired token: {self._token.token[:20]}..., valid for {self._token.expires_at - time.time():.0f}s")
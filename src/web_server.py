@@ -1,11 +1,41 @@
-from flask import Flask, render_template, request, redirect, flash, Response
-from functools import wraps
+from flask import Flask, render_template, request, redirect, flash, Response, jsonify
+from functools import lru_cache, wraps
+import gzip
+import hashlib
+import json
+import os
+import threading
 import config_manager
 import config
+from data_store import DataStore
+from datetime import date
+from tariff import TARIFFS
+from log_reader import LogReader, LogFilter, LEVELS, parse_cursor
+import logger as logging_setup
+import metrics
 import logging
 
 logger = logging.getLogger('octobot.web_server')
 
+LOG_PAGE_SIZE = 200
+MAX_LOG_PAGE_SIZE = 1000
+# The log is polled every second, so this sends a keep-alive every 15s when nothing is logged
+SSE_KEEP_ALIVE_POLLS = 15
+# Each open log stream holds one of the server's threads, so at most half of them can be streams.
+# Live views that don't get one poll /api/logs instead.
+log_stream_slots = threading.BoundedSemaphore(config.WEB_THREADS // 2) if config.WEB_THREADS >= 2 else None
+LOG_POLL_SECONDS = 5
+log_reader = LogReader()
+SAVINGS_PERIODS = {'daily': 'day', 'weekly': 'week', 'monthly': 'month'}
+MAX_SAVINGS_PERIODS = 366
+
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_BYTES = 500
+GZIP_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript', 'application/json'}
+# Static files requested with their version (see static_url) never change, so browsers can keep them for a year
+STATIC_MAX_AGE_SECONDS = 365 * 24 * 3600
+
 app = Flask(__name__)
 app.secret_key = 'octobot-tool'
 
@@ -13,6 +43,56 @@ def is_ingress_request():
     # Skip auth for ingress requests
     return bool(request.headers.get('X-Ingress-Path') or request.headers.get('X-Hassio-Ingress'))
 
+@lru_cache(maxsize=None)
+def static_url(filename: str) -> str:
+    """
+    A static file's URL, versioned by its content so it can be cached indefinitely. Relative, like the
+    templates' other links, so it works behind the Home Assistant ingress path.
+    """
+    with open(os.path.join(app.static_folder, filename), 'rb') as file:
+        version = hashlib.sha1(file.read()).hexdigest()[:12]
+    return f"static/{filename}?v={version}"
+
+
+@app.context_processor
+def template_helpers():
+    return {'static_url': static_url}
+
+
+@app.after_request
+def cache_and_compress(response: Response) -> Response:
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE_SECONDS
+        response.cache_control.immutable = True
+    return _gzip(response)
+
+
+def _gzip(response: Response) -> Response:
+    if response.status_code != 200 or 'gzip' not in request.accept_encodings or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    if request.endpoint == 'static':
+        # Static files are streamed from disk, read them in to compress them
+        response.direct_passthrough = False
+        response.make_sequence()
+    elif response.is_streamed:
+        return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # The compressed body differs byte for byte, so its ETag can only be weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
 def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -70,56 +150,177 @@ def config_page():
 @app.route('/logs')
 @require_auth
 def logs():
-    log_lines = tail_file('logs/octobot.log', None)  # None = read entire file
-    log_entries = group_log_entries(log_lines)
-    return render_template('logs.html', log_entries=log_entries)
+    log_filter = _log_filter_from_request()
+    log_entries, older_cursor = log_reader.page(LOG_PAGE_SIZE, log_filter=log_filter)
+    return render_template('logs.html', log_entries=log_entries, older_cursor=older_cursor,
+                           levels=LEVELS, log_filter=log_filter, log_poll_seconds=LOG_POLL_SECONDS)
 
 
-def tail_file(filepath, n):
-    """Read last n lines from file, or entire file if n is None"""
+@app.route('/api/logs')
+@require_auth
+def logs_api():
+    """
+    The newest log entries, those before the `before` cursor or those written after the `after` cursor,
+    optionally filtered by `level` (minimum) and `module`.
+    """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            if n is None:
-                return lines  # Return entire file
-            return lines[-n:] if len(lines) > n else lines
-    except FileNotFoundError:
-        return ["Log file not found. The bot may not have started yet."]
-    except Exception as e:
-        logger.error(f"Error reading log file: {e}")
-        return [f"Error reading log file: {str(e)}"]
-
-
-def group_log_entries(log_lines):
-    """Group log lines into entries based on timestamp pattern"""
-    import re
-
-    # Pattern matches timestamp
-    timestamp_pattern = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
-
-    entries = []
-    current_entry = []
-
-    for line in log_lines:
-        if timestamp_pattern.match(line):
-            # New log entry starts
-            if current_entry:
-                entries.append(''.join(current_entry))
-            current_entry = [line]
+        limit = min(int(request.args.get('limit', LOG_PAGE_SIZE)), MAX_LOG_PAGE_SIZE)
+        if request.args.get('after'):
+            log_entries = log_reader.since(request.args['after'], limit, _log_filter_from_request())
+            older_cursor = None
         else:
-            # Continuation of previous entry
-            if current_entry:
-                current_entry.append(line)
-            else:
-                # Edge case: file starts without timestamp
-                current_entry.append(line)
+            log_entries, older_cursor = log_reader.page(limit, request.args.get('before'), _log_filter_from_request())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'entries': [entry.to_dict() for entry in log_entries], 'older_cursor': older_cursor})
+
+
+@app.route('/api/logs/stream')
+@require_auth
+def logs_stream():
+    """
+    Server-sent events with every new log entry. Reconnecting clients resume from Last-Event-ID.
+    Responds 503 when every stream slot is taken, the client then polls /api/logs instead.
+    """
+    log_filter = _log_filter_from_request()
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+    try:
+        parse_cursor(after)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if log_stream_slots is None or not log_stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open log streams, poll /api/logs instead'})
+        response.headers['Retry-After'] = str(LOG_POLL_SECONDS)
+        return response, 503
+    entries = log_reader.follow(after, log_filter)
+
+    def events():
+        # Waitress only sends the headers with the first chunk, so send one straight away
+        yield ": ok\n\n"
+        idle_polls = 0
+        for entry in entries:
+            if entry is None:
+                idle_polls += 1
+                if idle_polls % SSE_KEEP_ALIVE_POLLS == 0:
+                    # Keeps proxies from closing the connection, and notices when the client has gone
+                    yield ": keep-alive\n\n"
+                continue
+            yield f"id: {entry.resume_cursor}\ndata: {json.dumps(entry.to_dict())}\n\n"
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called once the server is done with the response, including when the client goes away
+    response.call_on_close(log_stream_slots.release)
+    return response
+
+
+@app.route('/api/runs')
+@require_auth
+def runs_api():
+    """The most recent runs in the structured logs, with their entry and error counts."""
+    handler = logging_setup.structured_log_handler
+    if handler is None:
+        return jsonify({'error': 'Structured logs are disabled, set STRUCTURED_LOGS=true'}), 404
+    limit = min(request.args.get('limit', 30, type=int), MAX_LOG_PAGE_SIZE)
+    return jsonify({'runs': handler.index.runs(limit)})
 
-    if current_entry:
-        entries.append(''.join(current_entry))
 
-    return entries
+@app.route('/api/runs/<run_id>/logs')
+@require_auth
+def run_logs_api(run_id):
+    """Every structured entry one run logged, optionally from a minimum `level` up."""
+    return _structured_entries(run_id=run_id)
+
+
+@app.route('/api/structured-logs')
+@require_auth
+def structured_logs_api():
+    """The newest structured entries, filtered by minimum `level` and a `since`/`until` ISO 8601 UTC time range."""
+    return _structured_entries(since=request.args.get('since'), until=request.args.get('until'))
+
+
+def _structured_entries(**conditions):
+    handler = logging_setup.structured_log_handler
+    if handler is None:
+        return jsonify({'error': 'Structured logs are disabled, set STRUCTURED_LOGS=true'}), 404
+    limit = min(request.args.get('limit', LOG_PAGE_SIZE, type=int), MAX_LOG_PAGE_SIZE)
+    locations = handler.index.query(min_level=request.args.get('level', '').upper(), limit=limit, **conditions)
+    return jsonify({'entries': handler.read_entries(locations)})
+
+
+@app.route('/metrics')
+@require_auth
+def metrics_endpoint():
+    """Latency histograms, retries, cache lookups and bytes transferred, in the Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/savings/<period>')
+@require_auth
+def savings_api(period):
+    """
+    Daily, weekly or monthly cost on each tariff and realised savings, from the rollups updated after each run,
+    optionally for one `mpan`. Tagged with an ETag so an unchanged dashboard costs a 304.
+    """
+    if period not in SAVINGS_PERIODS:
+        return jsonify({'error': f"Unknown period {period}, expected one of {', '.join(SAVINGS_PERIODS)}"}), 404
+    data_store = DataStore.get_instance()
+    if data_store is None:
+        return jsonify({'error': 'Storage is disabled, set DATA_STORE_PATH'}), 404
+    limit = max(1, min(request.args.get('limit', 30, type=int), MAX_SAVINGS_PERIODS))
+    mpan = request.args.get('mpan')
+
+    tag = f"{period}:{limit}:{mpan}:{data_store.rollup_version()}:{config.SAVINGS_BASELINE_TARIFF}"
+    etag = hashlib.sha1(tag.encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'period': period, 'baseline_tariff': config.SAVINGS_BASELINE_TARIFF,
+                            'periods': data_store.get_savings(SAVINGS_PERIODS[period], limit, mpan)})
+    response.set_etag(etag)
+    # Cached by the browser but revalidated on every view, the rollups change after each run
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/forecast')
+@require_auth
+def forecast_api():
+    """The day-ahead forecasts of today onwards, from the DAY_AHEAD_TIME job."""
+    data_store = DataStore.get_instance()
+    if data_store is None:
+        return jsonify({'error': 'Storage is disabled, set DATA_STORE_PATH'}), 404
+    display_names = {tariff.id: tariff.display_name for tariff in TARIFFS}
+    forecasts = data_store.get_forecasts(date.today())
+    for forecast in forecasts:
+        for tariff in forecast['tariffs']:
+            tariff['display_name'] = display_names.get(tariff['tariff_id'], tariff['tariff_id'])
+
+    response = jsonify({'forecasts': forecasts})
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def _log_filter_from_request() -> LogFilter:
+    level = request.args.get('level', '').upper()
+    modules = [module.strip() for module in request.args.get('module', '').split(',') if module.strip()]
+    return LogFilter(min_level=level if level in LEVELS else None, modules=modules)
 
 
 def run_server():
+    if config.WEB_SERVER == 'waitress':
+        try:
+            from waitress import serve
+        except ImportError:
+            logger.warning("waitress isn't installed, falling back to Flask's development server")
+        else:
+            logger.info(f"Web server starting on http://localhost:{config.WEB_PORT} (waitress, {config.WEB_THREADS} threads)")
+            # The connection limit only caps open sockets, log_stream_slots keeps streams from taking every thread
+            serve(app, host='0.0.0.0', port=config.WEB_PORT, threads=config.WEB_THREADS,
+                  connection_limit=config.WEB_CONNECTION_LIMIT, ident='OctoBot')
+            return
+
     logger.info(f"Web server starting on http://localhost:{config.WEB_PORT}")
-    app.run(host='0.0.0.0', port=config.WEB_PORT, debug=False, use_reloader=False)
+    # Threaded so a log stream doesn't hold up every other request
+    app.run(host='0.0.0.0', port=config.WEB_PORT, debug=False, use_reloader=False, threaded=True)